@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmarks
+
+# In[ ]:
+
+
+#export
+
+# Initialization
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import warnings
+import contextlib
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use('Agg') # no figure is shown during the fits
+import theoretical_tools
+from theoretical_tools import TF_my_templateup, pseq_params, make_fit_from_data
+from cell_library import get_neuron_params
+from syn_and_connec_library import get_connectivity_and_synapses_matrix
+from NeuronConnectivity import ReformatSynParameters, LoadTransferFunctions, DataPath
+from DiffOperator import DifferentialOperator, NotebookParameters, NOTEBOOK_V0
+from SDEIntegrator import RegulatoryPsi, TimeStepping
+from DecisionSession import RunSession, StimulusProfile
+
+
+# ## Setup
+
+# In[ ]:
+
+
+#export
+
+# All the benchmarks use the CONFIG1 fits of the RS and FS cells, the default parameters (without
+# SI units) and initial conditions of the notebook, and draw their random numbers from generators
+# seeded with BENCHMARK_SEED, so that each run of a benchmark does exactly the same work.
+
+BENCHMARK_SEED = 20230
+
+BASELINE_FILE = DataPath('benchmark_baseline.json')
+
+
+def CountingTF(TF, counter):
+    # TF wrapped so that counter['TFCalls'] counts its calls (a call to the jet counting as one, as in
+    # DifferentialOperator) and counter['TFPoints'] the number of points at which it was evaluated
+    def Count(fe, fi, XX):
+        counter['TFCalls'] = counter.get('TFCalls', 0) + 1
+        counter['TFPoints'] = counter.get('TFPoints', 0) + np.broadcast(fe, fi, XX).size
+    def CountedTF(fe, fi, XX):
+        Count(fe, fi, XX)
+        return TF(fe, fi, XX)
+    if hasattr(TF, 'jet'):
+        def CountedJet(fe, fi, XX):
+            Count(fe, fi, XX)
+            return TF.jet(fe, fi, XX)
+        CountedTF.jet = CountedJet
+    for attribute in ('params', 'name'):
+        if hasattr(TF, attribute):
+            setattr(CountedTF, attribute, getattr(TF, attribute))
+    return CountedTF
+
+
+@contextlib.contextmanager
+def CountingTemplate(counter):
+    # Counts the calls to theoretical_tools.TF_my_templateup made by the fitting functions, and those to
+    # theoretical_tools.TF_of_threshold (the TF given the threshold) made by fit_transfer_function
+    original, originalOfThreshold = theoretical_tools.TF_my_templateup, theoretical_tools.TF_of_threshold
+    def CountedTemplate(fe, fi, XX, *p):
+        counter['TFCalls'] = counter.get('TFCalls', 0) + 1
+        counter['TFPoints'] = counter.get('TFPoints', 0) + np.broadcast(fe, fi, XX).size
+        return original(fe, fi, XX, *p)
+    def CountedOfThreshold(Vthre, *args):
+        counter['TFCalls'] = counter.get('TFCalls', 0) + 1
+        counter['TFPoints'] = counter.get('TFPoints', 0) + np.size(Vthre)
+        return originalOfThreshold(Vthre, *args)
+    theoretical_tools.TF_my_templateup, theoretical_tools.TF_of_threshold = CountedTemplate, CountedOfThreshold
+    try:
+        yield
+    finally:
+        theoretical_tools.TF_my_templateup, theoretical_tools.TF_of_threshold = original, originalOfThreshold
+
+
+def RSCellParameters():
+    # Parameter dict of the RS cell with its CONFIG1 fit, as built by LoadTransferFunctions
+    params = get_neuron_params('RS-cell', SI_units=True)
+    ReformatSynParameters(params, get_connectivity_and_synapses_matrix('CONFIG1', SI_units=True))
+    params['P'] = np.load(DataPath('RS-cell_CONFIG1_fit.npy'))
+    return params
+
+
+def SyntheticFitData(fileName, seed=BENCHMARK_SEED):
+    # Writes in fileName the data of make_fit_from_data for a synthetic RS cell: its CONFIG1 transfer
+    # function on a (fe, fi) grid without adaptation, with a 2% multiplicative noise
+    rng = np.random.default_rng(seed)
+    params = RSCellParameters()
+    levels = np.linspace(4., 20., 8)                           # fiSim
+    Fe_eff, fiSim = np.meshgrid(np.linspace(1., 15., 15), levels)
+    w = np.zeros_like(Fe_eff)
+    MEANfreq = TF_my_templateup(Fe_eff, fiSim, w, *pseq_params(params))*(1+0.02*rng.standard_normal(Fe_eff.shape))
+    del params['P']
+    data = np.empty(6, dtype=object)
+    data[:] = [MEANfreq, np.zeros_like(MEANfreq), Fe_eff, levels, params, w]
+    np.save(fileName, data, allow_pickle=True)
+
+
+# ## Benchmarks
+
+# In[ ]:
+
+
+#export
+
+# A benchmark is a function (TF1, TF2, counter) returning the function run() to be timed, all its
+# inputs being prepared beforehand. TF1 and TF2 are counting transfer functions (see CountingTF).
+
+def BenchTFScalar(TF1, TF2, counter):
+    p = pseq_params(RSCellParameters())
+    def run():
+        with CountingTemplate(counter):
+            return theoretical_tools.TF_my_templateup(5., 10., 0., *p)
+    return run
+
+
+def BenchTFVectorized(TF1, TF2, counter):
+    p = pseq_params(RSCellParameters())
+    rng = np.random.default_rng(BENCHMARK_SEED)
+    fe, fi, XX = rng.uniform(0.5, 30., 10000), rng.uniform(0.5, 30., 10000), rng.uniform(0., 1e-10, 10000)
+    def run():
+        with CountingTemplate(counter):
+            return theoretical_tools.TF_my_templateup(fe, fi, XX, *p)
+    return run
+
+
+def BenchDifferentialOperator(TF1, TF2, counter):
+    params = NotebookParameters()
+    V = np.array(NOTEBOOK_V0, dtype=float)
+    def run():
+        return DifferentialOperator(V, TF1, TF2, params, 1., 10., 1., 10.)
+    return run
+
+
+def BenchRegulatoryPsi(TF1, TF2, counter):
+    params = NotebookParameters()
+    stimulus = StimulusProfile(params)
+    def run():
+        return RegulatoryPsi(0.5, stimulus, 10*stimulus, params, rng=np.random.default_rng(BENCHMARK_SEED))
+    return run
+
+
+def BenchTimeStepping(TF1, TF2, counter):
+    params = NotebookParameters()
+    stimulus = StimulusProfile(params)
+    lambdaA, lambdaB, psi = RegulatoryPsi(0.5, stimulus, 10*stimulus, params, rng=np.random.default_rng(BENCHMARK_SEED))
+    def run():
+        return TimeStepping(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, rng=np.random.default_rng(BENCHMARK_SEED))
+    return run
+
+
+def BenchEpisode(nH):
+    # One episode of a session of horizon nH, with the decision threshold of the notebook
+    def Bench(TF1, TF2, counter):
+        def run():
+            return RunSession(NotebookParameters(), TF1, TF2, NOTEBOOK_V0, nH, 1, 0.1,
+                              rng=np.random.default_rng(BENCHMARK_SEED))
+        return run
+    return Bench
+
+
+def BenchFit(method):
+    # make_fit_from_data with the given method on the synthetic data of SyntheticFitData
+    def Bench(TF1, TF2, counter):
+        directory = tempfile.mkdtemp()
+        fileName = os.path.join(directory, 'RS-cell_synthetic.npy')
+        SyntheticFitData(fileName)
+        def run():
+            with CountingTemplate(counter), contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                return make_fit_from_data(fileName, method=method)
+        run.cleanup = lambda: shutil.rmtree(directory, ignore_errors=True)
+        return run
+    return Bench
+
+
+BENCHMARKS = {'TF_scalar': BenchTFScalar,
+              'TF_vectorized': BenchTFVectorized,
+              'DifferentialOperator': BenchDifferentialOperator,
+              'RegulatoryPsi': BenchRegulatoryPsi,
+              'TimeStepping': BenchTimeStepping,
+              'episode_H0': BenchEpisode(0),
+              'episode_H1': BenchEpisode(1),
+              'make_fit_from_data': BenchFit('nelder-mead'),
+              'make_fit_least_squares': BenchFit('least_squares')}
+
+
+# ## Measurements
+
+# In[ ]:
+
+
+#export
+
+def MeasureBenchmark(run, counter, repeat=5, minTime=0.05):
+    # run: the function to be timed, counter: the dict its transfer functions count into
+    # After a first call (compilation, caches), run is called number times in a row, number being
+    # doubled until this takes at least minTime seconds, and this is repeated repeat times. The time
+    # is the median over the repeats of the time per call. The allocations (peak of the memory traced
+    # by tracemalloc, numpy arrays included) and the TF calls are those of one more call.
+    run()
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            run()
+        if time.perf_counter()-t0 >= minTime or number >= 2**20:
+            break
+        number *= 2
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            run()
+        times.append((time.perf_counter()-t0)/number)
+    counter.clear()
+    tracemalloc.start()
+    try:
+        run()
+        peakMemory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'time': float(np.median(times)), 'timeMin': min(times), 'timeMax': max(times),
+            'repeat': repeat, 'number': number, 'peakMemory': peakMemory,
+            'TFCalls': counter.get('TFCalls', 0), 'TFPoints': counter.get('TFPoints', 0)}
+
+
+def RunBenchmarks(names=None, repeat=5, minTime=0.05, verbose=False):
+    # Runs the benchmarks of BENCHMARKS (all by default, or those in names) and returns their
+    # measurements (see MeasureBenchmark) with a description of the machine, as a JSON-ready dict
+    TF1, TF2 = LoadTransferFunctions('RS-cell', 'FS-cell', 'CONFIG1')
+    results = {}
+    for name in (BENCHMARKS if names is None else names):
+        counter = {}
+        run = BENCHMARKS[name](CountingTF(TF1, counter), CountingTF(TF2, counter), counter)
+        try:
+            results[name] = MeasureBenchmark(run, counter, repeat, minTime)
+        finally:
+            if hasattr(run, 'cleanup'):
+                run.cleanup()
+        if verbose:
+            print("%-22s %12.6g s  %12d B  %10d TF calls" % (name, results[name]['time'],
+                                                              results[name]['peakMemory'], results[name]['TFCalls']))
+    return {'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform(), 'processor': platform.processor()},
+            'seed': BENCHMARK_SEED, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'benchmarks': results}
+
+
+def SaveBenchmarks(results, fileName):
+    with open(fileName, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+def LoadBenchmarks(fileName):
+    with open(fileName) as f:
+        return json.load(f)
+
+
+def CompareBenchmarks(results, baseline, tolerance=0.25):
+    # Compares results with baseline (both as returned by RunBenchmarks) benchmark by benchmark.
+    # A time or a peak memory more than (1+tolerance) times that of the baseline is a regression,
+    # less than 1/(1+tolerance) times an improvement. The TF calls are deterministic: any change
+    # of them is reported. Returns a list of dicts (benchmark, metric, baseline, value, ratio, status).
+    comparison = []
+    for name, result in results['benchmarks'].items():
+        reference = baseline['benchmarks'].get(name)
+        if reference is None:
+            continue
+        for metric in ('time', 'peakMemory', 'TFCalls', 'TFPoints'):
+            old, new = reference[metric], result[metric]
+            ratio = new/old if old else (1. if new == old else np.inf)
+            if metric.startswith('TF'):
+                status = 'ok' if new == old else 'changed'
+            elif ratio > 1+tolerance:
+                status = 'regression'
+            elif ratio < 1/(1+tolerance):
+                status = 'improvement'
+            else:
+                status = 'ok'
+            comparison.append({'benchmark': name, 'metric': metric, 'baseline': old, 'value': new,
+                               'ratio': ratio, 'status': status})
+    return comparison
+
+
+def PrintComparison(comparison):
+    for row in comparison:
+        print("%-22s %-11s %12.6g -> %12.6g  x%-8.3g %s" % (row['benchmark'], row['metric'], row['baseline'],
+                                                            row['value'], row['ratio'], row['status']))
+
+
+import argparse
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of the transfer function, the differential operator, "
+                                     "the integrators, the episodes and the fit")
+    parser.add_argument('names', nargs='*', help="benchmarks to run, among: "+", ".join(BENCHMARKS)+" (all by default)")
+    parser.add_argument('-o', '--output', help="JSON file where the results are saved")
+    parser.add_argument('-b', '--baseline', default=BASELINE_FILE, help="JSON baseline to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="save the results as the new baseline")
+    parser.add_argument('--repeat', type=int, default=5, help="number of repeats of each timing")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="relative tolerance of the comparison")
+    args = parser.parse_args()
+
+    results = RunBenchmarks(args.names or None, repeat=args.repeat, verbose=True)
+    if args.output:
+        SaveBenchmarks(results, args.output)
+    if args.save_baseline:
+        SaveBenchmarks(results, args.baseline)
+    elif os.path.exists(args.baseline):
+        comparison = CompareBenchmarks(results, LoadBenchmarks(args.baseline), args.tolerance)
+        PrintComparison(comparison)
+        if any(row['status'] in ('regression', 'changed') for row in comparison):
+            sys.exit(1)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Numerical continuation of the fixed points
+
+# In[ ]:
+
+
+#export
+
+# Initialization
+import numpy as np
+from DiffOperator import DifferentialOperator, MakeModelParameters, MODEL_PARAMETER_NAMES, NumericalJacobian
+from FixedPoints import FindFixedPoint
+
+
+# ## Continuation parameter
+
+# In[ ]:
+
+
+#export
+
+# The continuation parameter is a field of the parameter record (e.g. 'wce', 'wci', 'vAI', 'bRS') or a
+# constant stimulus: 'stimulusA', 'stimulusB', or 'stimulus' for the same stimulus on both pools.
+# The other stimuli are fixed by the stimuli argument (stimulusA, stimulusB) of the functions below.
+
+STIMULUS_PARAMETERS = ('stimulus', 'stimulusA', 'stimulusB')
+
+def ParameterRhs(TF1, TF2, params, parameter, stimuli=(0., 0.)):
+    # Returns Rhs(V, value), the noise-free right-hand side with the parameter set to value
+    if parameter not in STIMULUS_PARAMETERS and parameter not in MODEL_PARAMETER_NAMES:
+        raise ValueError("Unknown continuation parameter %s" % parameter)
+    params = MakeModelParameters(params)
+    def Rhs(V, value):
+        stimulusA, stimulusB = stimuli
+        p = params
+        if parameter == 'stimulus':
+            stimulusA = stimulusB = value
+        elif parameter == 'stimulusA':
+            stimulusA = value
+        elif parameter == 'stimulusB':
+            stimulusB = value
+        else:
+            p = MakeModelParameters(params, **{parameter: value})
+        return DifferentialOperator(V, TF1, TF2, p, stimulusA, stimulusB, stimulusA, stimulusB)
+    return Rhs
+
+
+def BranchStimuli(parameter, value, stimuli):
+    # Stimuli (stimulusA, stimulusB) when the parameter has the given value
+    if parameter == 'stimulus':
+        return value, value
+    if parameter == 'stimulusA':
+        return value, stimuli[1]
+    if parameter == 'stimulusB':
+        return stimuli[0], value
+    return stimuli
+
+
+# ## Pseudo-arclength continuation
+
+# In[ ]:
+
+
+#export
+
+# A branch of fixed points F(V, p) = 0 is followed in the (V, p) space, in variables scaled by the size
+# of the starting point (the adaptation variables are orders of magnitude larger than the rates). At
+# each step, the tangent t of the branch solves [dF/dV dF/dp; t_previous] t = [0; 1], the predictor is
+# y + ds*t and the corrector is Newton's method on F(y) = 0 with the predictor's hyperplane
+# t.(y-predictor) = 0, so the branch is followed around the folds. ds grows after an easy correction
+# and is halved after a failed one. The Jacobian of the corrected point gives both the tangent of the
+# next step and the eigenvalues: a fold is detected when det(dF/dV) changes sign, a Hopf point when
+# the number of complex eigenvalues with a positive real part changes. They are located by linear
+# interpolation between the two points of the branch.
+
+def _Special(kind, k, values, V, indicator):
+    # Special point between the points k-1 and k of a branch, indicator being the function which changes sign
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a = indicator[k-1]/(indicator[k-1]-indicator[k])
+    a = a if np.isfinite(a) else 0.5
+    return {'type': kind, 'index': k, 'value': values[k-1]+a*(values[k]-values[k-1]), 'V': V[k-1]+a*(V[k]-V[k-1])}
+
+
+def ContinueBranch(TF1, TF2, params, parameter, bounds, V0=None, stimuli=(0., 0.), ds=0.05, dsMin=1e-5,
+                   dsMax=0.5, maxPoints=500, tol=1e-9, maxCorrections=8, direction=1, start=None):
+    # parameter: the continuation parameter (see ParameterRhs), followed from its value in params (or in
+    #            stimuli) towards direction (+1 or -1), until it leaves bounds = (min, max)
+    # V0: state from which the starting fixed point is searched (FixedPoints.FindFixedPoint)
+    # ds, dsMin, dsMax: arclength steps, in scaled variables
+    # start: optional starting fixed point V, as a (V, value) pair, e.g. taken from another branch
+    # Returns a dict: 'parameter', 'values' (nPoints,), 'V' (nPoints, 18), 'eigenvalues' (nPoints, 18),
+    # 'stable' (nPoints,), 'asymmetry' |v_eA-v_eB| (nPoints,) and the special 'points' (fold and hopf).
+    params = MakeModelParameters(params)
+    Rhs = ParameterRhs(TF1, TF2, params, parameter, stimuli)
+    if start is None:
+        if parameter in STIMULUS_PARAMETERS:
+            value = stimuli[1] if parameter == 'stimulusB' else stimuli[0]
+        else:
+            value = getattr(params, parameter)
+        fixedPoint = FindFixedPoint(TF1, TF2, params, *BranchStimuli(parameter, value, stimuli), V0=V0)
+        if not fixedPoint['converged']:
+            raise RuntimeError("No starting fixed point found for %s=%g" % (parameter, value))
+        x, value = fixedPoint['V'], float(value)
+    else:
+        x, value = np.array(start[0], dtype=float), float(start[1])
+
+    # Scaled variables y = (V/scale, value/scaleP)
+    scale = np.maximum(1., np.abs(x))
+    scaleP = max(1., abs(value))
+    def G(y):
+        return Rhs(y[:-1]*scale, y[-1]*scaleP)/scale
+    def DG(y):
+        Jx = NumericalJacobian(lambda V: Rhs(V, y[-1]*scaleP), y[:-1]*scale)
+        h = 1e-6*max(1., abs(y[-1]))
+        Jp = (G(np.append(y[:-1], y[-1]+h))-G(np.append(y[:-1], y[-1]-h)))/(2*h)
+        return np.column_stack([Jx*scale/scale[:,None], Jp]), Jx
+
+    y = np.append(x/scale, value/scaleP)
+    DGy, Jx = DG(y)
+    tangent = np.zeros(y.size)
+    tangent[-1] = direction
+    values, states, eigenvalues, determinants = [value], [x], [np.linalg.eigvals(Jx)], [np.linalg.det(Jx)]
+    while len(values) < maxPoints:
+        # tangent of the branch, oriented as the previous one
+        t = np.linalg.solve(np.vstack([DGy, tangent]), np.append(np.zeros(y.size-1), 1.))
+        tangent = t/np.linalg.norm(t)
+        # predictor-corrector
+        while True:
+            predictor = y+ds*tangent
+            z = predictor.copy()
+            for corrections in range(maxCorrections):
+                g = G(z)
+                if not np.all(np.isfinite(g)):
+                    break
+                if np.max(np.abs(g)) < tol:
+                    break
+                A, _ = DG(z)
+                z = z-np.linalg.solve(np.vstack([A, tangent]), np.append(g, tangent.dot(z-predictor)))
+            converged = np.all(np.isfinite(z)) and np.max(np.abs(G(z))) < tol
+            if converged:
+                break
+            ds /= 2
+            if ds < dsMin:
+                break
+        if not converged:
+            break
+        y = z
+        DGy, Jx = DG(y)
+        values.append(y[-1]*scaleP)
+        states.append(y[:-1]*scale)
+        eigenvalues.append(np.linalg.eigvals(Jx))
+        determinants.append(np.linalg.det(Jx))
+        if corrections <= 3:
+            ds = min(1.5*ds, dsMax)
+        if not bounds[0] <= values[-1] <= bounds[1]:
+            break
+
+    values, V, eigenvalues, determinants = np.array(values), np.array(states), np.array(eigenvalues), np.array(determinants)
+    complexPair = eigenvalues.imag != 0
+    unstableComplex = np.sum((eigenvalues.real > 0) & complexPair, axis=1)
+    maxComplexReal = np.where(complexPair, eigenvalues.real, -np.inf).max(axis=1)
+    points = []
+    for k in range(1, values.size):
+        if np.sign(determinants[k]) != np.sign(determinants[k-1]):
+            points.append(_Special('fold', k, values, V, determinants))
+        if unstableComplex[k] != unstableComplex[k-1]:
+            points.append(_Special('hopf', k, values, V, maxComplexReal))
+    return {'parameter': parameter, 'values': values, 'V': V, 'eigenvalues': eigenvalues,
+            'stable': np.all(eigenvalues.real < 0, axis=1), 'asymmetry': np.abs(V[:,0]-V[:,7]), 'points': points}
+
+
+# ## Two-parameter bifurcation maps
+
+# In[ ]:
+
+
+#export
+
+def BifurcationMap(TF1, TF2, params, parameter, bounds, parameter2, values2, V0=None, stimuli=(0., 0.), **options):
+    # Continues the branch in parameter (within bounds) for each value of parameter2 in values2, the
+    # starting fixed point of each branch being searched from the one of the previous branch. The fold
+    # and Hopf points of all the branches give the fold and Hopf curves in the (parameter2, parameter) plane.
+    # options: passed to ContinueBranch
+    # Returns a dict with the 'branches', and the 'folds' and 'hopfs' arrays of (value2, value) pairs.
+    params = MakeModelParameters(params)
+    branches, folds, hopfs = [], [], []
+    for value2 in values2:
+        if parameter2 in STIMULUS_PARAMETERS:
+            p, s = params, BranchStimuli(parameter2, value2, stimuli)
+        else:
+            p, s = MakeModelParameters(params, **{parameter2: value2}), stimuli
+        branch = ContinueBranch(TF1, TF2, p, parameter, bounds, V0, s, **options)
+        V0 = branch['V'][0]
+        branches.append(branch)
+        for point in branch['points']:
+            (folds if point['type'] == 'fold' else hopfs).append((value2, point['value']))
+    return {'parameter': parameter, 'parameter2': parameter2, 'values2': np.asarray(values2), 'branches': branches,
+            'folds': np.array(folds).reshape(-1, 2), 'hopfs': np.array(hopfs).reshape(-1, 2)}
+
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Decision-making sessions
+
+# In[ ]:
+
+
+#export
+
+# Initialization
+import os
+import json
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from scipy.special import comb
+from DiffOperator import MakeModelParameters
+from SDEIntegrator import RegulatoryPsi, TimeSteppingToDecision, Recorder
+from NeuronConnectivity import LoadTransferFunctions, TransferFunctionFingerprint
+from NoiseStreams import EpisodeGenerator, TrialNoise
+from FixedPoints import WarmStart
+
+
+# ## Session setup
+
+# In[ ]:
+
+
+#export
+
+DIFFICULTY_SET = [0.01,0.05,0.1,0.15,0.2] # difficulty set of visual discriminization, as in the notebook
+GAIN = 0.3                                 # reward gain, as in the notebook
+
+
+def smoothstep(x, x_min=0, x_max=1, N=1):
+    x = np.clip((x - x_min) / (x_max - x_min), 0, 1)
+
+    result = 0
+    for n in range(0, N + 1):
+         result += comb(N + n, n) * comb(2 * N + 1, N - n) * (-x) ** n
+
+    result *= x ** (N + 1)
+
+    return result
+
+
+def StimulusProfile(params, t0=2):
+# Time profile of the stimuli of one trial (appearing at t0), the stimuli being ampA and ampB times this profile
+    params = MakeModelParameters(params)
+    t = np.linspace(0, params.tF, params.nSteps+1)
+    return smoothstep(t-t0)-smoothstep(t-t0-params.tF)
+
+
+# ## One session (one iteration of the notebook)
+
+# In[ ]:
+
+
+#export
+
+def RunSession(params, TF1, TF2, V0, nH, nOfEpisodes, learningSpeed, c0=None, decisionThreshold=5,
+               rng=None, verbose=False, checkpoint=None, checkpointEvery=5, noiseKey=None, profiler=None,
+               difficultySet=None, gain=None, warmStart=False):
+# Simulates the nOfEpisodes episodes of one session, exactly as the session loop of the notebook.
+# params: the parameter vector or a ModelParameters record
+# TF1, TF2: transfer functions of RS and FS cells
+# V0: initial conditions of the state variables
+# nH: horizon number (0 or 1), the number of trials per episode is nH+1
+# learningSpeed, c0: learning speed k and decay rate c0 of the extrinsic noise (params c0 by default)
+# rng: random generator (np.random.Generator) of all the random draws of the session
+#      (difficulties, stimuli, extrinsic and intrinsic noises), a new one by default
+# noiseKey: optional (session, iteration) pair, the draws of the session are then taken from the
+#           counter-based streams of NoiseStreams instead of rng: those of each episode from
+#           EpisodeGenerator(session, iteration, episode) and the noise of each trial from
+#           TrialNoise(session, iteration, episode, trial), which replays that trial in isolation
+# checkpoint: optional file name (.npz) where the state of the session is saved every checkpointEvery
+#             episodes and at the end. If the file exists, the session is resumed from it (see ResumeSession).
+# profiler: optional Instrumentation.Profiler, in which the session and each of its trials are recorded
+# difficultySet, gain: difficulty set and reward gain of the task (DIFFICULTY_SET and GAIN by default)
+# warmStart: if True, the trials start from FixedPoints.WarmStart(TF1, TF2, params, V0), the pre-stimulus
+#            attractor reached from V0 (solved once per session and cached), instead of V0
+# Returns a dict with the performance, decisionTimeList, difficultyList and reward arrays.
+
+    params = MakeModelParameters(params) if c0 is None else MakeModelParameters(params, c0=c0)
+    c0 = params.c0
+    rng = np.random.default_rng() if rng is None else rng
+    if warmStart:
+        V0 = WarmStart(TF1, TF2, params, V0)
+
+    dSet = DIFFICULTY_SET if difficultySet is None else list(difficultySet)
+    gain = GAIN if gain is None else gain
+    if nH==0:
+        minStim = gain        # min. value of the stimuli (for Horizon 0)
+    elif nH==1:
+        minStim = 2 * gain    # min. value of the stimuli (for Horizon 1)
+    else:
+        raise ValueError("Invalid horizon number! Choose either 0 or 1.")
+    maxStim = minStim + 6
+    profile = StimulusProfile(params)
+
+    reward = np.zeros((nH+1, nOfEpisodes))
+    performance = np.zeros(nOfEpisodes)
+    decisionTimeList = np.zeros(nOfEpisodes * (nH+1))
+    difficultyList = np.zeros(nOfEpisodes * (nH+1))
+
+    # Set the initial reward for each horizon in the first episode
+    reward[:,0] = 0.5
+
+    # Continue from the checkpoint if there is one
+    config = [nH, nOfEpisodes, learningSpeed, c0, decisionThreshold]+([] if noiseKey is None else list(noiseKey))
+    fingerprint = SessionFingerprint(params, TF1, TF2, dSet, gain)
+    firstEpisode = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        state = LoadCheckpoint(checkpoint, config, fingerprint, (dSet, gain))
+        reward, performance = state['reward'], state['performance']
+        decisionTimeList, difficultyList = state['decisionTimeList'], state['difficultyList']
+        firstEpisode, rng = state['episode'], state['rng']
+
+    if profiler is not None:
+        profiler.startSession(learningSpeed=learningSpeed, c0=c0, horizon=nH)
+
+    for episodeNo in range(firstEpisode, nOfEpisodes):
+
+        if noiseKey is not None:
+            rng = EpisodeGenerator(noiseKey[0], noiseKey[1], episodeNo)
+
+        d = dSet[rng.integers(len(dSet))] # assign randomly the difficulty for the current episode
+        difficultyList[episodeNo] = d
+
+        # Verify that the stimuli and rewards are compatible (to avoid negative stimuli etc.)
+        lowest  = minStim + d/2 + (nH+1)*gain
+        highest = maxStim - d/2 - (nH+1)*gain
+        mean0Val = rng.uniform(lowest, highest)
+        while (mean0Val + d/2 + (nH+1)*gain > maxStim) or (mean0Val - d/2 - (nH+1)*gain < minStim):
+            if verbose:
+                print('Mean value is out of bounds! Regenerating the mean value...')
+            mean0Val = rng.uniform(lowest, highest)
+
+        saveDecision = np.zeros(nH+1) # which stimuli are chosen throughout the trials
+        pointer = 0
+        mean0ValInitial = mean0Val
+
+        for trial in range(0,nH+1):
+            shuffle = rng.integers(0,2) # to randomly shuffle the positions of two stimuli
+
+            ampA = mean0Val - d/2 # weak stimulus amplitude
+            ampB = mean0Val + d/2 # strong stimulus amplitude
+            if shuffle==1:
+                ampA, ampB = ampB, ampA
+
+            stimulusA = ampA*profile
+            stimulusB = ampB*profile
+
+            psi0 = reward[trial][episodeNo]
+            noise = rng if noiseKey is None else TrialNoise(noiseKey[0], noiseKey[1], episodeNo, trial)
+            if profiler is not None:
+                profiler.startTrial(episode=episodeNo, trial=trial)
+            lambdaA, lambdaB, psi = RegulatoryPsi(psi0, stimulusA, stimulusB, params, rng=noise, profiler=profiler)
+            summary, decisionTime, psiFinal = TimeSteppingToDecision(V0, lambdaA, lambdaB, TF1, TF2, params,
+                                                                     decisionThreshold, tWarmUp=2, psi=psi, rng=noise,
+                                                                     recorder=Recorder(summary=True), profiler=profiler)
+            if profiler is not None:
+                profiler.endTrial()
+
+            # Save the results and update the reward, the branches of the notebook being:
+            # the gain is won if psi(T)<0.5 in the first trial (>0.5 in the second trial of Horizon 1)
+            if decisionTime is not None:
+                decisionTimeList[episodeNo] = decisionTime
+                if episodeNo<nOfEpisodes-1:
+                    win = psiFinal<0.5 if trial==0 else psiFinal>0.5
+                    ampA, ampB = (ampA + gain, ampB + gain) if win else (ampA - gain, ampB - gain)
+                    if (trial==0) == win:
+                        saveDecision[trial] = min(ampA, ampB)
+                    else:
+                        saveDecision[trial] = max(ampA, ampB)
+                    if nH == 0:
+                        performance[episodeNo] = 1 if win else 0
+                    mean1Val = (ampA + ampB)/2 # mean after the gain
+                    reward[trial][episodeNo+1] = reward[trial][episodeNo] +\
+                        learningSpeed*(mean1Val - mean0Val)*(2*psiFinal-1)*(reward[trial][episodeNo]-1)**2\
+                        *(reward[trial][episodeNo])**2
+                    mean0Val = mean1Val # update mean value for the next trial
+                else:
+                    pointer = 1
+                    decisionTimeList[episodeNo] = -1
+
+        # Save the final performance of the episode
+        if pointer == 0:
+            if nH == 1:
+                mxBound = 2*mean0ValInitial + 3*gain
+                mnBound = 2*mean0ValInitial - 3*gain
+                performance[episodeNo] = (sum(saveDecision)-mnBound)/(mxBound - mnBound)
+                if performance[episodeNo]>0.99:
+                    performance[episodeNo]=1
+                elif performance[episodeNo]<0.01:
+                    performance[episodeNo]=0
+        elif episodeNo!=nOfEpisodes-1:
+            if verbose:
+                print("Episode %1.0i is not valid!" % episodeNo)
+            performance[episodeNo] = -1
+
+        if checkpoint is not None and ((episodeNo+1) % checkpointEvery == 0 or episodeNo == nOfEpisodes-1):
+            SaveCheckpoint(checkpoint, config, episodeNo+1, rng, reward, performance, decisionTimeList, difficultyList,
+                           fingerprint, dSet, gain)
+
+    return {'performance': performance, 'decisionTimeList': decisionTimeList,
+            'difficultyList': difficultyList, 'reward': reward}
+
+
+def SaveSessionResults(result, iteration, learningSpeed, c0, directory='.'):
+# Saves the results of one session with the file names of the notebook
+    name = "_Iter_%d_k_%d_c0_%d.npy" % (iteration, learningSpeed*1000, c0*1000)
+    np.save(os.path.join(directory, "performanceResults"+name), np.array(result['performance']))
+    np.save(os.path.join(directory, "decisionTimeList"+name), result['decisionTimeList'])
+    np.save(os.path.join(directory, "difficultyList"+name), result['difficultyList'])
+
+
+# ## Checkpoints
+
+# In[ ]:
+
+
+#export
+
+# A checkpoint holds the state of a session at the beginning of an episode: the reward matrix, the
+# partial result arrays, the index of the next episode and the state of the random generator, which
+# is the only state carried from one episode to the next. Resuming from it thus gives results
+# identical to the ones of an uninterrupted session. It is a small .npz file, written atomically.
+# Besides the configuration of the session (horizon, episodes, k, c0, threshold and noise key), it
+# records the fingerprint of everything else the session depends on: the model parameters (dt, tF,
+# vAI, sigma, ...), the difficulty set, the gain and the transfer functions (their fit included).
+# A checkpoint is only resumed by the session it belongs to.
+
+def SessionFingerprint(params, TF1, TF2, difficultySet=None, gain=None):
+    # Hash of the model parameters, the task and the transfer functions of a session
+    dSet = DIFFICULTY_SET if difficultySet is None else list(difficultySet)
+    gain = GAIN if gain is None else gain
+    data = np.array(tuple(MakeModelParameters(params)), dtype=float).tobytes()+np.array(dSet+[gain], dtype=float).tobytes()
+    data += (TransferFunctionFingerprint(TF1)+TransferFunctionFingerprint(TF2)).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def SaveCheckpoint(fileName, config, episode, rng, reward, performance, decisionTimeList, difficultyList,
+                   fingerprint='', difficultySet=DIFFICULTY_SET, gain=GAIN):
+    with open(fileName+'.tmp', 'wb') as f:
+        np.savez(f, config=np.array(config, dtype=float), fingerprint=fingerprint, episode=episode,
+                 difficultySet=np.array(difficultySet, dtype=float), gain=gain,
+                 rngState=json.dumps(rng.bit_generator.state, default=lambda a: a.tolist()), reward=reward, performance=performance,
+                 decisionTimeList=decisionTimeList, difficultyList=difficultyList)
+    os.replace(fileName+'.tmp', fileName)
+
+
+def LoadCheckpoint(fileName, config=None, fingerprint=None, task=None):
+# Returns the state saved in a checkpoint, as a dict, with the random generator 'rng' restored.
+# config: if given, [nH, nOfEpisodes, learningSpeed, c0, decisionThreshold] (followed by the noiseKey
+#         if any) of the session to be resumed, a ValueError is raised if the checkpoint belongs to another session
+# fingerprint: if given, the SessionFingerprint of the session to be resumed, a ValueError is raised if
+#              the checkpoint was saved with other parameters, task or transfer functions (or without fingerprint)
+# task: if given, the (difficultySet, gain) of the session to be resumed, checked as config
+# The returned 'difficultySet' (a list) and 'gain' are those of the session (DIFFICULTY_SET and GAIN for
+# the checkpoints which do not record them).
+    with np.load(fileName) as data:
+        state = {key: data[key] for key in data.files}
+    state['difficultySet'] = state['difficultySet'].tolist() if 'difficultySet' in state else list(DIFFICULTY_SET)
+    state['gain'] = float(state['gain']) if 'gain' in state else GAIN
+    if task is not None and (len(task[0]) != len(state['difficultySet']) or \
+                             not np.allclose(state['difficultySet'], np.array(task[0], dtype=float), rtol=0, atol=1e-12) or \
+                             abs(state['gain']-task[1]) > 1e-12):
+        raise ValueError("The checkpoint %s belongs to a session with the difficulty set %s and the gain %g"
+                         % (fileName, state['difficultySet'], state['gain']))
+    if config is not None and (len(config) != state['config'].size or \
+                               not np.allclose(state['config'], np.array(config, dtype=float), rtol=0, atol=1e-12)):
+        raise ValueError("The checkpoint %s belongs to another session %s" % (fileName, state['config'].tolist()))
+    state['fingerprint'] = str(state.get('fingerprint', ''))
+    if fingerprint is not None and state['fingerprint'] != fingerprint:
+        raise ValueError("The checkpoint %s was saved with other model parameters, task or transfer functions" % fileName)
+    rngState = json.loads(str(state.pop('rngState')))
+    rng = np.random.Generator(getattr(np.random, rngState['bit_generator'])())
+    rng.bit_generator.state = rngState
+    state['rng'] = rng
+    state['episode'] = int(state['episode'])
+    return state
+
+
+def ResumeSession(checkpoint, params, TF1, TF2, V0, verbose=False, checkpointEvery=5, profiler=None, warmStart=False):
+# Continues the session saved in checkpoint from its last completed episode, with its difficulty set
+# and gain (params, TF1, TF2, V0 and warmStart must be those of the session, see LoadCheckpoint)
+    state = LoadCheckpoint(checkpoint)
+    config = state['config'].tolist()
+    nH, nOfEpisodes, learningSpeed, c0, decisionThreshold = config[:5]
+    noiseKey = tuple(int(k) for k in config[5:]) or None
+    return RunSession(params, TF1, TF2, V0, int(nH), int(nOfEpisodes), learningSpeed, c0, decisionThreshold,
+                      verbose=verbose, checkpoint=checkpoint, checkpointEvery=checkpointEvery, noiseKey=noiseKey,
+                      profiler=profiler, difficultySet=state['difficultySet'], gain=state['gain'],
+                      warmStart=warmStart)
+
+
+# ## Parameter sweeps on a process pool
+
+# In[ ]:
+
+
+#export
+
+# Sessions of different (k, c0) values or iterations are independent, each one is a job run in a worker
+# process. Each job gets its own random stream, spawned from one SeedSequence in the order of the jobs,
+# so the results do not depend on the number of workers or on the order in which the jobs complete.
+
+_workerTF = {} # transfer functions of a worker process, loaded once per process
+
+def _InitWorker(cells):
+    _workerTF[cells] = LoadTransferFunctions(*cells)
+
+
+def _RunJob(job, seed, params, V0, nH, nOfEpisodes, decisionThreshold, cells, checkpointDirectory=None, noiseSession=None,
+            difficultySet=None, gain=None, warmStart=False):
+    if cells not in _workerTF:
+        _InitWorker(cells)
+    TF1, TF2 = _workerTF[cells]
+    learningSpeed, c0, iteration = job
+    checkpoint = None
+    if checkpointDirectory is not None:
+        # the fingerprint in the name keeps the checkpoints of sweeps with other parameters apart
+        fingerprint = SessionFingerprint(MakeModelParameters(params, c0=c0), TF1, TF2, difficultySet, gain)
+        checkpoint = os.path.join(checkpointDirectory, "session_H%d_Iter_%d_k_%r_c0_%r_%s.npz"
+                                  % (nH, iteration, learningSpeed, c0, fingerprint[:16]))
+    return RunSession(params, TF1, TF2, V0, nH, nOfEpisodes, learningSpeed, c0, decisionThreshold,
+                      rng=np.random.default_rng(seed), checkpoint=checkpoint,
+                      noiseKey=None if noiseSession is None else (noiseSession, iteration),
+                      difficultySet=difficultySet, gain=gain, warmStart=warmStart)
+
+
+def SweepJobs(learningSpeedList, c0List, nOfIterations):
+# Jobs (k, c0, iteration) of a sweep, k and c0 being a value or a list of values
+    return list(itertools.product(np.atleast_1d(learningSpeedList).tolist(),
+                                  np.atleast_1d(c0List).tolist(), range(nOfIterations)))
+
+
+def IterSweep(params, V0, nH, nOfEpisodes, learningSpeedList, c0List, nOfIterations, decisionThreshold=5,
+              nWorkers=None, seed=None, cells=('RS-cell', 'FS-cell', 'CONFIG1'), checkpointDirectory=None,
+              noiseSession=None, difficultySet=None, gain=None, warmStart=False):
+# Runs the sessions of all jobs of SweepJobs(learningSpeedList, c0List, nOfIterations) on nWorkers
+# processes (os.cpu_count() by default, nWorkers=0 runs them in this process) and yields the
+# (job, result) pairs as soon as each session is over, result being as returned by RunSession.
+# seed: seed of the SeedSequence from which the random streams of the jobs are spawned
+# cells: arguments of LoadTransferFunctions used in the workers
+# checkpointDirectory: if given, each session is checkpointed there (see RunSession), so that running
+#                      the same sweep again resumes the interrupted sessions and skips the completed ones
+# noiseSession: if given (an integer), the sessions draw from the counter-based streams keyed by
+#               (noiseSession, iteration, ...) instead of the streams spawned from seed (see RunSession):
+#               the sessions of a given iteration then see the same noise for all (k, c0) values
+# difficultySet, gain, warmStart: task and initial state of the sessions (see RunSession)
+
+    params = MakeModelParameters(params)
+    jobs = SweepJobs(learningSpeedList, c0List, nOfIterations)
+    seeds = np.random.SeedSequence(seed).spawn(len(jobs))
+    if checkpointDirectory is not None:
+        os.makedirs(checkpointDirectory, exist_ok=True)
+    arguments = (params, V0, nH, nOfEpisodes, decisionThreshold, tuple(cells), checkpointDirectory, noiseSession,
+                 difficultySet, gain, warmStart)
+
+    if nWorkers == 0:
+        for job, s in zip(jobs, seeds):
+            yield job, _RunJob(job, s, *arguments)
+        return
+
+    with ProcessPoolExecutor(max_workers=nWorkers, initializer=_InitWorker, initargs=(tuple(cells),)) as pool:
+        futures = {pool.submit(_RunJob, job, s, *arguments): job for job, s in zip(jobs, seeds)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def RunSweep(params, V0, nH, nOfEpisodes, learningSpeedList, c0List, nOfIterations, decisionThreshold=5,
+             nWorkers=None, seed=None, cells=('RS-cell', 'FS-cell', 'CONFIG1'), callback=None, saveDirectory=None,
+             store=None, checkpointDirectory=None, noiseSession=None, difficultySet=None, gain=None,
+             warmStart=False):
+# Runs a whole sweep with IterSweep and collects the results.
+# callback: optional function callback(job, result) called in this process as soon as a session is over
+# saveDirectory: if given, the results of each session are saved there as in the notebook when it is over
+# store: optional ResultsStore to which the results of each session are appended when it is over
+#        (unless the store already has them, e.g. when a checkpointed sweep is run again)
+# Returns a dict mapping each job (k, c0, iteration) to its result.
+
+    results = {}
+    stored = set(store.keys()) if store is not None else set()
+    for job, result in IterSweep(params, V0, nH, nOfEpisodes, learningSpeedList, c0List, nOfIterations,
+                                 decisionThreshold, nWorkers, seed, cells, checkpointDirectory, noiseSession,
+                                 difficultySet, gain, warmStart):
+        results[job] = result
+        if saveDirectory is not None:
+            SaveSessionResults(result, job[2], job[0], job[1], saveDirectory)
+        if store is not None and (job[0], job[1], nH, job[2]) not in stored:
+            store.appendSession(result, job[0], job[1], nH, job[2])
+        if callback is not None:
+            callback(job, result)
+    if store is not None:
+        store.flush()
+
+    return results
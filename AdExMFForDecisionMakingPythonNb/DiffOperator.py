@@ -9,9 +9,72 @@
 #export
 
 # Initialization
+from collections import namedtuple
 import numpy as np
 
 
+# ## Model parameters
+
+# In[ ]:
+
+
+#export
+
+# Names of the entries of the parameter vector "params" of MainNotebook.ipynb, in this order
+MODEL_PARAMETER_NAMES = ('aRS', 'bRS', 'aFS', 'bFS', 'tauwRS', 'tauwFS', 'Ntot', 'pc', 'Ne', 'Ni',
+                         'vAI', 'wce', 'wci', 'sigma', 'El', 'Qe', 'Qi', 'Te', 'Ti', 'Gl', 'Ee', 'Ei',
+                         'tF', 'dt', 'T', 'tauPsi', 'sigma_r', 'c0')
+
+# Names of the 18 state variables, V[k] being STATE_VARIABLE_NAMES[k] (see the glossary of TimeStepping)
+STATE_VARIABLE_NAMES = ('v_eA', 'v_iA', 'C_eAeA', 'C_eAiA', 'C_iAiA', 'W_eA', 'W_iA',
+                        'v_eB', 'v_iB', 'C_eBeB', 'C_eBiB', 'C_iBiB', 'W_eB', 'W_iB',
+                        'C_eAeB', 'C_eAiB', 'C_iAeB', 'C_iAiB')
+
+# Immutable parameter record. The first 28 fields keep the order of "params", so that
+# params[k] still works, and they are followed by quantities derived once from them:
+# wCe, wCi: total cross-coupling weights onto one pool, nSteps: number of time steps int(tF/dt)
+ModelParameters = namedtuple('ModelParameters', MODEL_PARAMETER_NAMES+('wCe', 'wCi', 'nSteps'))
+
+def MakeModelParameters(params, **changes):
+    # params : the parameter vector (list or array) or a ModelParameters record
+    # changes: entries to be replaced, e.g. MakeModelParameters(params, c0=1.2)
+    if isinstance(params, ModelParameters) and not changes:
+        return params
+    values = dict(zip(MODEL_PARAMETER_NAMES, [float(p) for p in list(params)[:len(MODEL_PARAMETER_NAMES)]]))
+    values.update(changes)
+    Ntot, pc = values['Ntot'], values['pc']
+    values['Ne'] = Ntot*pc/2                   # number of excitatory neurons in one pool 
+    values['Ni'] = Ntot*(1-pc)/2               # number of inhibitory neurons in one pool
+    values['wCe'] = values['wce']*pc*Ntot/2    # short notation for total coupling weight (/2 since one pool)
+    values['wCi'] = values['wci']*pc*Ntot/2    # short notation for total coupling weight (/2 since one pool)
+    values['nSteps'] = int(values['tF']/values['dt'])
+    return ModelParameters(**values)
+
+
+# The two parameter sets of the notebook (answers 0 and 1 to "Biophysical parameters without --> 0 or
+# with --> 1 SI units?"), Ne and Ni being derived from Ntot and pc by MakeModelParameters.
+
+NOTEBOOK_PARAMETERS = {
+    'non-SI': {'aRS': 4, 'bRS': 40, 'aFS': 0, 'bFS': 0, 'tauwRS': 5000, 'tauwFS': 1e9, 'Ntot': 20000, 'pc': 0.8,
+               'vAI': 5, 'wce': 2.5e-4, 'wci': 2.5e-4, 'sigma': 0.01, 'El': -65, 'Qe': 1.5, 'Qi': 5, 'Te': 5,
+               'Ti': 5, 'Gl': 10, 'Ee': 0, 'Ei': -80, 'tF': 15, 'dt': 0.05, 'T': 5, 'tauPsi': 5, 'sigma_r': 0.01,
+               'c0': 1.0},
+    'SI': {'aRS': 4e-9, 'bRS': 40e-12, 'aFS': 0, 'bFS': 0, 'tauwRS': 5, 'tauwFS': 1e6, 'Ntot': 20000, 'pc': 0.8,
+           'vAI': 5, 'wce': 2.5e-4, 'wci': 2.5e-4, 'sigma': 0.01, 'El': -65e-3, 'Qe': 1.5e-9, 'Qi': 5e-9,
+           'Te': 5e-3, 'Ti': 5e-3, 'Gl': 10e-9, 'Ee': 0, 'Ei': -80e-3, 'tF': 6, 'dt': 0.05, 'T': 5e-3,
+           'tauPsi': 5e-2, 'sigma_r': 0.01, 'c0': 45}}
+
+NOTEBOOK_V0 = [1., 30., 0.5, 0.5, 0.5, 1.e-10, 0., 1., 30., 0.5, 0.5, 0.5, 1.e-10, 0., 0.05, 0.05, 0.05, 0]
+
+
+def NotebookParameters(units='non-SI', **changes):
+    # ModelParameters record of the notebook parameter set ('non-SI' or 'SI') with the given changes
+    if units not in NOTEBOOK_PARAMETERS:
+        raise ValueError("Unknown units %s, choose 'non-SI' or 'SI'" % units)
+    values = dict(NOTEBOOK_PARAMETERS[units], Ne=0, Ni=0)
+    return MakeModelParameters([values[name] for name in MODEL_PARAMETER_NAMES], **changes)
+
+
 # ## Derivatives of transfer functions with respect to firing rates
 
 # In[5]:
@@ -19,25 +82,60 @@ import numpy as np
 
 #export
 
+# If the transfer function carries an analytic jet (TF.jet returning TF and its first and 
+# second derivatives, see theoretical_tools.TF_my_templateup_jet), the derivatives are taken
+# from it. Otherwise they are computed by central differences.
+
 def diff_fe(TF, fe, fi ,XX, df=1e-5):
+    if hasattr(TF, 'jet'):
+        return TF.jet(fe, fi, XX)[1]
     return (TF(fe+df/2., fi,XX)-TF(fe-df/2.,fi,XX))/df                    # deltaTF/deltafe
 
 def diff_fi(TF, fe, fi, XX, df=1e-5):
+    if hasattr(TF, 'jet'):
+        return TF.jet(fe, fi, XX)[2]
     return (TF(fe, fi+df/2.,XX)-TF(fe, fi-df/2.,XX))/df                   # delta2TF/deltafi2
 
 def diff2_fe_fe(TF, fe, fi, XX, df=1e-5):
+    if hasattr(TF, 'jet'):
+        return TF.jet(fe, fi, XX)[3]
     return (diff_fe(TF, fe+df/2., fi,XX)-diff_fe(TF,fe-df/2.,fi,XX))/df   # delta/deltafe(deltaTF/deltafe)
 
 def diff2_fi_fe(TF, fe, fi, XX, df=1e-5):
+    if hasattr(TF, 'jet'):
+        return TF.jet(fe, fi, XX)[4]
     return (diff_fi(TF, fe+df/2., fi,XX)-diff_fi(TF,fe-df/2.,fi,XX))/df   # delta/deltafi(deltaTF/deltafe)
 
 def diff2_fe_fi(TF, fe, fi, XX, df=1e-5):
+    if hasattr(TF, 'jet'):
+        return TF.jet(fe, fi, XX)[4]
     return (diff_fe(TF, fe, fi+df/2.,XX)-diff_fe(TF,fe, fi-df/2.,XX))/df  # delta/deltafe(deltaTF/deltafi)
 
 def diff2_fi_fi(TF, fe, fi, XX, df=1e-5):
+    if hasattr(TF, 'jet'):
+        return TF.jet(fe, fi, XX)[5]
     return (diff_fi(TF, fe, fi+df/2.,XX)-diff_fi(TF,fe, fi-df/2.,XX))/df  # delta/deltafi(deltaTF/deltafi)
 
 
+def TF_jet(TF, fe, fi, XX, df=1e-5):
+    # Value, first and second derivatives of TF at (fe, fi, XX), in the order
+    # (TF, dTF/dfe, dTF/dfi, d2TF/dfe2, d2TF/dfedfi, d2TF/dfi2), together with the number
+    # of TF evaluations it costed. Without an analytic jet, the finite differences use the
+    # same stencils as diff_fe, diff_fi and diff2_* above.
+    if hasattr(TF, 'jet'):
+        return TF.jet(fe, fi, XX), 1
+    h = df/2.
+    f00 = TF(fe, fi, XX)
+    fp0, fm0 = TF(fe+h, fi, XX), TF(fe-h, fi, XX)
+    f0p, f0m = TF(fe, fi+h, XX), TF(fe, fi-h, XX)
+    fpp0, fmm0 = TF(fe+df, fi, XX), TF(fe-df, fi, XX)
+    f0pp, f0mm = TF(fe, fi+df, XX), TF(fe, fi-df, XX)
+    fpp, fpm, fmp, fmm = TF(fe+h, fi+h, XX), TF(fe+h, fi-h, XX), TF(fe-h, fi+h, XX), TF(fe-h, fi-h, XX)
+    jet = (f00, (fp0-fm0)/df, (f0p-f0m)/df,
+           (fpp0-2.*f00+fmm0)/df**2, (fpp-fmp-fpm+fmm)/df**2, (f0pp-2.*f00+f0mm)/df**2)
+    return jet, 13
+
+
 # ## SDE system for time integration via Euler-Maruyama
 
 # In[6]:
@@ -47,49 +145,32 @@ def diff2_fi_fi(TF, fe, fi, XX, df=1e-5):
 
 # Building the SDE system
 
-def DifferentialOperator(V, TF1, TF2, params, exc_aff_A, exc_aff_B, inh_aff_A, inh_aff_B):
+def DifferentialOperator(V, TF1, TF2, params, exc_aff_A, exc_aff_B, inh_aff_A, inh_aff_B, counter=None, profiler=None):
        
     # exc_aff_A: stimulus related excitatory activity in eA
     # exc_aff_B: stimulus related excitatory activitiy in eB
     # inh_aff_A: stimulus related inhibitory activity in iA
     # inh_aff_B: stimulus related inhibitory activity in iB
+    # params   : ModelParameters record (a plain parameter vector is converted)
+    # counter  : optional dict, counter['TF'] is increased by the number of transfer function
+    #            evaluations made in this call and counter['steps'] by one
+    # profiler : optional Instrumentation.Profiler, which records the evaluations of TF1, TF2 and of
+    #            their derivatives and the time spent in each block below
     
     # Parameters -- Note: If parameters are changed, they should be 
     # changed also in transfer function parameter set!!! So better to keep them fixed, without any change!
-    aRS = params[0]
-    bRS = params[1]
-    aFS = params[2]
-    bFS = params[3]
-    tauwRS = params[4]
-    tauwFS = params[5]
-    Ntot = params[6]
-    pc = params[7]
-    Ne = params[8]
-    Ni = params[9]
-    vAI = params[10]
-    wce = params[11]
-    wci = params[12]
-    # sigma = params[13]
-    El = params[14]
-    Qe = params[15]
-    Qi = params[16]
-    Te = params[17]
-    Ti = params[18]
-    Gl = params[19]
-    Ee = params[20]
-    Ei = params[21]
-    # tF = params[22]
-    # dt = params[23]
-    T  = params[24]
-
+    if not isinstance(params, ModelParameters):
+        params = MakeModelParameters(params)
+    aRS, bRS, tauwRS = params.aRS, params.bRS, params.tauwRS
+    vAI, wce, wci = params.vAI, params.wce, params.wci
+    El, Qe, Qi, Te, Ti, Gl, Ee, Ei = params.El, params.Qe, params.Qi, params.Te, params.Ti, params.Gl, params.Ee, params.Ei
+    T  = params.T
     
     # General definitions
     vAI_A = vAI         # base drive to keep Pool A in AI state (given only to excitatory population eA)
     vAI_B = vAI         # base drive to keep Pool B in AI state (given only to excitatory population eB)
-    wCe = wce*pc*Ntot/2 # short notation for total coupling weight (/2 since one pool)
-    wCi = wci*pc*Ntot/2 # short notation for total coupling weight (/2 since one pool)
-    Ne = Ntot*pc/2      # number of excitatory neurons in one pool 
-    Ni = Ntot*(1-pc)/2  # number of inhibitory neurons in one pool
+    wCe, wCi = params.wCe, params.wCi # total coupling weights
+    Ne, Ni = params.Ne, params.Ni     # number of excitatory and inhibitory neurons in one pool
     
     # General definitions for Pool A
     v_cross_on_exc_inputA = (V[7]+exc_aff_B+vAI_B)*wCe # excitatory coupling from eB to eA 
@@ -112,155 +193,225 @@ def DifferentialOperator(V, TF1, TF2, params, exc_aff_A, exc_aff_B, inh_aff_A, i
     inhinputTF2_B = V[8] + inh_aff_B + v_cross_on_inh_inputB         # V[8]: in-column inhibitory coupling for FS-cells
 
     
+    # Phase 1: the transfer functions are only evaluated at a handful of points per call.
+    # Their jets (value, first and second derivatives, see TF_jet) are computed once here.
+    # Note that A16 and A17 read dTF2/dfi of pool A at the adaptation of the excitatory 
+    # population V[5], hence the extra point J2A_W.
+    
+    if profiler is not None:
+        t = profiler.now()
+    J1A, n1A = TF_jet(TF1, excinputTF1_A, inhinputTF1_A, V[5])
+    J1B, n1B = TF_jet(TF1, excinputTF1_B, inhinputTF1_B, V[12])
+    if profiler is not None:
+        t = profiler.lap('TF1', t)
+    J2A, n2A = TF_jet(TF2, excinputTF2_A, inhinputTF2_A, V[6])
+    J2B, n2B = TF_jet(TF2, excinputTF2_B, inhinputTF2_B, V[13])
+    J2A_W, n2A_W = TF_jet(TF2, excinputTF2_A, inhinputTF2_A, V[5])
+    
+    if counter is not None:
+        counter['TF'] = counter.get('TF', 0) + n1A + n2A + n1B + n2B + n2A_W
+        counter['steps'] = counter.get('steps', 0) + 1
+    if profiler is not None:
+        t = profiler.lap('TF2', t)
+        nTrials = np.size(V[0])
+        profiler.count('TF1Evaluations', (n1A+n1B)*nTrials)
+        profiler.count('TF2Evaluations', (n2A+n2B+n2A_W)*nTrials)
+        profiler.count('derivativeEvaluations', 5*5*nTrials) # 5 derivatives in each of the 5 jets
+        profiler.count('rhsCalls')
+    
+    # Phase 2: assemble the right-hand sides from the cached jets.
+    # A float32 state (reduced precision ensembles, see SDEIntegrator.TimeSteppingEnsemble) is assembled
+    # in float32, except the covariances: they are sums of products of the jets which nearly cancel 
+    # against -2*V[k] at equilibrium, so they are accumulated in float64 and only rounded to float32 when
+    # stored. This is why they are assembled after the rates and the adaptation.
+    
+    res = np.empty((18,)+np.shape(V[0]), dtype=np.result_type(V[0], J1A[0]))
+    
+    F1A, d1A_e, d1A_i, d1A_ee, d1A_ei, d1A_ii = J1A
+    F2A, d2A_e, d2A_i, d2A_ee, d2A_ei, d2A_ii = J2A
+    F1B, d1B_e, d1B_i, d1B_ee, d1B_ei, d1B_ii = J1B
+    F2B, d2B_e, d2B_i, d2B_ee, d2B_ei, d2B_ii = J2B
+    d2A_i_W = J2A_W[2]
+    
     # POOL A state variables
-
-    def A0(V):
-        
-        return 1/T*(            .5*V[2]*diff2_fe_fe(TF1, excinputTF1_A, inhinputTF1_A,V[5])+            .5*V[3]*diff2_fe_fi(TF1, excinputTF1_A, inhinputTF1_A,V[5])+            .5*V[3]*diff2_fi_fe(TF1, excinputTF1_A, inhinputTF1_A,V[5])+            .5*V[4]*diff2_fi_fi(TF1, excinputTF1_A, inhinputTF1_A,V[5])+            V[14]*(diff2_fe_fe(TF1, excinputTF1_A, inhinputTF1_A,V[5])*wCe+            diff2_fe_fi(TF1, excinputTF1_A, inhinputTF1_A,V[5])*wCi)+            V[16]*(diff2_fe_fi(TF1, excinputTF1_A, inhinputTF1_A,V[5])*wCe+            diff2_fi_fi(TF1, excinputTF1_A, inhinputTF1_A, V[5])*wCi)+             0.5*V[9]*(diff2_fe_fe(TF1, excinputTF1_A, inhinputTF1_A,V[5])*wCe**2+                       diff2_fi_fi(TF1, excinputTF1_A, inhinputTF1_A,V[5])*wCi**2+            2*diff2_fe_fi(TF1, excinputTF1_A, inhinputTF1_A,V[5])*wCi*wCe)+            TF1(excinputTF1_A, inhinputTF1_A,V[5])-V[0])
-
-
-
-    def A1(V):
-
-          return 1/T*(            .5*V[2]*diff2_fe_fe(TF2, excinputTF2_A,                              inhinputTF2_A,V[6])+            .5*V[3]*diff2_fe_fi(TF2, excinputTF2_A,                              inhinputTF2_A,V[6])+            .5*V[3]*diff2_fi_fe(TF2, excinputTF2_A,                              inhinputTF2_A,V[6])+            .5*V[4]*diff2_fi_fi(TF2, excinputTF2_A,                              inhinputTF2_A,V[6])+             V[14]*(diff2_fe_fe(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCe+                    diff2_fe_fi(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCi)+             V[16]*(diff2_fe_fi(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCe+                    diff2_fi_fi(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCi)+             .5*V[9]*(diff2_fe_fe(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCe**2+                      diff2_fi_fi(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCi**2+                      2*diff2_fe_fi(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCi*wCe)+             TF2(excinputTF2_A, inhinputTF2_A,V[6])-V[1])            
-        
-
-
-    def A2(V):
-
-        return 1/T*(             1./Ne*TF1(excinputTF1_A,inhinputTF1_A,V[5])*                 (1./T-TF1(excinputTF1_A,inhinputTF1_A,V[5]))+             (TF1(excinputTF1_A,inhinputTF1_A,V[5])-V[0])**2+             2.*V[2]*diff_fe(TF1,excinputTF1_A,inhinputTF1_A,V[5])+             2.*V[3]*diff_fi(TF1,excinputTF1_A,inhinputTF1_A,V[5])+             2.*V[14]*(diff_fe(TF1,excinputTF1_A,inhinputTF1_A,V[5])*wCe+             diff_fi(TF1,excinputTF1_A,inhinputTF1_A,V[5])*wCi)-2.*V[2])
-
-
-
-    def A3(V): # mu, nu = e,i, then lbd = e then i
-
-        return 1/T*(            (TF1(excinputTF1_A,inhinputTF1_A,V[5])-V[0])*             (TF2(excinputTF2_A,inhinputTF2_A,V[6])-V[1])+            V[2]*diff_fe(TF2, excinputTF2_A, inhinputTF2_A,V[6])+            V[3]*diff_fe(TF1, excinputTF1_A, inhinputTF1_A,V[5])+            V[3]*diff_fi(TF2, excinputTF2_A, inhinputTF2_A,V[6])+            V[4]*diff_fi(TF1, excinputTF1_A, inhinputTF1_A,V[5])+            V[16]*(diff_fe(TF1, excinputTF1_A, inhinputTF1_A,V[5])*wCe+            diff_fi(TF1, excinputTF1_A, inhinputTF1_A,V[5])*wCi)+            V[14]*(diff_fe(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCe+            diff_fi(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCi) +            -2.*V[3])
-
-  
     
-    def A4(V): 
-
-        return 1/T*(                 1./Ni*TF2(excinputTF2_A, inhinputTF2_A,V[6])*                     (1./T-TF2(excinputTF2_A, inhinputTF2_A,V[6]))+                 (TF2(excinputTF2_A, inhinputTF2_A,V[6])-V[1])**2+                 2.*V[3]*diff_fe(TF2, excinputTF2_A, inhinputTF2_A,V[6])+                 2.*V[4]*diff_fi(TF2, excinputTF2_A, inhinputTF2_A,V[6])+                 2.*V[16]*(diff_fe(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCe+                          diff_fi(TF2, excinputTF2_A, inhinputTF2_A,V[6])*wCi)
-                     -2.*V[4])
+    res[0] = 1/T*(.5*V[2]*d1A_ee+.5*V[3]*d1A_ei+.5*V[3]*d1A_ei+.5*V[4]*d1A_ii+\
+                  V[14]*(d1A_ee*wCe+d1A_ei*wCi)+\
+                  V[16]*(d1A_ei*wCe+d1A_ii*wCi)+\
+                  0.5*V[9]*(d1A_ee*wCe**2+d1A_ii*wCi**2+2*d1A_ei*wCi*wCe)+\
+                  F1A-V[0])
     
-
-    def A5(V):
-
-        fe_A = 2*wce*Ne*(V[0]+vAI_A+exc_aff_A) + wce*Ne*(V[7]+vAI_B+exc_aff_B)        
-        fi_A = 2*wci*Ni*V[1]+ wci*Ne*(V[7]+vAI_B+exc_aff_B)
-        muGe_A, muGi_A = Qe*Te*fe_A, Qi*Ti*fi_A
-        muG_A = Gl+muGe_A+muGi_A
-        muV_A = (muGe_A*Ee+muGi_A*Ei+Gl*El-V[5])/muG_A
-
-        return (-V[5]/tauwRS+(bRS)*V[0]+aRS*(muV_A-El)/tauwRS)
-
-
-    def A6(V):
-        return  (-V[6]/1.0+0.*V[1]) # inhibitory cells do not have any adaptation, therefore 0!
-
-
+    res[1] = 1/T*(.5*V[2]*d2A_ee+.5*V[3]*d2A_ei+.5*V[3]*d2A_ei+.5*V[4]*d2A_ii+\
+                  V[14]*(d2A_ee*wCe+d2A_ei*wCi)+\
+                  V[16]*(d2A_ei*wCe+d2A_ii*wCi)+\
+                  .5*V[9]*(d2A_ee*wCe**2+d2A_ii*wCi**2+2*d2A_ei*wCi*wCe)+\
+                  F2A-V[1])
+    if profiler is not None:
+        t = profiler.lap('poolA', t)
+    
+    fe_A = 2*wce*Ne*(V[0]+vAI_A+exc_aff_A) + wce*Ne*(V[7]+vAI_B+exc_aff_B)        
+    fi_A = 2*wci*Ni*V[1]+ wci*Ne*(V[7]+vAI_B+exc_aff_B)
+    muGe_A, muGi_A = Qe*Te*fe_A, Qi*Ti*fi_A
+    muG_A = Gl+muGe_A+muGi_A
+    muV_A = (muGe_A*Ee+muGi_A*Ei+Gl*El-V[5])/muG_A
+    
+    res[5] = -V[5]/tauwRS+(bRS)*V[0]+aRS*(muV_A-El)/tauwRS
+    
+    res[6] = -V[6]/1.0+0.*V[1] # inhibitory cells do not have any adaptation, therefore 0!
+    if profiler is not None:
+        t = profiler.lap('adaptation', t)
     
     # POOL B state variables    
-      
-
-
-    def A7(V):
-
-        return 1/T*(            .5*V[9]*diff2_fe_fe(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])+            .5*V[10]*diff2_fe_fi(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])+            .5*V[10]*diff2_fi_fe(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])+            .5*V[11]*diff2_fi_fi(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])+            .5*V[2]*(diff2_fe_fe(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])*wCe**2+                      diff2_fi_fi(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])*wCi**2+                      2*diff2_fe_fi(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])*wCe*wCi)+            V[14]*(diff2_fe_fe(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])*wCe+                       diff2_fe_fi(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])*wCi)+            V[15]*(diff2_fe_fi(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])*wCe+                       diff2_fi_fi(TF1, excinputTF1_B,                              inhinputTF1_B,V[12])*wCi)+            TF1(excinputTF1_B, inhinputTF1_B,V[12])-V[7])
     
-
-
-    def A8(V):     
-
-        return 1/T*(                  .5*V[9]*diff2_fe_fe(TF2, excinputTF2_B,                                      inhinputTF2_B,V[13])+                  .5*V[10]*diff2_fe_fi(TF2, excinputTF2_B,                                       inhinputTF2_B,V[13])+                  .5*V[10]*diff2_fi_fe(TF2, excinputTF2_B,                                       inhinputTF2_B,V[13])+                  .5*V[11]*diff2_fi_fi(TF2, excinputTF2_B,                                       inhinputTF2_B,V[13])+                     .5*V[2]*(diff2_fe_fe(TF2, excinputTF2_B,                                          inhinputTF2_B,V[13])*wCe**2+                              diff2_fi_fi(TF2, excinputTF2_B,                                       inhinputTF2_B,V[13])*wCi**2+                              2*diff2_fe_fi(TF2, excinputTF2_B,                                       inhinputTF2_B,V[13])*wCe*wCi)+                   V[14]*(diff2_fe_fe(TF2, excinputTF2_B,                                       inhinputTF2_B,V[13])*wCe+                              diff2_fe_fi(TF2, excinputTF2_B,                                       inhinputTF2_B,V[13])*wCi)+                   V[15]*(diff2_fe_fi(TF2, excinputTF2_B,                                       inhinputTF2_B,V[13])*wCe+                              diff2_fi_fi(TF2, excinputTF2_B,                                       inhinputTF2_B,V[13])*wCi)+                   TF2(excinputTF2_B, inhinputTF2_B,V[13])-V[8])                    
-
-
-
-    def A9(V):
-
-        return 1/T*(                 1./Ne*TF1(excinputTF1_B, inhinputTF1_B,V[12])*                     (1./T-TF1(excinputTF1_B, inhinputTF1_B,V[12]))+                 (TF1(excinputTF1_B, inhinputTF1_B,V[12])-V[7])**2+                 2.*V[9]*diff_fe(TF1, excinputTF1_B,                                 inhinputTF1_B,V[12])+                 2.*V[10]*diff_fi(TF1, excinputTF1_B,                                  inhinputTF1_B,V[12])+                     2.*V[14]*(diff_fe(TF1, excinputTF1_B,                                  inhinputTF1_B,V[12])*wCe+                           diff_fi(TF1, excinputTF1_B,                                  inhinputTF1_B,V[12])*wCi)-2.*V[9])              
-
-
-
-    def A10(V): # mu, nu = e,i, then lbd = e then i
-
-        return 1/T*(                  (TF1(excinputTF1_B, inhinputTF1_B,V[12])-V[7])*                     (TF2(excinputTF2_B,                          inhinputTF2_B,V[13])-V[8])+                  V[9]*diff_fe(TF2, excinputTF2_B,                               inhinputTF2_B,V[13])+                  V[10]*diff_fe(TF1, excinputTF1_B,                                inhinputTF1_B,V[12])+                  V[10]*diff_fi(TF2, excinputTF2_B,                                inhinputTF2_B,V[13])+                  V[11]*diff_fi(TF1, excinputTF1_B, inhinputTF1_B,V[12])+
-                  V[15]*(diff_fe(TF1, excinputTF1_B, inhinputTF1_B,V[12])*wCe+\
-                         diff_fi(TF1, excinputTF1_B, inhinputTF1_B,V[12])*wCi)+\
-
-                  V[14]*(diff_fe(TF2, excinputTF2_B, inhinputTF2_B,V[13])*wCe+\
-                         diff_fi(TF2, excinputTF2_B, inhinputTF2_B,V[13])*wCi)+\
-                     -2.*V[10])
-
-
-
-    def A11(V):
-
-        return 1/T*(                 1./Ni*TF2(excinputTF2_B,                           inhinputTF2_B,V[13])*(1./T-                   TF2(excinputTF2_B, inhinputTF2_B,V[13]))+                 (TF2(excinputTF2_B,                      inhinputTF2_B,V[13])-V[8])**2+                 2.*V[10]*diff_fe(TF2, excinputTF2_B,                                  inhinputTF2_B,V[13])+                 2.*V[11]*diff_fi(TF2, excinputTF2_B,                                  inhinputTF2_B,V[13])+                     2.*V[15]*(diff_fe(TF2, excinputTF2_B,                                  inhinputTF2_B,V[13])*wCe+                               diff_fi(TF2, excinputTF2_B,                                  inhinputTF2_B,V[13])*wCi)-2.*V[11])                     
-
-
+    res[7] = 1/T*(.5*V[9]*d1B_ee+.5*V[10]*d1B_ei+.5*V[10]*d1B_ei+.5*V[11]*d1B_ii+\
+                  .5*V[2]*(d1B_ee*wCe**2+d1B_ii*wCi**2+2*d1B_ei*wCe*wCi)+\
+                  V[14]*(d1B_ee*wCe+d1B_ei*wCi)+\
+                  V[15]*(d1B_ei*wCe+d1B_ii*wCi)+\
+                  F1B-V[7])
     
-    def A12(V):
-       
-        fe_B = 2*wce*Ne*(V[7]+vAI_B+exc_aff_B) + wce*Ne*(V[0]+vAI_A+exc_aff_A)
-        fi_B = 2*wci*Ni*V[8]+ wci*Ne*(V[0]+vAI_A+exc_aff_A)
-        
-        muGe_B, muGi_B = Qe*Te*fe_B, Qi*Ti*fi_B
-        muG_B = Gl+muGe_B+muGi_B
-        muV_B = (muGe_B*Ee+muGi_B*Ei+Gl*El-V[12])/muG_B
-
-        return (-V[12]/tauwRS+(bRS)*V[7]+aRS*(muV_B-El)/tauwRS)
-
-
-
-    def A13(V):
-        return  (-V[13]/1.0+0.*V[8])  # inhibitory population does not have any adaptation, therefore 0!
-
+    res[8] = 1/T*(.5*V[9]*d2B_ee+.5*V[10]*d2B_ei+.5*V[10]*d2B_ei+.5*V[11]*d2B_ii+\
+                  .5*V[2]*(d2B_ee*wCe**2+d2B_ii*wCi**2+2*d2B_ei*wCe*wCi)+\
+                  V[14]*(d2B_ee*wCe+d2B_ei*wCi)+\
+                  V[15]*(d2B_ei*wCe+d2B_ii*wCi)+\
+                  F2B-V[8])
+    if profiler is not None:
+        t = profiler.lap('poolB', t)
     
-    # Cross-pool state variables (cross-pool covariance terms)  
+    fe_B = 2*wce*Ne*(V[7]+vAI_B+exc_aff_B) + wce*Ne*(V[0]+vAI_A+exc_aff_A)
+    fi_B = 2*wci*Ni*V[8]+ wci*Ne*(V[0]+vAI_A+exc_aff_A)
+    muGe_B, muGi_B = Qe*Te*fe_B, Qi*Ti*fi_B
+    muG_B = Gl+muGe_B+muGi_B
+    muV_B = (muGe_B*Ee+muGi_B*Ei+Gl*El-V[12])/muG_B
     
+    res[12] = -V[12]/tauwRS+(bRS)*V[7]+aRS*(muV_B-El)/tauwRS
     
-    def A14(V):
-
-
-        return 1/T*(                  (TF1(excinputTF1_A, inhinputTF1_A,V[5])-V[0])*                     (TF1(excinputTF1_B,                          inhinputTF1_B,V[12])-V[7])+                  V[14]*diff_fe(TF1, excinputTF1_A,                               inhinputTF1_A,V[5])+                  V[16]*diff_fi(TF1, excinputTF1_A,                                inhinputTF1_A, V[5])+                     V[9]*(diff_fe(TF1, excinputTF1_A,                                inhinputTF1_A, V[5])*wCe+                       diff_fi(TF1, excinputTF1_A,                                inhinputTF1_A, V[5])*wCi)+                     V[2]*(diff_fe(TF1, excinputTF1_B,                                inhinputTF1_B, V[12])*wCe+                       diff_fi(TF1, excinputTF1_B,                                inhinputTF1_B, V[12])*wCi)+                     V[14]*diff_fe(TF1, excinputTF1_B,                                inhinputTF1_B, V[12])+                  V[15]*diff_fi(TF1, excinputTF1_B,                                inhinputTF1_B, V[12])+-2.*V[14])             
-
-
-
-    def A15(V):
-
-        return 1/T*(                  (TF1(excinputTF1_A, inhinputTF1_A,V[5])-V[0])*                     (TF2(excinputTF2_B,                          inhinputTF2_B,V[13])-V[8])+                  V[15]*diff_fe(TF1, excinputTF1_A,                               inhinputTF1_A,V[5])+                  V[17]*diff_fi(TF1, excinputTF1_A,                                inhinputTF1_A, V[5])+                     V[10]*(diff_fe(TF1, excinputTF1_A,                                inhinputTF1_A, V[5])*wCe+                       diff_fi(TF1, excinputTF1_A,                                inhinputTF1_A, V[5])*wCi)+                     V[2]*(diff_fe(TF2, excinputTF2_B,                                inhinputTF2_B, V[13])*wCe+                       diff_fi(TF2, excinputTF2_B,                                inhinputTF2_B, V[13])*wCi)+                     V[14]*diff_fe(TF2, excinputTF2_B,                                inhinputTF2_B, V[13])+                  V[15]*diff_fi(TF2, excinputTF2_B,                                inhinputTF2_B, V[13])-2.*V[15])                     
-
-
-
-
-
-    def A16(V):
-
-        return 1/T*(                  (TF2(excinputTF2_A, inhinputTF2_A,V[6])-V[1])*                     (TF1(excinputTF1_B,                          inhinputTF1_B,V[12])-V[7])+                  V[14]*diff_fe(TF2, excinputTF2_A,                               inhinputTF2_A,V[6])+                  V[16]*diff_fi(TF2, excinputTF2_A,                                inhinputTF2_A, V[6])+                     V[9]*(diff_fe(TF2, excinputTF2_A,                                inhinputTF2_A, V[6])*wCe+                       diff_fi(TF2, excinputTF2_A,                                inhinputTF2_A, V[5])*wCi)+                     V[3]*(diff_fe(TF1, excinputTF1_B,                                inhinputTF1_B, V[12])*wCe+                       diff_fi(TF2, excinputTF2_B,                                inhinputTF1_B, V[13])*wCi)+                     V[16]*diff_fe(TF1, excinputTF1_B,                                inhinputTF1_B, V[12])+                  V[17]*diff_fi(TF2, excinputTF2_B,                                inhinputTF2_B, V[13])+                     -2.*V[16])                     
-
-
-
-
-
-
-    def A17(V):
-
-        return 1/T*(                  (TF2(excinputTF2_A, inhinputTF2_A,V[6])-V[1])*                     (TF2(excinputTF2_B,                          inhinputTF2_B,V[13])-V[8])+                  V[15]*diff_fe(TF2, excinputTF2_A,                               inhinputTF2_A,V[6])+                  V[17]*diff_fi(TF2, excinputTF2_A,                                inhinputTF2_A, V[6])+                     V[10]*(diff_fe(TF2, excinputTF2_A,                                inhinputTF2_A, V[6])*wCe+                       diff_fi(TF2, excinputTF2_A,                                inhinputTF2_A, V[5])*wCi)+                     V[3]*(diff_fe(TF2, excinputTF2_B,                                inhinputTF2_B, V[13])*wCe+                       diff_fi(TF2, excinputTF2_B,                                inhinputTF2_B, V[13])*wCi)+                     V[16]*diff_fe(TF2, excinputTF2_B,                                inhinputTF2_B, V[13])+                  V[17]*diff_fi(TF2, excinputTF2_B,                                inhinputTF2_B, V[13])-2.*V[17])                     
-
-    # Return the SDE system state variables as a vector 
+    res[13] = -V[13]/1.0+0.*V[8] # inhibitory population does not have any adaptation, therefore 0!
+    if profiler is not None:
+        t = profiler.lap('adaptation', t)
     
-    res = np.array([A0(V), A1(V), A2(V), A3(V), A4(V), A5(V), A6(V), A7(V), A8(V), A9(V),                         A10(V), A11(V), A12(V), A13(V), A14(V), A15(V), A16(V), A17(V)])
+    if res.dtype == np.float32:
+        V = np.asarray(V, dtype=np.float64)
+        F1A, d1A_e, d1A_i = np.asarray(J1A[:3], dtype=np.float64)
+        F2A, d2A_e, d2A_i = np.asarray(J2A[:3], dtype=np.float64)
+        F1B, d1B_e, d1B_i = np.asarray(J1B[:3], dtype=np.float64)
+        F2B, d2B_e, d2B_i = np.asarray(J2B[:3], dtype=np.float64)
+        d2A_i_W = np.asarray(J2A_W[2], dtype=np.float64)
     
+    # POOL A covariances
     
+    res[2] = 1/T*(1./Ne*F1A*(1./T-F1A)+\
+                  (F1A-V[0])**2+\
+                  2.*V[2]*d1A_e+\
+                  2.*V[3]*d1A_i+\
+                  2.*V[14]*(d1A_e*wCe+d1A_i*wCi)-2.*V[2])
     
+    res[3] = 1/T*((F1A-V[0])*(F2A-V[1])+\
+                  V[2]*d2A_e+V[3]*d1A_e+V[3]*d2A_i+V[4]*d1A_i+\
+                  V[16]*(d1A_e*wCe+d1A_i*wCi)+\
+                  V[14]*(d2A_e*wCe+d2A_i*wCi)-2.*V[3])
     
-    '''def Diff_OP(V, exc_aff=0, exc_aff_B=0, inh_aff=0, pure_exc_aff=0, pure_exc_aff_B=0, inh_fract=0):
-                return     res = np.array([A0(V), A1(V), A2(V), A3(V), A4(V), A5(V), A6(V), A7(V), A8(V), A9(V),\
-                         A10(V), A11(V), A12(V), A13(V), A14(V), A15(V), A16(V), A17(V)])
-
-            return Diff_OP'''
+    res[4] = 1/T*(1./Ni*F2A*(1./T-F2A)+\
+                  (F2A-V[1])**2+\
+                  2.*V[3]*d2A_e+\
+                  2.*V[4]*d2A_i+\
+                  2.*V[16]*(d2A_e*wCe+d2A_i*wCi)-2.*V[4])
+    if profiler is not None:
+        t = profiler.lap('poolA', t)
+    
+    # POOL B covariances
+    
+    res[9] = 1/T*(1./Ne*F1B*(1./T-F1B)+\
+                  (F1B-V[7])**2+\
+                  2.*V[9]*d1B_e+\
+                  2.*V[10]*d1B_i+\
+                  2.*V[14]*(d1B_e*wCe+d1B_i*wCi)-2.*V[9])
     
+    res[10] = 1/T*((F1B-V[7])*(F2B-V[8])+\
+                   V[9]*d2B_e+V[10]*d1B_e+V[10]*d2B_i+V[11]*d1B_i+\
+                   V[15]*(d1B_e*wCe+d1B_i*wCi)+\
+                   V[14]*(d2B_e*wCe+d2B_i*wCi)-2.*V[10])
+    
+    res[11] = 1/T*(1./Ni*F2B*(1./T-F2B)+\
+                   (F2B-V[8])**2+\
+                   2.*V[10]*d2B_e+\
+                   2.*V[11]*d2B_i+\
+                   2.*V[15]*(d2B_e*wCe+d2B_i*wCi)-2.*V[11])
+    if profiler is not None:
+        t = profiler.lap('poolB', t)
+    
+    # Cross-pool state variables (cross-pool covariance terms)  
+    
+    res[14] = 1/T*((F1A-V[0])*(F1B-V[7])+\
+                   V[14]*d1A_e+V[16]*d1A_i+\
+                   V[9]*(d1A_e*wCe+d1A_i*wCi)+\
+                   V[2]*(d1B_e*wCe+d1B_i*wCi)+\
+                   V[14]*d1B_e+V[15]*d1B_i-2.*V[14])
+    
+    res[15] = 1/T*((F1A-V[0])*(F2B-V[8])+\
+                   V[15]*d1A_e+V[17]*d1A_i+\
+                   V[10]*(d1A_e*wCe+d1A_i*wCi)+\
+                   V[2]*(d2B_e*wCe+d2B_i*wCi)+\
+                   V[14]*d2B_e+V[15]*d2B_i-2.*V[15])
+    
+    res[16] = 1/T*((F2A-V[1])*(F1B-V[7])+\
+                   V[14]*d2A_e+V[16]*d2A_i+\
+                   V[9]*(d2A_e*wCe+d2A_i_W*wCi)+\
+                   V[3]*(d1B_e*wCe+d2B_i*wCi)+\
+                   V[16]*d1B_e+V[17]*d2B_i-2.*V[16])
+    
+    res[17] = 1/T*((F2A-V[1])*(F2B-V[8])+\
+                   V[15]*d2A_e+V[17]*d2A_i+\
+                   V[10]*(d2A_e*wCe+d2A_i_W*wCi)+\
+                   V[3]*(d2B_e*wCe+d2B_i*wCi)+\
+                   V[16]*d2B_e+V[17]*d2B_i-2.*V[17])
+    if profiler is not None:
+        profiler.lap('crossCovariances', t)
                          
     return res
 
+
+# ## Jacobian and linear decay terms
+
+# In[ ]:
+
+
+#export
+
+# The Jacobian of the right-hand side is assembled by central differences. DifferentialOperator
+# accepts a batch of states V of shape (18, n), so the 36 perturbed states are evaluated in a single
+# call. (An analytic Jacobian would need the third derivatives of the transfer functions, since the
+# equations of the rates contain their second derivatives.)
+
+def NumericalJacobian(Rhs, x, eps=1e-6, floor=1e-2):
+    # Central difference Jacobian of Rhs (a function of a batch of states) at x (n,), the step of each
+    # variable being eps times its size, or eps*floor for the small ones: the adaptation variables start
+    # at 1e-10 and the transfer functions are very sensitive to them, so an absolute step of eps would
+    # be far too large for them
+    n = x.size
+    h = eps*np.maximum(floor, np.abs(x))
+    columns = np.concatenate([x[:,None]+np.diag(h), x[:,None]-np.diag(h)], axis=1)
+    f = Rhs(columns)
+    return (f[:,:n]-f[:,n:])/(2*h)
+
+
+def Jacobian(V, TF1, TF2, params, exc_aff_A, exc_aff_B, inh_aff_A, inh_aff_B, eps=1e-6, floor=1e-2):
+    # Jacobian (18, 18) of DifferentialOperator with respect to V (18,), J[k, l] = d res[k]/d V[l]
+    params = MakeModelParameters(params)
+    def Rhs(V):
+        return DifferentialOperator(V, TF1, TF2, params, exc_aff_A, exc_aff_B, inh_aff_A, inh_aff_B)
+    return NumericalJacobian(Rhs, np.asarray(V, dtype=float), eps, floor)
+
+
+# Linear decay terms of the right-hand side, res[k] = LinearDecayRates(params)[k]*V[k] + (the rest):
+# -2/T for the covariances, -1/tauwRS for the adaptation of the excitatory populations, -1 for the
+# (absent) adaptation of the inhibitory ones, and 0 for the rates (their decay is left with the TF).
+COVARIANCE_VARIABLES = (2, 3, 4, 9, 10, 11, 14, 15, 16, 17)
+ADAPTATION_VARIABLES = (5, 6, 12, 13) # W_eA, W_iA, W_eB, W_iB
+
+def LinearDecayRates(params):
+    params = MakeModelParameters(params)
+    rates = np.zeros(18)
+    rates[list(COVARIANCE_VARIABLES)] = -2./params.T
+    rates[[5, 12]] = -1./params.tauwRS
+    rates[[6, 13]] = -1.
+    return rates
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Fixed points of the noise-free system
+
+# In[ ]:
+
+
+#export
+
+# Initialization
+import numpy as np
+from DiffOperator import DifferentialOperator, MakeModelParameters, NumericalJacobian, NOTEBOOK_V0, ADAPTATION_VARIABLES
+from NeuronConnectivity import TransferFunctionFingerprint
+
+
+# ## Right-hand side and Jacobian
+
+# In[ ]:
+
+
+#export
+
+# The noise-free system is dV/dt = DifferentialOperator(V, ...) with constant stimuli, the stimulus
+# of a pool being given to both of its populations as in TimeStepping. Its Jacobian is assembled by
+# DiffOperator.NumericalJacobian.
+
+def SteadyRhs(TF1, TF2, params, stimulusA=0., stimulusB=None):
+    # Right-hand side V -> dV/dt of the noise-free system for the constant stimuli (stimulusB=stimulusA by default)
+    params = MakeModelParameters(params)
+    stimulusB = stimulusA if stimulusB is None else stimulusB
+    def Rhs(V):
+        return DifferentialOperator(V, TF1, TF2, params, stimulusA, stimulusB, stimulusA, stimulusB)
+    return Rhs
+
+
+# ## Fixed point solver
+
+# In[ ]:
+
+
+#export
+
+# The fixed point is found by pseudo-transient continuation: each iteration is an implicit Euler step
+# of pseudo-time tau, x <- x + (I/tau - J)^-1 f(x), tau being doubled after each accepted step and
+# divided by 4 after a rejected one (residual increased more than twice, or not finite). For a small
+# tau this follows the dynamics from V0, hence it goes to the attractor reached from V0 and not to an
+# unstable fixed point, and for a large tau it is Newton's method, which converges quadratically.
+# adaptation='frozen' keeps W_eA, W_iA, W_eB, W_iB at their values in V0 and only solves for the
+# fast variables (firing rates and covariances), giving the quasi-steady state of a given adaptation.
+# The stability is given by the eigenvalues of the Jacobian (of the fast variables only when frozen).
+
+def FindFixedPoint(TF1, TF2, params, stimulusA=0., stimulusB=None, V0=None, adaptation='steady',
+                   tol=1e-10, maxIter=500, tau=None):
+    # V0: starting state, (18,), the initial conditions of the notebook by default
+    # tol: convergence criterion, max_k |f_k(x)|/(1+|x_k|) < tol
+    # tau: initial pseudo-time step, dt by default
+    # Returns a dict with the fixed point 'V', the 'eigenvalues' of its Jacobian, 'stable' (all their
+    # real parts negative), 'converged', the number of 'iterations' and the final scaled 'residual'.
+    if adaptation not in ('steady', 'frozen'):
+        raise ValueError("adaptation must be 'steady' or 'frozen'")
+    params = MakeModelParameters(params)
+    Rhs = SteadyRhs(TF1, TF2, params, stimulusA, stimulusB)
+    x = np.array(NOTEBOOK_V0 if V0 is None else V0, dtype=float)
+    free = np.ones(x.size, dtype=bool)
+    if adaptation == 'frozen':
+        free[list(ADAPTATION_VARIABLES)] = False
+    tau = params.dt if tau is None else tau
+
+    def Residual(x):
+        return np.where(free, Rhs(x), 0.)
+
+    f = Residual(x)
+    r = np.linalg.norm(f)
+    converged = False
+    for iteration in range(maxIter):
+        residual = np.max(np.abs(f)/(1+np.abs(x)))
+        if residual < tol:
+            converged = True
+            break
+        J = NumericalJacobian(Rhs, x)[np.ix_(free, free)]
+        step = np.zeros_like(x)
+        step[free] = np.linalg.solve(np.eye(free.sum())/tau-J, f[free])
+        fNew = Residual(x+step)
+        rNew = np.linalg.norm(fNew)
+        if not np.isfinite(rNew) or rNew > 2*r:
+            tau /= 4
+            continue
+        x, f, r = x+step, fNew, rNew
+        tau *= 2
+    else:
+        residual = np.max(np.abs(f)/(1+np.abs(x)))
+
+    eigenvalues = np.linalg.eigvals(NumericalJacobian(Rhs, x)[np.ix_(free, free)])
+    return {'V': x, 'eigenvalues': eigenvalues, 'stable': bool(np.all(eigenvalues.real < 0)),
+            'converged': converged, 'iterations': iteration, 'residual': residual}
+
+
+# ## Cache and warm start
+
+# In[ ]:
+
+
+#export
+
+# The fixed points are cached per transfer functions, parameter set (vAI, adaptation parameters, ...),
+# stimuli, starting state and adaptation mode, so that all the trials of a session or of a sweep
+# sharing them solve only once. The transfer functions are identified by their fingerprint (fit,
+# configuration and kind: analytic, heterogeneous or tabulated), not by their name.
+
+_fixedPointCache = {}
+
+def FixedPoint(TF1, TF2, params, stimulusA=0., stimulusB=None, V0=None, adaptation='steady'):
+    # Cached FindFixedPoint (the returned dict must not be modified)
+    params = MakeModelParameters(params)
+    key = (TransferFunctionFingerprint(TF1), TransferFunctionFingerprint(TF2), tuple(params), float(stimulusA),
+           None if stimulusB is None else float(stimulusB), None if V0 is None else tuple(np.ravel(V0)), adaptation)
+    if key not in _fixedPointCache:
+        _fixedPointCache[key] = FindFixedPoint(TF1, TF2, params, stimulusA, stimulusB, V0, adaptation)
+    return _fixedPointCache[key]
+
+
+def ClearFixedPointCache():
+    _fixedPointCache.clear()
+
+
+def WarmStart(TF1, TF2, params, V0=None, adaptation='steady'):
+    # Initial state on the attractor of the pre-stimulus (zero stimulus) system reached from V0: the
+    # stable fixed point if one is found, V0 itself otherwise. Starting a trial there, the warm-up
+    # window (tWarmUp of TimeSteppingToDecision) needs not cover the relaxation from V0.
+    fixedPoint = FixedPoint(TF1, TF2, params, 0., None, V0, adaptation)
+    if fixedPoint['converged'] and fixedPoint['stable']:
+        return fixedPoint['V'].copy()
+    return np.array(NOTEBOOK_V0 if V0 is None else V0, dtype=float)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Instrumentation
+
+# In[ ]:
+
+
+#export
+
+# Initialization
+import json
+import time
+import numpy as np
+
+
+# ## Profiler
+
+# In[ ]:
+
+
+#export
+
+# A Profiler is given (profiler=...) to DifferentialOperator, RegulatoryPsi, the integrators of
+# SDEIntegrator or DecisionSession.RunSession, which then record into it, step by step:
+#   counts: TF1 and TF2 evaluations, derivative evaluations (five per jet), right-hand side calls,
+#           integration steps, intrinsic and extrinsic noise draws
+#   times : seconds spent in each block of the right-hand side (TF1 and TF2 jets, pool A, pool B,
+#           adaptation, cross-covariances), in the noise generation and in RegulatoryPsi
+# The evaluations and draws are counted per trial of an ensemble (a vectorized call counts once
+# per trial). The records are kept per trial, and the trials per session: RunSession opens a
+# session and a trial for each of its trials, the integrators open a trial when none is open.
+# Without profiler (the default) the engine only tests "profiler is not None" at each block.
+
+TIMED_BLOCKS = ('TF1', 'TF2', 'poolA', 'poolB', 'adaptation', 'crossCovariances', 'noise', 'regulatoryPsi')
+
+
+class Profiler:
+
+    def __init__(self):
+        self.sessions = []
+        self.trial = None                 # record of the open trial
+        self.counts, self.times = None, None # its counts and times, updated in place
+
+    # Sessions and trials
+
+    def startSession(self, **labels):
+        # labels: e.g. learningSpeed=0.1, c0=1.0, horizon=0
+        self.endTrial()
+        self.sessions.append({'labels': labels, 'trials': []})
+
+    def startTrial(self, **labels):
+        # labels: e.g. episode=3, trial=1
+        self.endTrial()
+        if not self.sessions:
+            self.startSession()
+        self.counts, self.times = {}, {}
+        self.trial = {'labels': labels, 'counts': self.counts, 'times': self.times, 'wallTime': time.perf_counter()}
+        self.sessions[-1]['trials'].append(self.trial)
+
+    def openTrial(self):
+        # Opens a trial if none is open, returns True if it did (the caller then ends it)
+        if self.trial is not None:
+            return False
+        self.startTrial()
+        return True
+
+    def endTrial(self):
+        if self.trial is not None:
+            self.trial['wallTime'] = time.perf_counter()-self.trial['wallTime']
+            self.trial, self.counts, self.times = None, None, None
+
+    # Recording (hot path)
+
+    def count(self, name, n=1):
+        if self.counts is None:
+            self.startTrial()
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def lap(self, name, t0):
+        # Adds the time elapsed since t0 to the block name, returns the current time
+        t = time.perf_counter()
+        if self.times is None:
+            self.startTrial()
+        self.times[name] = self.times.get(name, 0.) + t-t0
+        return t
+
+    now = staticmethod(time.perf_counter)
+
+    # Report
+
+    def report(self):
+        # Returns a JSON-ready dict: the trials of each session with their totals, and the totals
+        # over all sessions. The wall time of an open trial is the time elapsed so far.
+        sessions = []
+        for session in self.sessions:
+            trials = [dict(t, wallTime=t['wallTime'] if t is not self.trial else time.perf_counter()-t['wallTime'])
+                      for t in session['trials']]
+            sessions.append({'labels': session['labels'], 'trials': trials, 'total': Aggregate(trials)})
+        return {'sessions': sessions, 'total': Aggregate([s['total'] for s in sessions])}
+
+    def saveReport(self, fileName):
+        with open(fileName, 'w') as f:
+            json.dump(self.report(), f, indent=1, default=float)
+
+    def summary(self):
+        # Text table of the totals of each session: counts, then the time of each block and its share
+        lines = []
+        report = self.report()
+        for session in report['sessions']+[dict(labels='all sessions', total=report['total'])]:
+            total = session['total']
+            lines.append('%s: %d trials, %.6g s' % (session['labels'], total['trials'], total['wallTime']))
+            for name, value in sorted(total['counts'].items()):
+                lines.append('    %-24s %14d' % (name, value))
+            for name, value in sorted(total['times'].items(), key=lambda item: -item[1]):
+                share = value/total['wallTime'] if total['wallTime'] > 0 else np.nan
+                lines.append('    %-24s %14.6g s %6.1f %%' % (name, value, 100*share))
+        return '\n'.join(lines)
+
+
+def Aggregate(records):
+    # Sums the counts, times and wall times of trial records (or of totals of sessions)
+    total = {'trials': 0, 'counts': {}, 'times': {}, 'wallTime': 0.}
+    for record in records:
+        total['trials'] += record.get('trials', 1)
+        total['wallTime'] += record['wallTime']
+        for key in ('counts', 'times'):
+            for name, value in record[key].items():
+                total[key][name] = total[key].get(name, 0)+value
+    return total
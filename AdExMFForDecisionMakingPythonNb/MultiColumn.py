@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Competition between N cortical columns
+
+# In[ ]:
+
+
+#export
+
+# Initialization
+import numpy as np
+from DiffOperator import MakeModelParameters, TF_jet, NOTEBOOK_V0
+from SDEIntegrator import IntrinsicNoise
+
+
+# ## State of N columns
+
+# In[ ]:
+
+
+#export
+
+# Each column (pool) a = 0, ..., N-1 has the 7 variables of a pool of DifferentialOperator,
+#   v_e, v_i, C_ee, C_ei, C_ii, W_e, W_i
+# stored at 7*a, ..., 7*a+6, and each pair of columns a < b (in the order (0,1), (0,2), ..., (1,2), ...)
+# has the 4 cross-column covariances
+#   C_eaeb, C_eaib, C_iaeb, C_iaib
+# stored after the 7*N column variables. For N = 2 this is the 18-vector of DifferentialOperator
+# (see DiffOperator.STATE_VARIABLE_NAMES), the columns being named A, B, C, ...
+
+COLUMN_VARIABLE_NAMES = ('v_e', 'v_i', 'C_ee', 'C_ei', 'C_ii', 'W_e', 'W_i')
+
+
+def ColumnStateSize(nColumns):
+    return 7*nColumns + 4*(nColumns*(nColumns-1)//2)
+
+
+def ColumnCount(stateSize):
+    # Number of columns N of a state of the given size (inverse of ColumnStateSize)
+    nColumns = int(round((-5+np.sqrt(25+8*stateSize))/4))
+    if ColumnStateSize(nColumns) != stateSize:
+        raise ValueError("%d is not the size of the state of N columns" % stateSize)
+    return nColumns
+
+
+def ColumnPairs(nColumns):
+    # Indices (a, b) of the pairs of columns a < b, as two arrays
+    a, b = np.triu_indices(nColumns, 1)
+    return a, b
+
+
+def ColumnStateNames(nColumns):
+    labels = [chr(ord('A')+a) if nColumns <= 26 else str(a) for a in range(nColumns)]
+    names = []
+    for X in labels:
+        names += ['v_e'+X, 'v_i'+X, 'C_e'+X+'e'+X, 'C_e'+X+'i'+X, 'C_i'+X+'i'+X, 'W_e'+X, 'W_i'+X]
+    for a, b in zip(*ColumnPairs(nColumns)):
+        X, Y = labels[a], labels[b]
+        names += ['C_e'+X+'e'+Y, 'C_e'+X+'i'+Y, 'C_i'+X+'e'+Y, 'C_i'+X+'i'+Y]
+    return tuple(names)
+
+
+def ColumnInitialState(nColumns, V0=None):
+    # Initial state of N columns, every column starting from the pool A of the 18-vector V0 and every
+    # pair from its cross-pool covariances (the V0 of the notebook by default)
+    V0 = np.array(NOTEBOOK_V0 if V0 is None else V0, dtype=float)
+    nPairs = nColumns*(nColumns-1)//2
+    return np.concatenate([np.tile(V0[0:7], nColumns), np.tile(V0[14:18], nPairs)])
+
+
+def CouplingMatrix(nColumns, weights=None):
+    # Cross-coupling matrix M, M[a,b] being the weight of the excitatory output of column b onto column a
+    # relative to the coupling of the two-column model (wCe onto the excitatory and wCi onto the
+    # inhibitory population). All-to-all (ones off the diagonal) by default, which for N = 2 is the
+    # coupling of DifferentialOperator.
+    # weights: optional (N, N) array of relative weights, its diagonal is ignored
+    M = np.ones((nColumns, nColumns)) if weights is None else np.array(weights, dtype=float)
+    if M.shape != (nColumns, nColumns):
+        raise ValueError("The coupling matrix of %d columns must be (%d, %d)" % (nColumns, nColumns, nColumns))
+    np.fill_diagonal(M, 0.)
+    return M
+
+
+# ## SDE system of N columns
+
+# In[ ]:
+
+
+#export
+
+# The rates r = (v_e of the N columns, v_i of the N columns) enter the transfer functions through the
+# inputs u = P r + drive, P being the identity plus the cross-coupling wCe*M (onto the excitatory
+# inputs) and wCi*M (onto the inhibitory inputs) from the excitatory rates. With S the covariance
+# matrix of r, assembled from the state, the equations of DifferentialOperator read, for all the
+# columns at once,
+#   dv/dt = 1/T*(F + 0.5*(d_ee*Cin_ee + 2*d_ei*Cin_ei + d_ii*Cin_ii) - v),  Cin = P S P^T
+#   dS/dt = 1/T*(diag(F*(1/T-F)/N) + (F-v)(F-v)^T + S G^T + G S - 2*S),   G = dF/dr = D P
+# D holding the first derivatives of the transfer functions of each population (dTF/dfe, dTF/dfi),
+# and the adaptation follows the mean conductances of each column as in DifferentialOperator. The
+# transfer functions are evaluated once per population, as arrays, the rest being matrix products of
+# size 2N, so there is no loop over the columns or the pairs.
+#
+# legacy: the equations A16 and A17 of the two-column model (res[16], res[17] of DifferentialOperator)
+# do not follow the general form: the input of iB from eA is weighted by dTF2/dfi of pool B instead of
+# dTF1/dfi, and dTF2/dfi of pool A is taken at the adaptation W_eA. With legacy=True (the default for
+# N = 2) these terms are added as corrections, so that N = 2 reproduces DifferentialOperator; with
+# legacy=False (always for N > 2) the general equations are used.
+
+def MultiColumnOperator(V, TF1, TF2, params, excAff, inhAff, coupling=None, legacy=None):
+    # V      : state of N columns, (ColumnStateSize(N),) or (ColumnStateSize(N), nTrials)
+    # excAff : stimulus related excitatory activity of each column, (N,) or (N, nTrials)
+    # inhAff : stimulus related inhibitory activity of each column, (N,) or (N, nTrials)
+    # params : ModelParameters record (a plain parameter vector is converted)
+    # coupling: cross-coupling matrix (see CouplingMatrix), all-to-all by default
+    params = MakeModelParameters(params)
+    V = np.asarray(V)
+    n = ColumnCount(V.shape[0])
+    M = CouplingMatrix(n) if coupling is None else np.asarray(coupling, dtype=float)
+    legacy = n == 2 if legacy is None else legacy
+    aRS, bRS, tauwRS = params.aRS, params.bRS, params.tauwRS
+    vAI, wce, wci = params.vAI, params.wce, params.wci
+    El, Qe, Qi, Te, Ti, Gl, Ee, Ei = params.El, params.Qe, params.Qi, params.Te, params.Ti, params.Gl, params.Ee, params.Ei
+    T, Ne, Ni, wCe, wCi = params.T, params.Ne, params.Ni, params.wCe, params.wCi
+
+    batch = V.shape[1:]
+    columns = V[:7*n].reshape((n, 7)+batch)
+    ve, vi, Cee, Cei, Cii, We, Wi = (columns[:,k] for k in range(7))
+    cross = V[7*n:].reshape((-1, 4)+batch)
+    pa, pb = ColumnPairs(n)
+    excAff = np.asarray(excAff, dtype=float).reshape(np.shape(excAff)+(1,)*(len(batch)+1-np.ndim(excAff)))
+    inhAff = np.asarray(inhAff, dtype=float).reshape(np.shape(inhAff)+(1,)*(len(batch)+1-np.ndim(inhAff)))
+
+    # Inputs of the transfer functions
+    drive = ve + vAI + excAff                 # excitatory output of each column, as seen by the others
+    crossDrive = np.tensordot(M, drive, axes=1)
+    excInput = drive + wCe*crossDrive
+    inhInput = vi + inhAff + wCi*crossDrive
+    (F1, d1_e, d1_i, d1_ee, d1_ei, d1_ii), _ = TF_jet(TF1, excInput, inhInput, We)
+    (F2, d2_e, d2_i, d2_ee, d2_ei, d2_ii), _ = TF_jet(TF2, excInput, inhInput, Wi)
+
+    # Covariance matrix S of the rates (batch first)
+    def BatchFirst(x):
+        return np.moveaxis(np.asarray(x), 0, -1)
+    def ColumnFirst(x):
+        return np.moveaxis(x, -1, 0)
+    idx = np.arange(n)
+    S = np.zeros(batch+(2*n, 2*n), dtype=np.result_type(V, F1))
+    S[..., idx, idx] = BatchFirst(Cee)
+    S[..., idx, n+idx] = S[..., n+idx, idx] = BatchFirst(Cei)
+    S[..., n+idx, n+idx] = BatchFirst(Cii)
+    for k, (rows, cols) in enumerate(((pa, pb), (pa, n+pb), (n+pa, pb), (n+pa, n+pb))):
+        S[..., rows, cols] = S[..., cols, rows] = BatchFirst(cross[:,k])
+
+    # Input map P and Jacobian of the rates G = dF/dr
+    P = np.eye(2*n)
+    P[:n,:n] += wCe*M
+    P[n:,:n] += wCi*M
+    Cin = np.einsum('ij,...jk,lk->...il', P, S, P)
+    cinEE, cinEI, cinII = Cin[..., idx, idx], Cin[..., idx, n+idx], Cin[..., n+idx, n+idx]
+    dE = BatchFirst(np.concatenate([d1_e, d2_e]))  # derivatives of each population (e then i)
+    dI = BatchFirst(np.concatenate([d1_i, d2_i]))
+    G = dE[...,:,None]*np.tile(P[:n], (2, 1)) + dI[...,:,None]*np.tile(P[n:], (2, 1))
+
+    res = np.empty(V.shape, dtype=S.dtype)
+    out = res[:7*n].reshape((n, 7)+batch)
+    outCross = res[7*n:].reshape((-1, 4)+batch)
+
+    # Means
+    cinEE, cinEI, cinII = (ColumnFirst(c) for c in (cinEE, cinEI, cinII))
+    out[:,0] = 1/T*(F1 + .5*(d1_ee*cinEE + 2*d1_ei*cinEI + d1_ii*cinII) - ve)
+    out[:,1] = 1/T*(F2 + .5*(d2_ee*cinEE + 2*d2_ei*cinEI + d2_ii*cinII) - vi)
+
+    # Covariances
+    F = BatchFirst(np.concatenate([F1, F2]))
+    deviation = F - BatchFirst(np.concatenate([ve, vi]))
+    GS = G @ S
+    R = np.einsum('...i,...j->...ij', deviation, deviation) + GS + np.swapaxes(GS, -1, -2) - 2*S
+    R[..., np.arange(2*n), np.arange(2*n)] += F*(1./T-F)/np.repeat([Ne, Ni], n)
+    R = R/T
+    out[:,2] = ColumnFirst(R[..., idx, idx])
+    out[:,3] = ColumnFirst(R[..., idx, n+idx])
+    out[:,4] = ColumnFirst(R[..., n+idx, n+idx])
+    for k, (rows, cols) in enumerate(((pa, pb), (pa, n+pb), (n+pa, pb), (n+pa, n+pb))):
+        outCross[:,k] = ColumnFirst(R[..., rows, cols])
+
+    # Adaptation
+    fe = 2*wce*Ne*drive + wce*Ne*crossDrive
+    fi = 2*wci*Ni*vi + wci*Ne*crossDrive
+    muGe, muGi = Qe*Te*fe, Qi*Ti*fi
+    muG = Gl+muGe+muGi
+    muV = (muGe*Ee+muGi*Ei+Gl*El-We)/muG
+    out[:,5] = -We/tauwRS+bRS*ve+aRS*(muV-El)/tauwRS
+    out[:,6] = -Wi/1.0+0.*vi # inhibitory cells do not have any adaptation
+
+    if legacy:
+        if n != 2:
+            raise ValueError("The legacy equations only exist for two columns")
+        J2A_W, _ = TF_jet(TF2, excInput[0], inhInput[0], We[0])
+        C_eAiA, C_eBeB, C_eBiB, C_iAiB = Cei[0], Cee[1], Cei[1], cross[0,3]
+        outCross[0,2] += 1/T*(C_eAiA*wCi*M[1,0]*(d2_i[1]-d1_i[1]) + C_iAiB*(d2_i[1]-d1_i[1])
+                              + C_eBeB*wCi*M[0,1]*(J2A_W[2]-d2_i[0]))
+        outCross[0,3] += 1/T*C_eBiB*wCi*M[0,1]*(J2A_W[2]-d2_i[0])
+    return res
+
+
+# ## Euler-Maruyama scheme for N columns
+
+# In[ ]:
+
+
+#export
+
+def RateIndices(nColumns):
+    # Indices of v_e and v_i of each column in the state, in the order of the intrinsic noise
+    # (v_e, v_i of column 0, v_e, v_i of column 1, ...), as for TimeStepping with N = 2
+    return (7*np.arange(nColumns)[:,None]+np.arange(2)).ravel()
+
+
+def TimeSteppingColumns(V0, lambdas, TF1, TF2, params, coupling=None, decisionThreshold=None, tWarmUp=2.,
+                        rng=None, legacy=None):
+# Same scheme as SDEIntegrator.TimeStepping for N columns, the regulated stimulus of a column being
+# provided to both of its populations.
+# V0: initial conditions, (ColumnStateSize(N),), e.g. ColumnInitialState(N)
+# lambdas: regulated stimuli of the columns, (N, nSteps+1)
+# coupling, legacy: see MultiColumnOperator
+# decisionThreshold: if given, the integration stops as soon as the v_e of the leading column exceeds the
+#                    one of every other column by this value (|v_eA-v_eB| for N = 2), checked from
+#                    int(tWarmUp/dt) on as in TimeSteppingToDecision
+# rng: random generator of the intrinsic noise, as for TimeStepping (with N = 2 and the same rng, the
+#      trajectory is the one of TimeStepping)
+# Returns X (nInstants, ColumnStateSize(N)), the decision time measured from tWarmUp and the index of
+# the chosen column (both None if no decision is made).
+
+    params = MakeModelParameters(params)
+    sigma, dt, T, nSteps = params.sigma, params.dt, params.T, params.nSteps
+    iWarmUp = int(tWarmUp/dt)
+    lambdas = np.asarray(lambdas, dtype=float)
+    n = lambdas.shape[0]
+    M = CouplingMatrix(n) if coupling is None else np.asarray(coupling, dtype=float)
+    rates = RateIndices(n)
+
+    x = np.array(V0, dtype=float)
+    X = np.empty((nSteps+1, x.size))
+    X[0] = x
+    intrinsicNoise = IntrinsicNoise(rng, nSteps, 2*n)
+
+    decisionTime, winner = None, None
+    for i in range(nSteps+1):
+        if decisionThreshold is not None and iWarmUp <= i < nSteps:
+            second, first = np.sort(x[7*np.arange(n)])[-2:]
+            if first-second > decisionThreshold:
+                decisionTime, winner = (i-iWarmUp)*dt, int(np.argmax(x[7*np.arange(n)]))
+                break
+        if i == nSteps:
+            break
+        x = x + dt*MultiColumnOperator(x, TF1, TF2, params, lambdas[:,i], lambdas[:,i], M, legacy)
+        x[rates] = x[rates] + (1/T)*np.sqrt(dt)*sigma*intrinsicNoise[i,:]
+        X[i+1] = x
+    return X[:i+1], decisionTime, winner
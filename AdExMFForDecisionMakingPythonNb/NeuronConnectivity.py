@@ -12,10 +12,15 @@
 
 # Initialize
 
+import os
+import json
+import hashlib
 import numpy as np
 from syn_and_connec_library import get_connectivity_and_synapses_matrix
 from cell_library import get_neuron_params
-from theoretical_tools import pseq_params,TF_my_templateup
+from theoretical_tools import TF_parameters,TF_kernel,TF_jet_kernel
+from theoretical_tools import HETEROGENEITY_ORDER,heterogeneity_nodes,TF_het_params,TF_het_kernel,TF_het_jet_kernel
+from theoretical_tools import TF_table_grid,TF_table_fill,TF_table_jet_kernel,TF_table_error
 
 
 # In[ ]:
@@ -37,54 +42,206 @@ def ReformatSynParameters(params, M):
             params['Ntot'], params['gei'] = M[0,0]['Ntot'], M[0,0]['gei']
             params['coeffCrossCov'] = M[0,0]['coeffCrossCov']
 
-def LoadTransferFunctions(NRN1, NRN2, NTWK):
-
-
-            # NTWK
-            M = get_connectivity_and_synapses_matrix(NTWK, SI_units=True)
-
-            # NRN1
-            params1 = get_neuron_params(NRN1, SI_units=True)
-            ReformatSynParameters(params1, M)
-            try:
-
-
-                P1 = np.load('data/RS-cell_CONFIG1_fit.npy')
-
-
-                params1['P'] = P1
-                def TF1(fe, fi,XX):
-                    return TF_my_templateup(fe, fi,XX, *pseq_params(params1))
-
-
-
+# The fit files are found in the data folder next to this file, whatever the working directory. The
+# transfer functions are built once per process for each (cell, network, fit) and then shared: the cache
+# is keyed by the hash of the content of the fit file, so that a new fit gives new transfer functions.
+# The hash is computed again only when the path, modification time or size of the file change.
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+FIT_FILES = ('RS-cell_CONFIG1_fit.npy', 'FS-cell_CONFIG1_fit.npy') # fits of TF1 and TF2 by default
+
+_transferFunctionCache = {}
+_fileHashCache = {}
+
+def DataPath(fileName):
+    # Path of a file of the data folder (absolute paths are kept)
+    return os.path.join(DATA_DIRECTORY, fileName)
+
+
+def FileHash(fileName):
+    # SHA-256 of the content of the file, cached on its (path, modification time, size)
+    stat = os.stat(fileName)
+    key = (os.path.abspath(fileName), stat.st_mtime_ns, stat.st_size)
+    if key not in _fileHashCache:
+        with open(fileName, 'rb') as f:
+            _fileHashCache[key] = hashlib.sha256(f.read()).hexdigest()
+    return _fileHashCache[key]
+
+
+def TransferFunction(NRN, NTWK, fitFile):
+# Transfer function of the cell NRN in the network NTWK with the fit of fitFile (cached): it is called
+# as TF(fe, fi, XX) and has the attributes jet (TF with its first and second derivatives), params
+# (theoretical_tools.TFParameters) and name
+    fitFile = DataPath(fitFile)
+    key = (NRN, NTWK, FileHash(fitFile))
+    if key not in _transferFunctionCache:
+        params = get_neuron_params(NRN, SI_units=True)
+        ReformatSynParameters(params, get_connectivity_and_synapses_matrix(NTWK, SI_units=True))
+        params['P'] = np.load(fitFile)
+        p = TF_parameters(params) # built once, passed as is to the compiled kernels
+        def TF(fe, fi, XX):
+            return TF_kernel(fe, fi, XX, p.array)
+        def TF_jet(fe, fi, XX): # TF with its first and second derivatives
+            return TF_jet_kernel(fe, fi, XX, p.array)
+        TF.jet = TF_jet
+        TF.params = p
+        TF.name = '%s_%s' % (NRN, NTWK)
+        _transferFunctionCache[key] = TF
+    return _transferFunctionCache[key]
+
+
+def ClearTransferFunctionCache():
+    _transferFunctionCache.clear()
+    _fileHashCache.clear()
+
+
+def TransferFunctionFingerprint(TF):
+    # Hash of what a transfer function computes: its parameters (fit and network configuration included)
+    # and, for the heterogeneous and tabulated ones, their quadrature or grid. Two transfer functions of
+    # the same name (e.g. TF and its table, or two fits) thus have different fingerprints. A transfer
+    # function without params (e.g. a plain function) is identified by its id, within this process only.
+    params = getattr(TF, 'params', None)
+    if params is None:
+        return 'id%d' % id(TF)
+    data = np.ascontiguousarray(params.array).tobytes()
+    if getattr(TF, 'heterogeneity', None) is not None:
+        data += b'heterogeneity'+np.array(TF.heterogeneity, dtype=float).tobytes()
+    if getattr(TF, 'table', None) is not None:
+        data += b'table'+np.ascontiguousarray(TF.grid).tobytes()
+    return hashlib.sha256(data).hexdigest()
+
+
+def LoadTransferFunctions(NRN1, NRN2, NTWK, heterogeneity=None, order=HETEROGENEITY_ORDER, fitFiles=FIT_FILES):
+            # heterogeneity: if given, the relative spread sigma of the leak reversal potentials of the cells,
+            #                the transfer functions being then those of heterogeneous populations
+            #                (theoretical_tools.TF_my_templateup_heterogeneity, Gauss-Hermite quadrature of the given order)
+            # fitFiles: fits of NRN1 and NRN2, in the data folder (or absolute paths)
+
+            TF1 = TransferFunction(NRN1, NTWK, fitFiles[0])
+            TF2 = TransferFunction(NRN2, NTWK, fitFiles[1])
+
+            if heterogeneity is not None:
+                return HeterogeneousTransferFunction(TF1, heterogeneity, order), \
+                       HeterogeneousTransferFunction(TF2, heterogeneity, order)
+            return TF1, TF2
 
 
+# ## Heterogeneous populations
 
-            except IOError:
-                print('=======================================================')
-                print('=====  fit for NRN1 not available  ====================')
-                print('=======================================================')
+# In[ ]:
 
-            # NRN1
-            params2 = get_neuron_params(NRN2, SI_units=True)
-            ReformatSynParameters(params2, M)
-            try:
 
-                P2 = np.load('data/FS-cell_CONFIG1_fit.npy')
+#export
 
+# The transfer function of a population whose leak reversal potentials El*k are spread by k ~ N(1, sigma)
+# is the mean of the transfer function over k, taken by a Gauss-Hermite quadrature: it costs order
+# evaluations of the homogeneous transfer function per point, in a single compiled loop. It is called
+# and has a jet as the transfer functions of LoadTransferFunctions, hence it can replace TF1 and TF2.
+
+def HeterogeneousTransferFunction(TF, sigma, order=HETEROGENEITY_ORDER):
+    # TF: transfer function from LoadTransferFunctions (homogeneous), the result keeping its params (cached)
+    key = (TF, sigma, order)
+    if key in _transferFunctionCache:
+        return _transferFunctionCache[key]
+    scales, weights = heterogeneity_nodes(sigma, order)
+    pm = TF_het_params(TF.params, scales)
+    def TFHet(fe, fi, XX):
+        return TF_het_kernel(fe, fi, XX, pm, weights)
+    def TFHet_jet(fe, fi, XX):
+        return TF_het_jet_kernel(fe, fi, XX, pm, weights)
+    TFHet.jet = TFHet_jet
+    TFHet.params = TF.params
+    TFHet.name = '%s_het%g' % (TF.name, sigma)
+    TFHet.heterogeneity = (sigma, order)
+    _transferFunctionCache[key] = TFHet
+    return TFHet
+
+
+# ## Transfer function lookup tables
 
+# In[ ]:
 
-                params2['P'] = P2
-                def TF2(fe, fi,XX):
-                    return TF_my_templateup(fe, fi,XX, *pseq_params(params2))
 
-            except IOError:
-                print('=======================================================')
-                print('=====  fit for NRN2 not available  ====================')
-                print('=======================================================')
+#export
 
-            return TF1, TF2
+# The jets of TF1 and TF2 can be tabulated on a regular (fe, fi, W) grid covering the region visited by
+# the mean-field dynamics, and then interpolated (cubic convolution) instead of being computed. A table
+# is stored as a .npy file, memory-mapped when loaded, with a .json file recording the grid, the
+# interpolation error estimate (see theoretical_tools.TF_table_error) and a fingerprint of the transfer
+# function parameters (fit and network configuration), which is checked at loading. Outside of the grid
+# the analytic jet is used.
+
+# Default grid: (start, stop, number of points) of fe, fi and W
+TABLE_RANGES = ((0., 200., 201), (0., 200., 201), (0., 1e-9, 21))
+
+def TableFingerprint(TF, grid):
+    # Hash of the transfer function parameters (fit included) and of the grid of a table
+    return hashlib.sha256(np.ascontiguousarray(TF.params.array).tobytes()+grid.tobytes()).hexdigest()
+
+
+def BuildTransferFunctionTable(TF, fileName, ranges=TABLE_RANGES):
+# Tabulates the jet of TF (from LoadTransferFunctions) and saves it to fileName (.npy) and
+# its description to the .json file of the same name. Returns the description.
+# The heterogeneous transfer functions are not tabulated.
+    if getattr(TF, 'heterogeneity', None) is not None:
+        raise ValueError("The heterogeneous transfer function %s cannot be tabulated" % TF.name)
+    grid = TF_table_grid(*ranges)
+    shape = tuple(int(n) for n in grid[2::3])+(6,)
+    os.makedirs(os.path.dirname(fileName) or '.', exist_ok=True)
+    table = np.lib.format.open_memmap(fileName+'.tmp', mode='w+', dtype=np.float64, shape=shape)
+    TF_table_fill(table, grid, TF.params)
+    table.flush()
+    error = TF_table_error(table, grid, TF.params)
+    del table
+    os.replace(fileName+'.tmp', fileName)
+    
+    info = {'name': getattr(TF, 'name', None), 'fingerprint': TableFingerprint(TF, grid),
+            'ranges': [list(r) for r in ranges], 'grid': grid.tolist(),
+            'errorEstimate': dict(zip(['TF', 'dfe', 'dfi', 'dfefe', 'dfefi', 'dfifi'], error.tolist()))}
+    with open(os.path.splitext(fileName)[0]+'.json', 'w') as f:
+        json.dump(info, f, indent=1)
+    return info
+
+
+def LoadTransferFunctionTable(TF, fileName):
+# Loads the table of TF saved in fileName and returns the tabulated transfer function: 
+# it is called and has a jet as TF, plus the attributes table, grid and errorEstimate.
+# Raises a ValueError if the table was not built for TF (different fit or configuration).
+    with open(os.path.splitext(fileName)[0]+'.json') as f:
+        info = json.load(f)
+    grid = TF_table_grid(*info['ranges'])
+    if info['fingerprint'] != TableFingerprint(TF, grid):
+        raise ValueError("The table %s was not built for the transfer function %s" % (fileName, getattr(TF, 'name', '')))
+    table = np.asarray(np.load(fileName, mmap_mode='r'))
+    p = TF.params
+    
+    def TFTable(fe, fi, XX):
+        return TF_table_jet_kernel(fe, fi, XX, table, grid, p, ncomp=1)[0]
+    def TFTable_jet(fe, fi, XX):
+        return TF_table_jet_kernel(fe, fi, XX, table, grid, p)
+    TFTable.jet = TFTable_jet
+    TFTable.params = p
+    TFTable.name = getattr(TF, 'name', None)
+    TFTable.table, TFTable.grid = table, grid
+    TFTable.errorEstimate = info['errorEstimate'] if 'errorEstimate' in info else info['errorBound'] # older tables
+    return TFTable
+
+
+def TabulateTransferFunctions(TF1, TF2, directory=DATA_DIRECTORY, ranges=TABLE_RANGES):
+# Tabulated versions of TF1 and TF2, the tables data/<name>_table.npy being built if they
+# do not exist or do not match the transfer functions or the grid
+    tabulated = []
+    for TF in (TF1, TF2):
+        fileName = os.path.join(directory, '%s_table.npy' % TF.name)
+        try:
+            TFTable = LoadTransferFunctionTable(TF, fileName)
+            if TFTable.grid.tolist() != TF_table_grid(*ranges).tolist():
+                raise ValueError
+        except (IOError, ValueError):
+            BuildTransferFunctionTable(TF, fileName, ranges)
+            TFTable = LoadTransferFunctionTable(TF, fileName)
+        tabulated.append(TFTable)
+    return tuple(tabulated)
 
 
 # # Bibliography
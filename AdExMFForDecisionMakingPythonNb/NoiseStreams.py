@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Counter-based noise streams
+
+# In[ ]:
+
+
+#export
+
+# Initialization
+import numpy as np
+
+
+# ## Keys and blocks
+
+# In[ ]:
+
+
+#export
+
+# The noise of a trial is drawn from Philox, a counter-based generator: its output only depends on a key
+# and a counter, so any part of any stream can be generated directly, in any order and in any process.
+# The key is derived from (session, iteration, episode, trial), and the counter of the block b of the
+# stream s starts at [0, 0, b, s], so that the blocks and the streams never overlap. The noise is thus
+# generated lazily, block by block, as the integration goes on, and a single trial can be replayed in
+# isolation from its key.
+
+INTRINSIC = 0 # intrinsic noise of the 4 firing rates (TimeStepping)
+EXTRINSIC = 1 # extrinsic noise of the regulatory mechanism (RegulatoryPsi)
+EPISODE   = 2 # other draws of an episode (difficulty, stimuli, shuffling)
+
+BLOCK_SIZE = 256 # number of time steps per block
+
+
+def StreamKey(session, iteration=0, episode=0, trial=0):
+    # Philox key of the streams of one trial
+    return np.random.SeedSequence(session, spawn_key=(iteration, episode, trial)).generate_state(2, np.uint64)
+
+
+def BlockGenerator(key, stream, block=0):
+    # Generator of the block of a stream
+    return np.random.Generator(np.random.Philox(key=key, counter=[0, 0, block, stream]))
+
+
+def EpisodeGenerator(session, iteration, episode):
+    # Generator of the draws of an episode other than the noise of its trials
+    return BlockGenerator(StreamKey(session, iteration, episode), EPISODE)
+
+
+# ## Lazy noise
+
+# In[ ]:
+
+
+#export
+
+class NoiseStream:
+# Standard normal noise of one stream, rows of width values, generated by blocks of blockSize rows
+# when they are first indexed. noise[i] (or noise[i, columns]) is the row of the step i, and
+# noise[i0:i1] the rows of the steps i0, ..., i1-1, as for an array of shape (nSteps, width).
+
+    def __init__(self, key, stream, width, nSteps, blockSize=BLOCK_SIZE):
+        self.key, self.stream, self.width, self.blockSize = key, stream, width, blockSize
+        self.shape = (nSteps, width)
+        self.cachedBlock, self.cache = -1, None
+
+    def block(self, b):
+        if b != self.cachedBlock:
+            self.cache = BlockGenerator(self.key, self.stream, b).standard_normal((self.blockSize, self.width))
+            self.cachedBlock = b
+        return self.cache
+
+    def rows(self, start, stop):
+        out = np.empty((stop-start, self.width))
+        i = start
+        while i < stop:
+            b, r = divmod(i, self.blockSize)
+            n = min(self.blockSize-r, stop-i)
+            out[i-start:i-start+n] = self.block(b)[r:r+n]
+            i += n
+        return out
+
+    def __getitem__(self, index):
+        i, columns = index if isinstance(index, tuple) else (index, slice(None))
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.shape[0])
+            return self.rows(start, stop)[::step, columns]
+        b, r = divmod(int(i), self.blockSize)
+        return self.block(b)[r, columns]
+
+
+class EnsembleNoise:
+# Intrinsic noise of an ensemble of trials, one NoiseStream per trial, indexed as an array of shape
+# (nTrials, nSteps, width): noise[trials, i, columns], trials being a slice or an index array.
+# The blocks of all the trials are generated together.
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.blockSize = streams[0].blockSize
+        self.shape = (len(streams),)+streams[0].shape
+        self.cachedBlock, self.cache = -1, None
+
+    def __getitem__(self, index):
+        trials, i, columns = index
+        b, r = divmod(int(i), self.blockSize)
+        if b != self.cachedBlock:
+            self.cache = np.stack([s.block(b) for s in self.streams])
+            self.cachedBlock = b
+        return self.cache[trials, r, columns]
+
+
+class TrialNoise:
+# The noise of one trial, keyed by (session, iteration, episode, trial). It can be given as rng to
+# RegulatoryPsi and to the integrators of SDEIntegrator (a list of them for the ensembles), which
+# then draw the extrinsic and intrinsic noises of the trial from its own streams.
+
+    def __init__(self, session, iteration=0, episode=0, trial=0, blockSize=BLOCK_SIZE):
+        self.keys = (session, iteration, episode, trial)
+        self.key = StreamKey(session, iteration, episode, trial)
+        self.blockSize = blockSize
+
+    def intrinsic(self, nSteps, width=4):
+        # lazy (nSteps, width) intrinsic noise, width=4 for two pools
+        return NoiseStream(self.key, INTRINSIC, width, nSteps, self.blockSize)
+
+    def extrinsic(self, nSteps):
+        # (nSteps,) extrinsic noise, generated at once since the whole psi trace is needed
+        return NoiseStream(self.key, EXTRINSIC, 1, nSteps, self.blockSize).rows(0, nSteps)[:, 0]
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Results store
+
+# In[ ]:
+
+
+#export
+
+# Initialization
+import os
+import re
+import glob
+import uuid
+import numpy as np
+
+
+# ## Store of the session results
+
+# In[ ]:
+
+
+#export
+
+# The results of all sessions are rows (one per episode) of a structured array indexed by
+# (k, c0, horizon, iteration, episode). A store is a directory of chunks, each chunk being a .npy
+# file of such rows. Rows are appended in memory and written as a new chunk when there are
+# chunkSize of them (or at flush), under a unique name and through an atomic rename: several
+# processes can therefore append to the same store at the same time, and a reader never sees a
+# partial chunk. The chunks are memory-mapped when read.
+
+RESULT_DTYPE = np.dtype([('k', 'f8'), ('c0', 'f8'), ('horizon', 'i1'), ('iteration', 'i4'), ('episode', 'i4'),
+                         ('performance', 'f8'), ('decisionTime', 'f8'), ('difficulty', 'f8')])
+RESULT_KEYS = ('k', 'c0', 'horizon', 'iteration', 'episode')
+
+
+class ResultsStore:
+
+    def __init__(self, directory, chunkSize=100000):
+        self.directory = directory
+        self.chunkSize = chunkSize
+        self.pending = []
+        os.makedirs(directory, exist_ok=True)
+
+    # Writing
+
+    def append(self, rows):
+        # rows: a structured array of RESULT_DTYPE (or convertible to it)
+        self.pending.append(np.asarray(rows, dtype=RESULT_DTYPE).ravel())
+        if sum(r.size for r in self.pending) >= self.chunkSize:
+            self.flush()
+
+    def appendSession(self, result, learningSpeed, c0, horizon, iteration):
+        # result: a dict with the performance, decisionTimeList and difficultyList arrays of one
+        # session (see DecisionSession.RunSession), all given per episode
+        performance = np.asarray(result['performance'])
+        nOfEpisodes = performance.size
+        rows = np.zeros(nOfEpisodes, dtype=RESULT_DTYPE)
+        rows['k'], rows['c0'], rows['horizon'], rows['iteration'] = learningSpeed, c0, horizon, iteration
+        rows['episode'] = np.arange(nOfEpisodes)
+        rows['performance'] = performance
+        rows['decisionTime'] = np.asarray(result.get('decisionTimeList', np.full(nOfEpisodes, np.nan)))[:nOfEpisodes]
+        rows['difficulty'] = np.asarray(result.get('difficultyList', np.full(nOfEpisodes, np.nan)))[:nOfEpisodes]
+        self.append(rows)
+
+    def flush(self):
+        # Writes the pending rows as a new chunk
+        if not self.pending:
+            return None
+        rows = np.concatenate(self.pending)
+        self.pending = []
+        return self._write(rows)
+
+    def _write(self, rows):
+        name = os.path.join(self.directory, 'chunk_%d_%s.npy' % (os.getpid(), uuid.uuid4().hex))
+        with open(name+'.tmp', 'wb') as f:
+            np.save(f, rows)
+        os.replace(name+'.tmp', name)
+        return name
+
+    def compact(self):
+        # Merges the existing chunks into a single one, sorted by the keys. The chunks written
+        # meanwhile by other processes are left as they are.
+        self.flush()
+        names = self.chunkNames()
+        if len(names) < 2:
+            return
+        rows = np.concatenate([np.load(name) for name in names])
+        self._write(np.sort(rows, order=list(RESULT_KEYS)))
+        for name in names:
+            os.remove(name)
+
+    # Reading
+
+    def chunkNames(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'chunk_*.npy')))
+
+    def chunks(self):
+        # Memory-mapped chunks, read lazily one at a time
+        for name in self.chunkNames():
+            yield np.load(name, mmap_mode='r')
+
+    def load(self, k=None, c0=None, horizon=None, iteration=None, episode=None):
+        # Rows matching the given keys (None matches all), sorted by the keys. The pending rows
+        # of this store are included.
+        selection = {'k': k, 'c0': c0, 'horizon': horizon, 'iteration': iteration, 'episode': episode}
+        found = []
+        for chunk in list(self.chunks())+self.pending:
+            mask = np.ones(chunk.shape[0], dtype=bool)
+            for key, value in selection.items():
+                if value is not None:
+                    mask &= np.isclose(chunk[key], value, rtol=0, atol=1e-9)
+            if mask.any():
+                found.append(np.asarray(chunk[mask]))
+        if not found:
+            return np.zeros(0, dtype=RESULT_DTYPE)
+        return np.sort(np.concatenate(found), order=list(RESULT_KEYS))
+
+    def session(self, k, c0, horizon, iteration):
+        # Performance, decision time and difficulty arrays of one session, episode by episode
+        rows = self.load(k=k, c0=c0, horizon=horizon, iteration=iteration)
+        return {'performance': rows['performance'], 'decisionTimeList': rows['decisionTime'],
+                'difficultyList': rows['difficulty']}
+
+    def keys(self):
+        # The distinct (k, c0, horizon, iteration) sessions of the store
+        sessions = set()
+        for chunk in list(self.chunks())+self.pending:
+            for row in np.unique(np.asarray(chunk[['k', 'c0', 'horizon', 'iteration']])):
+                sessions.add(tuple(row.tolist()))
+        return sorted(sessions)
+
+
+# ## Import of the .npy files of the notebook
+
+# In[ ]:
+
+
+#export
+
+FILE_NAME_PATTERN = re.compile(r'(performanceResults|decisionTimeList|difficultyList)_Iter_(\d+)_k_(\d+)(?:_c0_(\d+))?\.npy$')
+
+def ImportResultFiles(store, directory, horizon, k=None, c0=None):
+# Imports the per-iteration files saved by the notebook (e.g. showcaseData/showcase_1_H0/varying_c0)
+# into store. The k and c0 values are read from the file names (saved as 1000*k, 1000*c0); the given
+# k or c0 is used when the names do not contain it (e.g. showcaseData/showcase_2_H0/varying_k, c0=2).
+# Returns the number of imported sessions.
+    sessions = {}
+    for name in sorted(os.listdir(directory)):
+        match = FILE_NAME_PATTERN.match(name)
+        if match is None:
+            continue
+        kind, iteration, kFile, c0File = match.groups()
+        key = (float(kFile)/1000 if k is None else k, float(c0File)/1000 if c0File is not None else c0, int(iteration))
+        if key[1] is None:
+            raise ValueError("c0 is not in the name of %s, it must be given" % name)
+        sessions.setdefault(key, {})[kind] = np.load(os.path.join(directory, name))
+    for (kValue, c0Value, iteration), files in sorted(sessions.items()):
+        performance = files.get('performanceResults')
+        if performance is None:
+            continue
+        nOfEpisodes = performance.size
+        store.appendSession({'performance': performance,
+                             'decisionTimeList': files.get('decisionTimeList', np.full(nOfEpisodes, np.nan)),
+                             'difficultyList': files.get('difficultyList', np.full(nOfEpisodes, np.nan))},
+                            kValue, c0Value, horizon, iteration)
+    store.flush()
+    return len(sessions)
@@ -9,12 +9,60 @@
 #export
 
 # Initialization
-from DiffOperator import DifferentialOperator
+from DiffOperator import DifferentialOperator, MakeModelParameters, STATE_VARIABLE_NAMES, LinearDecayRates, NumericalJacobian
+from DiffOperator import ADAPTATION_VARIABLES
+from NoiseStreams import EnsembleNoise
 # import derivativesTransferFunctions
+import time
 import numpy as np
 # import derivativesTransferFunctions
 
 
+# ## Noise draws
+
+# In[ ]:
+
+
+#export
+
+# The random arguments rng of the functions below are a np.random.Generator (or the np.random module, the
+# default), drawing the whole noise of a trial at once, or a NoiseStreams.TrialNoise, drawing it from
+# the counter-based streams of the trial, lazily for the intrinsic noise. The ensembles take one of them
+# for all trials or a list with one per trial.
+
+def ExtrinsicNoise(rng, nSteps):
+    if hasattr(rng, 'extrinsic'):
+        return rng.extrinsic(nSteps)
+    rng = np.random if rng is None else rng
+    return rng.normal(0, 1, size=nSteps)
+
+
+def IntrinsicNoise(rng, nSteps, width=4):
+    # width: number of noisy rates, 4 for two pools (2 per pool, see MultiColumn for N pools)
+    if hasattr(rng, 'intrinsic'):
+        return rng.intrinsic(nSteps, width)
+    rng = np.random if rng is None else rng
+    return rng.normal(0, 1, size=(nSteps, width))
+
+
+def EnsembleIntrinsicNoise(rng, nTrials, nSteps):
+    if isinstance(rng, (list, tuple)):
+        if all(hasattr(r, 'intrinsic') for r in rng):
+            return EnsembleNoise([r.intrinsic(nSteps) for r in rng])
+        return np.stack([IntrinsicNoise(r, nSteps) for r in rng])
+    rng = np.random if rng is None else rng
+    return rng.normal(0, 1, size=(nTrials, nSteps, 4))
+
+
+def EnsembleNoiseAs(noise, dtype):
+    # Noise of an ensemble in the precision of its state. The draws are the same in float64 and float32
+    # (rounded), hence both precisions follow the same Brownian paths. The lazy NoiseStreams.EnsembleNoise
+    # blocks are kept in float64, their slices being rounded when added to the state.
+    if isinstance(noise, EnsembleNoise):
+        return noise
+    return noise.astype(dtype, copy=False)
+
+
 # ## Reward-driven regulatory mechanism
 
 # In[ ]:
@@ -22,35 +70,190 @@ import numpy as np
 
 #export
 
-def RegulatoryPsi(psi0, stimulusA, stimulusB, params):
+def PsiNoiseEnvelope(params, c0=None):
+    # Amplitude of the extrinsic noise at each step, (1/(t[i+1]*c0)**2)*sqrt(dt)*sigma_r, 
+    # computed once for the whole trial. c0 can be an array (one value per trial), the
+    # envelope then has shape (len(c0), int(tF/dt)).
+    params = MakeModelParameters(params)
+    c0 = params.c0 if c0 is None else np.asarray(c0, dtype=float)[..., None]
+    t = np.linspace(0, params.tF, params.nSteps+1)
+    return (1/(t[1:]*c0)**2)*np.sqrt(params.dt)*params.sigma_r
 
-    tF      = params[22] # final time of the trial
-    dt      = params[23] # time step
-    tauPsi  = params[25] # time scale of the regulatory mechanism
-    sigma_r = params[26] # extrinsic noise level
-    c0      = params[27] # extrinsic noise decay rate
-    
+
+def RegulatoryPsi(psi0, stimulusA, stimulusB, params, rng=None, profiler=None, legacyStimuli=False):
+# rng: random generator of the extrinsic noise (see ExtrinsicNoise), the global np.random state by default
+# profiler: optional Instrumentation.Profiler, which records the time of RegulatoryPsi and its noise draws
+# legacyStimuli: if True, the regulated stimuli are only set at the first and last instants and are zero 
+#                elsewhere, as in the version of the notebook which produced the showcaseData
+
+    params  = MakeModelParameters(params)
+    tF      = params.tF      # final time of the trial
+    dt      = params.dt      # time step
+    tauPsi  = params.tauPsi  # time scale of the regulatory mechanism
+    if profiler is not None:
+        t0 = profiler.now()
     
-    # Initialize the psi vector and the time for the trial
+    # Initialize the psi vector, the noise envelope and the noise for the whole trial
     
     psi = np.zeros(int(tF/dt)+1)
     psi[0] = psi0 # initial condition
+    envelope = PsiNoiseEnvelope(params)
+    extrinsicNoise = ExtrinsicNoise(rng, int(tF/dt))
+    
+    # Generate psi time trace for the whole trial
+    for i in range(int(tF/dt)):
+        psi[i+1] = psi[i]+(dt/tauPsi)*(-4*psi[i])*(psi[i]-0.5)*(psi[i]-1)+envelope[i]*extrinsicNoise[i]/tauPsi
+    
+    # Regulated stimuli along the whole trial (at its first and last instants only with legacyStimuli)
+    instants = [0, int(tF/dt)] if legacyStimuli else slice(None)
     lambdaA = np.zeros(int(tF/dt)+1)
     lambdaB = np.zeros(int(tF/dt)+1)
-    lambdaA[0] = psi[0]*stimulusA[0]+(1-psi[0])*stimulusB[0]
-    lambdaB[0] = psi[0]*stimulusB[0]+(1-psi[0])*stimulusA[0]
-    t = np.linspace(0, tF, int(tF/dt)+1)
+    lambdaA[instants] = psi[instants]*stimulusA[instants]+(1-psi[instants])*stimulusB[instants]
+    lambdaB[instants] = psi[instants]*stimulusB[instants]+(1-psi[instants])*stimulusA[instants]
+    if profiler is not None:
+        profiler.lap('regulatoryPsi', t0)
+        profiler.count('extrinsicDraws', int(tF/dt))
     
+    return lambdaA, lambdaB, psi 
+
+
+def RegulatoryPsiEnsemble(psi0, stimulusA, stimulusB, params, c0=None, rng=None, profiler=None, dtype=np.float64,
+                          legacyStimuli=False):
+# Integrates the regulatory mechanism of nTrials trials at once.
+# psi0: initial conditions, a float or an array (nTrials,)
+# stimulusA, stimulusB: stimuli, (int(tF/dt)+1,) shared by all trials or (nTrials, int(tF/dt)+1)
+# c0: extrinsic noise decay rates, an array (nTrials,), params.c0 by default
+# rng: random generator of the extrinsic noise, or a list of nTrials generators. With a list,
+#      trial k draws its noise from rng[k] exactly as RegulatoryPsi(..., rng=rng[k]) would.
+# profiler: optional Instrumentation.Profiler, as for RegulatoryPsi
+# dtype: np.float64, or np.float32 for the reduced precision ensembles (the noise being drawn as in float64)
+# legacyStimuli: as for RegulatoryPsi
+# Returns lambdaA, lambdaB, psi, each of shape (nTrials, int(tF/dt)+1), ready for TimeSteppingEnsemble.
+
+    params  = MakeModelParameters(params)
+    dt      = params.dt
+    tauPsi  = params.tauPsi
+    nSteps  = params.nSteps
+    if profiler is not None:
+        t0 = profiler.now()
     
+    stimulusA, stimulusB = np.atleast_2d(stimulusA), np.atleast_2d(stimulusB)
+    nTrials = max(np.size(psi0), np.size(c0) if c0 is not None else 1,
+                  stimulusA.shape[0], stimulusB.shape[0], len(rng) if isinstance(rng, (list, tuple)) else 1)
     
-    # Generate psi time trace for the whole trial
-    for i in range(int(tF/dt)):
-        psi[i+1] = psi[i]+(dt/tauPsi)*(-4*psi[i])*(psi[i]-0.5)*(psi[i]-1)+                            (1/(t[i+1]*c0)**2)*np.sqrt(dt)*sigma_r*np.random.normal(0, 1)/tauPsi
+    psi = np.zeros((nTrials, nSteps+1), dtype=dtype)
+    psi[:,0] = psi0
+    envelope = np.broadcast_to(PsiNoiseEnvelope(params, c0), (nTrials, nSteps))
+    if isinstance(rng, (list, tuple)):
+        extrinsicNoise = np.stack([ExtrinsicNoise(r, nSteps) for r in rng])
+    else:
+        rng = np.random if rng is None else rng
+        extrinsicNoise = rng.normal(0, 1, size=(nTrials, nSteps))
+    extrinsicNoise = (envelope*extrinsicNoise).astype(dtype, copy=False)
     
-    lambdaA[i+1]= psi[i+1]*stimulusA[i+1]+(1-psi[i+1])*stimulusB[i+1]
-    lambdaB[i+1] = psi[i+1]*stimulusB[i+1]+(1-psi[i+1])*stimulusA[i+1]
+    # Generate the psi time traces, all trials together
+    for i in range(nSteps):
+        p = psi[:,i]
+        psi[:,i+1] = p+(dt/tauPsi)*(-4*p)*(p-0.5)*(p-1)+extrinsicNoise[:,i]/tauPsi
     
-    return lambdaA, lambdaB, psi 
+    # Regulated stimuli, as in RegulatoryPsi
+    instants = [0, nSteps] if legacyStimuli else slice(None)
+    stimulusA, stimulusB = np.broadcast_to(stimulusA, psi.shape), np.broadcast_to(stimulusB, psi.shape)
+    lambdaA = np.zeros((nTrials, nSteps+1), dtype=dtype)
+    lambdaB = np.zeros((nTrials, nSteps+1), dtype=dtype)
+    lambdaA[:,instants] = psi[:,instants]*stimulusA[:,instants]+(1-psi[:,instants])*stimulusB[:,instants]
+    lambdaB[:,instants] = psi[:,instants]*stimulusB[:,instants]+(1-psi[:,instants])*stimulusA[:,instants]
+    if profiler is not None:
+        profiler.lap('regulatoryPsi', t0)
+        profiler.count('extrinsicDraws', nTrials*nSteps)
+    
+    return lambdaA, lambdaB, psi
+
+
+# ## Trajectory recorder
+
+# In[ ]:
+
+
+#export
+
+class Recorder:
+# Decides what the integrators keep of a trajectory. The integrators call start once, record at
+# every instant i (i = 0, ..., last) with the state there, and finish once with the last instant.
+# variables: state variables to keep, indices or names of STATE_VARIABLE_NAMES (all by default),
+#            e.g. Recorder(['v_eA', 'v_eB'])
+# decimation: only the instants i multiple of decimation are kept, the last instant always is
+# summary: if True, no trajectory is kept, only the summary (final state, decision time and running 
+#          max of |v_eA-v_eB|) 
+# callback: optional function callback(t, x) called at each kept instant, x being the kept variables
+#           (also in summary mode, for streaming)
+# fileName: if given, the trajectory is written in this .npy file (memory-mapped) instead of memory,
+#           the rows after the last instant being NaN
+# For an ensemble of trials (states of shape (18, nTrials)), the kept rows have the shape (nTrials, nVariables).
+# The trajectory is kept in float32 if the state is float32 (reduced precision ensembles), in float64 otherwise.
+
+    def __init__(self, variables=None, decimation=1, summary=False, callback=None, fileName=None):
+        if variables is None:
+            variables = range(len(STATE_VARIABLE_NAMES))
+        self.variables = np.array([STATE_VARIABLE_NAMES.index(v) if isinstance(v, str) else int(v) for v in variables])
+        self.decimation = int(decimation)
+        self.summary = summary
+        self.callback = callback
+        self.fileName = fileName
+
+    def start(self, nSteps, dt, x0):
+        x0 = np.asarray(x0)
+        x0 = x0.astype(np.float32 if x0.dtype == np.float32 else np.float64, copy=False)
+        self.dt = dt
+        self.nRows = 0
+        self.maxDiff = np.zeros(x0.shape[1:])
+        self.X = None
+        if not self.summary:
+            shape = (nSteps//self.decimation+2,)+x0.shape[1:]+(self.variables.size,)
+            if self.fileName is None:
+                self.X = np.empty(shape, dtype=x0.dtype)
+            else:
+                self.X = np.lib.format.open_memmap(self.fileName, mode='w+', dtype=x0.dtype, shape=shape)
+                self.X[:] = np.nan
+            self.t = np.empty(shape[0])
+        self.record(0, x0)
+
+    def record(self, i, x):
+        self.maxDiff = np.maximum(self.maxDiff, np.abs(x[0]-x[7]))
+        self.last, self.lastState = i, x
+        if i % self.decimation == 0:
+            self._keep(i, x)
+
+    def _keep(self, i, x):
+        row = np.moveaxis(x[self.variables], 0, -1)
+        if not self.summary:
+            self.X[self.nRows] = row
+            self.t[self.nRows] = i*self.dt
+            self.nRows += 1
+        self.lastKept = i
+        if self.callback is not None:
+            self.callback(i*self.dt, row)
+
+    def finish(self, i, decisionTime=None):
+        if self.lastKept != i:
+            self._keep(i, self.lastState)
+        self.decisionTime = decisionTime
+        if self.fileName is not None and self.X is not None:
+            self.X.flush()
+
+    def result(self):
+    # Returns a dict with the kept instants 't' and states 'X' (None in summary mode, X having the
+    # shape (nKept, nVariables), or (nTrials, nKept, nVariables) for an ensemble), the 'variables' names,
+    # the 'finalTime' and 'finalState', the 'decisionTime' and 'maxDiff', the running max of |v_eA-v_eB|.
+        X, t = None, None
+        if not self.summary:
+            t = self.t[:self.nRows]
+            X = self.X if self.fileName is not None else self.X[:self.nRows]
+            if X.ndim == 3:
+                X = np.moveaxis(X, 0, 1)
+        return {'t': t, 'X': X, 'variables': [STATE_VARIABLE_NAMES[k] for k in self.variables],
+                'finalTime': self.last*self.dt, 'finalState': np.moveaxis(np.asarray(self.lastState), 0, -1).copy(),
+                'decisionTime': self.decisionTime, 'maxDiff': self.maxDiff}
 
 
 # ## Euler-Maruyama scheme with all modules
@@ -60,11 +263,16 @@ def RegulatoryPsi(psi0, stimulusA, stimulusB, params):
 
 #export
 
-def TimeStepping(V0, lambdaA, lambdaB, TF1, TF2, params): 
+def TimeStepping(V0, lambdaA, lambdaB, TF1, TF2, params, rng=None, recorder=None, profiler=None): 
 # V0: initial conditions for the state variables
 # lambdaA, lambdaB: regulated stimuli
 # TF1, TF2: transfer functions of RS and FS cells, respectively
-# params: paramaters
+# params: paramaters, a ModelParameters record or the parameter vector (see DiffOperator.MODEL_PARAMETER_NAMES)
+# rng: random generator of the intrinsic noise (np.random.Generator or NoiseStreams.TrialNoise, see IntrinsicNoise),
+#      the global np.random state by default
+# recorder: optional Recorder, TimeStepping then returns recorder.result() instead of the whole trajectory X
+# profiler: optional Instrumentation.Profiler, which records the steps, the noise draws and, through
+#           DifferentialOperator, the TF evaluations and the time of each block (a trial is opened if none is)
 
 # Glossary
     
@@ -113,16 +321,24 @@ def TimeStepping(V0, lambdaA, lambdaB, TF1, TF2, params):
 # dt = params[23]
 
     # Set parameters and initialize the state variables    
-    sigma = params[13]    
-    tF    = params[22]
-    dt    = params[23]
-    T     = params[24] 
+    params = MakeModelParameters(params) # converted once for the whole trial
+    sigma = params.sigma
+    tF    = params.tF
+    dt    = params.dt
+    T     = params.T
     
-    X = np.zeros((int(tF/dt)+1, np.size(V0)))
-    X[0,:] = V0       
+    x = np.array(V0, dtype=float) # state at the current instant
+    record = Recorder() if recorder is None else recorder # the whole trajectory by default
+    record.start(int(tF/dt), dt, x)
+    ownTrial = profiler is not None and profiler.openTrial()
     
     # Integrate in time via Euler-Maruyama scheme    
-    intrinsicNoise = np.random.normal(0, 1, size=(int(tF/dt), 4)) # generate the intrinsic noise
+    if profiler is not None:
+        t0 = profiler.now()
+    intrinsicNoise = IntrinsicNoise(rng, int(tF/dt)) # generate the intrinsic noise
+    if profiler is not None:
+        profiler.lap('noise', t0)
+        profiler.count('intrinsicDraws', 4*int(tF/dt))
     
     exc_aff_A = lambdaA
     exc_aff_B = lambdaB
@@ -132,9 +348,481 @@ def TimeStepping(V0, lambdaA, lambdaB, TF1, TF2, params):
     # Integrate in time!
     for i in range(int(tF/dt)):        
         
-        X[i+1,:] = X[i,:] + dt*DifferentialOperator(X[i,:], TF1, TF2, params, exc_aff_A[i],                                                exc_aff_B[i], inh_aff_A[i], inh_aff_B[i])
-        X[i+1,0:2] = X[i+1, 0:2] + (1/T)*np.sqrt(dt)*sigma*intrinsicNoise[i,0:2]
-        X[i+1,7:9] = X[i+1, 7:9] + (1/T)*np.sqrt(dt)*sigma*intrinsicNoise[i,2:4]
+        x = x + dt*DifferentialOperator(x, TF1, TF2, params, exc_aff_A[i], \
+                                        exc_aff_B[i], inh_aff_A[i], inh_aff_B[i], profiler=profiler)
+        x[0:2] = x[0:2] + (1/T)*np.sqrt(dt)*sigma*intrinsicNoise[i,0:2]
+        x[7:9] = x[7:9] + (1/T)*np.sqrt(dt)*sigma*intrinsicNoise[i,2:4]
+        record.record(i+1, x)
+        if profiler is not None:
+            profiler.count('steps')
+    record.finish(int(tF/dt))
+    if ownTrial:
+        profiler.endTrial()
+    
+    return record.result()['X'] if recorder is None else record.result()
+
+
+
+# ## Euler-Maruyama scheme for an ensemble of trials
+
+# In[ ]:
+
+
+#export
+
+def TimeSteppingEnsemble(V0, lambdaA, lambdaB, TF1, TF2, params, rng=None, recorder=None, profiler=None,
+                         dtype=np.float64):
+# Integrates nTrials independent trials at once: the state of shape (18, nTrials) is advanced
+# with a single vectorized DifferentialOperator call per time step.
+# V0: initial conditions, (18,) shared by all trials or (nTrials, 18)
+# lambdaA, lambdaB: regulated stimuli, (nTrials, int(tF/dt)+1), e.g. from RegulatoryPsiEnsemble
+# TF1, TF2: transfer functions of RS and FS cells, respectively
+# params: paramaters, a ModelParameters record or the parameter vector
+# rng: random generator of the intrinsic noise, or a list of nTrials generators. With a list,
+#      trial k draws its noise from rng[k] exactly as TimeStepping(..., rng=rng[k]) would.
+# recorder: optional Recorder, recorder.result() is then returned instead of X
+# profiler: optional Instrumentation.Profiler, as for TimeStepping (the whole ensemble being one trial)
+# dtype: np.float64, or np.float32 for the reduced precision mode (see ValidatePrecision below)
+# Returns X of shape (nTrials, int(tF/dt)+1, 18), X[k] being the trajectory of trial k.
+
+    params = MakeModelParameters(params)
+    sigma  = params.sigma
+    dt     = params.dt
+    T      = params.T
+    nSteps = params.nSteps
+    
+    exc_aff_A = np.atleast_2d(np.asarray(lambdaA, dtype=dtype))
+    exc_aff_B = np.atleast_2d(np.asarray(lambdaB, dtype=dtype))
+    nTrials = max(exc_aff_A.shape[0], exc_aff_B.shape[0], np.atleast_2d(V0).shape[0])
+    exc_aff_A = np.broadcast_to(exc_aff_A, (nTrials, exc_aff_A.shape[1]))
+    exc_aff_B = np.broadcast_to(exc_aff_B, (nTrials, exc_aff_B.shape[1]))
+    inh_aff_A = exc_aff_A # regulated stimuli are provided to both populations, as in TimeStepping
+    inh_aff_B = exc_aff_B
+    
+    state = np.array(np.broadcast_to(V0, (nTrials, 18)), dtype=dtype).T.copy() # (18, nTrials)
+    record = Recorder() if recorder is None else recorder
+    record.start(nSteps, dt, state)
+    ownTrial = profiler is not None and profiler.openTrial()
+    
+    # Intrinsic noise of every trial, intrinsicNoise[k] being the (nSteps, 4) block of trial k
+    if profiler is not None:
+        t0 = profiler.now()
+    intrinsicNoise = EnsembleNoiseAs(EnsembleIntrinsicNoise(rng, nTrials, nSteps), dtype)
+    noiseAmplitude = (1/T)*np.sqrt(dt)*sigma
+    if profiler is not None:
+        profiler.lap('noise', t0)
+        profiler.count('intrinsicDraws', 4*nTrials*nSteps)
+    
+    # Integrate in time!
+    for i in range(nSteps):
+        
+        state = state + dt*DifferentialOperator(state, TF1, TF2, params, exc_aff_A[:,i], \
+                                                exc_aff_B[:,i], inh_aff_A[:,i], inh_aff_B[:,i],
+                                                profiler=profiler).astype(dtype, copy=False)
+        state[0:2] = state[0:2] + noiseAmplitude*intrinsicNoise[:,i,0:2].T
+        state[7:9] = state[7:9] + noiseAmplitude*intrinsicNoise[:,i,2:4].T
+        record.record(i+1, state)
+        if profiler is not None:
+            profiler.count('steps')
+    record.finish(nSteps)
+    if ownTrial:
+        profiler.endTrial()
+    
+    return record.result()['X'] if recorder is None else record.result()
+
+
+# ## Integration until the decision
+
+# In[ ]:
+
+
+#export
+
+def TimeSteppingToDecision(V0, lambdaA, lambdaB, TF1, TF2, params, decisionThreshold=None, tWarmUp=2., 
+                           stopCallback=None, psi=None, rng=None, recorder=None, profiler=None):
+# Same scheme as TimeStepping, stopped as soon as the decision is made.
+# decisionThreshold: the decision is made once |v_eA-v_eB| exceeds this value
+# tWarmUp: the criterion is only checked from int(tWarmUp/dt) on (the activity is degenerate at the beginning)
+# stopCallback: optional function stopCallback(t, X_i) returning True to stop at time t, state X_i
+# psi: optional psi trace of the trial (from RegulatoryPsi)
+# The instants are checked exactly as the search diff[int(2/dt):-1] of the notebook, and the noise
+# block is the same as in TimeStepping, so that the result matches a full integration followed by the search.
+# Returns X (the trajectory up to the decision, X[-1] being the final state), the decision time
+# measured from tWarmUp (None if no decision is made) and psi[-1] used in the reward update (None without psi).
+# recorder: optional Recorder, recorder.result() is then returned instead of X, e.g. Recorder(summary=True)
+#           when only the decision matters
+# profiler: optional Instrumentation.Profiler, as for TimeStepping
+
+    params = MakeModelParameters(params)
+    sigma  = params.sigma
+    dt     = params.dt
+    T      = params.T
+    nSteps = params.nSteps
+    iWarmUp = int(tWarmUp/dt)
+    
+    x = np.array(V0, dtype=float)
+    record = Recorder() if recorder is None else recorder
+    record.start(nSteps, dt, x)
+    ownTrial = profiler is not None and profiler.openTrial()
+    
+    if profiler is not None:
+        t0 = profiler.now()
+    intrinsicNoise = IntrinsicNoise(rng, nSteps) # generate the intrinsic noise
+    if profiler is not None:
+        profiler.lap('noise', t0)
+        profiler.count('intrinsicDraws', 4*nSteps)
+    
+    exc_aff_A = lambdaA
+    exc_aff_B = lambdaB
+    inh_aff_A = exc_aff_A # regulated stimuli are provided to both populations, as in TimeStepping
+    inh_aff_B = exc_aff_B
+    
+    decisionTime = None
+    for i in range(nSteps+1):
+        
+        # Check the decision (the last instant is not checked, as in the notebook)
+        if i >= iWarmUp and i < nSteps:
+            if (decisionThreshold is not None and np.abs(x[0]-x[7]) > decisionThreshold) or \
+               (stopCallback is not None and stopCallback(i*dt, x)):
+                decisionTime = (i-iWarmUp)*dt
+                break
+        if i == nSteps:
+            break
+        
+        x = x + dt*DifferentialOperator(x, TF1, TF2, params, exc_aff_A[i], \
+                                        exc_aff_B[i], inh_aff_A[i], inh_aff_B[i], profiler=profiler)
+        x[0:2] = x[0:2] + (1/T)*np.sqrt(dt)*sigma*intrinsicNoise[i,0:2]
+        x[7:9] = x[7:9] + (1/T)*np.sqrt(dt)*sigma*intrinsicNoise[i,2:4]
+        record.record(i+1, x)
+        if profiler is not None:
+            profiler.count('steps')
+    record.finish(i, decisionTime)
+    if ownTrial:
+        profiler.endTrial()
+    
+    psiFinal = None if psi is None else psi[-1]
+    
+    return record.result()['X'] if recorder is None else record.result(), decisionTime, psiFinal
+
+
+def TimeSteppingEnsembleToDecision(V0, lambdaA, lambdaB, TF1, TF2, params, decisionThreshold=None, tWarmUp=2.,
+                                   stopCallback=None, psi=None, rng=None, profiler=None, dtype=np.float64):
+# Same as TimeSteppingToDecision for an ensemble of trials (see TimeSteppingEnsemble for the shapes).
+# The trials which have made their decision are masked out, only the others are integrated further.
+# stopCallback: optional function stopCallback(t, X_i) with X_i of shape (nActive, 18), returning
+#               a boolean array, True for the trials to stop
+# Returns X of shape (nTrials, int(tF/dt)+1, 18), NaN after the stop of each trial, the final 
+# states (nTrials, 18), the decision times (NaN if no decision is made) and psi[:,-1] (None without psi).
+# profiler, dtype: as for TimeSteppingEnsemble
+
+    params = MakeModelParameters(params)
+    sigma  = params.sigma
+    dt     = params.dt
+    T      = params.T
+    nSteps = params.nSteps
+    iWarmUp = int(tWarmUp/dt)
+    
+    exc_aff_A = np.atleast_2d(np.asarray(lambdaA, dtype=dtype))
+    exc_aff_B = np.atleast_2d(np.asarray(lambdaB, dtype=dtype))
+    nTrials = max(exc_aff_A.shape[0], exc_aff_B.shape[0], np.atleast_2d(V0).shape[0])
+    exc_aff_A = np.broadcast_to(exc_aff_A, (nTrials, exc_aff_A.shape[1]))
+    exc_aff_B = np.broadcast_to(exc_aff_B, (nTrials, exc_aff_B.shape[1]))
+    inh_aff_A = exc_aff_A
+    inh_aff_B = exc_aff_B
+    
+    ownTrial = profiler is not None and profiler.openTrial()
+    if profiler is not None:
+        t0 = profiler.now()
+    intrinsicNoise = EnsembleNoiseAs(EnsembleIntrinsicNoise(rng, nTrials, nSteps), dtype)
+    noiseAmplitude = (1/T)*np.sqrt(dt)*sigma
+    if profiler is not None:
+        profiler.lap('noise', t0)
+        profiler.count('intrinsicDraws', 4*nTrials*nSteps)
+    
+    # allocated after the noise, whose float64 draws are released once converted to dtype
+    X = np.full((nTrials, nSteps+1, 18), np.nan, dtype=dtype)
+    X[:,0,:] = V0
+    finalState = X[:,0,:].copy()
+    
+    decisionTime = np.full(nTrials, np.nan)
+    active = np.arange(nTrials) # trials still integrated
+    state = X[:,0,:].T.copy()   # (18, nActive)
+    for i in range(nSteps+1):
+        
+        # Check the decisions (the last instant is not checked, as in the notebook)
+        if i >= iWarmUp and i < nSteps:
+            stop = np.zeros(active.size, dtype=bool)
+            if decisionThreshold is not None:
+                stop |= np.abs(state[0]-state[7]) > decisionThreshold
+            if stopCallback is not None:
+                stop |= np.asarray(stopCallback(i*dt, state.T), dtype=bool)
+            if stop.any():
+                decisionTime[active[stop]] = (i-iWarmUp)*dt
+                finalState[active[stop]] = state[:,stop].T
+                active, state = active[~stop], state[:,~stop]
+        if i == nSteps or active.size == 0:
+            break
+        
+        state = state + dt*DifferentialOperator(state, TF1, TF2, params, exc_aff_A[active,i], \
+                                                exc_aff_B[active,i], inh_aff_A[active,i], inh_aff_B[active,i],
+                                                profiler=profiler).astype(dtype, copy=False)
+        state[0:2] = state[0:2] + noiseAmplitude*intrinsicNoise[active,i,0:2].T
+        state[7:9] = state[7:9] + noiseAmplitude*intrinsicNoise[active,i,2:4].T
+        X[active,i+1,:] = state.T
+        if profiler is not None:
+            profiler.count('steps')
+    
+    finalState[active] = state.T
+    if ownTrial:
+        profiler.endTrial()
+    psiFinal = None if psi is None else np.atleast_2d(psi)[:,-1]
+    
+    return X, finalState, decisionTime, psiFinal
+
+
+# ## Higher-order and adaptive-step schemes
+
+# In[ ]:
+
+
+#export
+
+# The noise is additive (it only enters v_e, v_i of both columns), so a step of size h=m*dt from 
+# the instant i*dt reads x + (drift part) + the noise increment accumulated over the m base steps.
+# The noise is always drawn on the base grid dt as in TimeStepping, hence all the schemes below 
+# follow the same Brownian path as TimeStepping for a given rng, whatever their step sizes, and a 
+# rejected step of the adaptive scheme is retried with the same path (no bias from rejections).
+
+# A step function Step(Rhs, x, i, m, dt, noise) returns the new state at (i+m)*dt and a lower order
+# estimate of it used for the error control (None if the scheme has no embedded estimate).
+# Rhs(x, i) is the drift at state x and instant i*dt, noise the additive noise increment.
+
+def EulerMaruyamaStep(Rhs, x, i, m, dt, noise):
+    return x + m*dt*Rhs(x, i) + noise, None
+
+
+def StochasticHeunStep(Rhs, x, i, m, dt, noise):
+    # predictor-corrector scheme (strong order 1 for additive noise), Euler-Maruyama is the embedded
+    # estimate: the noise cancels in their difference, which estimates the local error of the drift
+    h = m*dt
+    f0 = Rhs(x, i)
+    xEuler = x + h*f0 + noise
+    f1 = Rhs(xEuler, i+m)
+    return x + 0.5*h*(f0+f1) + noise, xEuler
+
+
+# The implicit-explicit (IMEX) schemes split the drift as L*x + N(x), L being the diagonal of the
+# linear decay terms Rhs.decay (see DiffOperator.LinearDecayRates: -2/T for the covariances, -1/tauwRS
+# and -1 for the adaptations), and treat L*x implicitly and N(x) = Rhs(x) - L*x explicitly. Since L is
+# diagonal, the implicit part is a division and costs no more than an explicit step, and the decay
+# terms no longer bound the step size.
+
+def IMEXEulerStep(Rhs, x, i, m, dt, noise):
+    # semi-implicit Euler, x' = (x + h*N(x) + noise)/(1 - h*L), explicit Euler is the embedded estimate
+    h = m*dt
+    L = Rhs.decay
+    f0 = Rhs(x, i)
+    return (x + h*(f0-L*x) + noise)/(1-h*L), x + h*f0 + noise
+
+
+def IMEXHeunStep(Rhs, x, i, m, dt, noise):
+    # trapezoidal rule for L*x and stochastic Heun for N(x), the semi-implicit Euler predictor being
+    # the embedded estimate
+    h = m*dt
+    L = Rhs.decay
+    f0 = Rhs(x, i)
+    N0 = f0-L*x
+    xPredictor = (x + h*N0 + noise)/(1-h*L)
+    N1 = Rhs(xPredictor, i+m)-L*xPredictor
+    return (x + 0.5*h*L*x + 0.5*h*(N0+N1) + noise)/(1-0.5*h*L), xPredictor
+
+
+# The linearly implicit Euler scheme treats the whole drift implicitly, linearized at x with the Jacobian
+# Rhs.jacobian(x, i) (see DiffOperator.Jacobian), x' = x + h*(I - h*J)^-1 Rhs(x) + noise. It also damps
+# the stiff modes which do not come from the decay terms (the dependence of the rates on the transfer
+# functions), at the cost of a Jacobian (one batched call of 36 states) and an 18x18 solve per step.
+# The adaptation variables are kept explicit (their columns of J are dropped): near their initial 1e-10
+# the transfer functions are so nonlinear in W that its linearization would stall the adaptation and
+# collapse the rates as soon as the step is a few dt.
+
+def LinearlyImplicitEulerStep(Rhs, x, i, m, dt, noise):
+    # explicit Euler is the embedded estimate
+    h = m*dt
+    f0 = Rhs(x, i)
+    J = Rhs.jacobian(x, i)
+    J[:,list(ADAPTATION_VARIABLES)] = 0.
+    return x + h*np.linalg.solve(np.eye(x.size)-h*J, f0) + noise, x + h*f0 + noise
+
+
+SDE_SCHEMES = {'euler': EulerMaruyamaStep, 'heun': StochasticHeunStep, 'imex': IMEXEulerStep, 'imex-heun': IMEXHeunStep,
+               'linearly-implicit': LinearlyImplicitEulerStep}
+
+
+def _SchemeSetup(V0, lambdaA, lambdaB, TF1, TF2, params, rng):
+    # Drift, noise and counters shared by TimeSteppingScheme and TimeSteppingAdaptive
+    params = MakeModelParameters(params)
+    nSteps = params.nSteps
+    
+    intrinsicNoise = IntrinsicNoise(rng, nSteps) # same noise as in TimeStepping
+    noiseAmplitude = (1/params.T)*np.sqrt(params.dt)*params.sigma
+    
+    exc_aff_A = lambdaA
+    exc_aff_B = lambdaB
+    inh_aff_A = exc_aff_A # regulated stimuli are provided to both populations, as in TimeStepping
+    inh_aff_B = exc_aff_B
+    counter = {'TF': 0, 'steps': 0}
+    
+    def Rhs(x, i):
+        return DifferentialOperator(x, TF1, TF2, params, exc_aff_A[i], exc_aff_B[i], \
+                                    inh_aff_A[i], inh_aff_B[i], counter=counter)
+    Rhs.decay = LinearDecayRates(params) # for the IMEX schemes
+    Rhs.jacobian = lambda x, i: NumericalJacobian(lambda X: Rhs(X, i), x) # for the linearly implicit scheme
+    
+    def Noise(i, m):
+        # additive noise increment over the base steps i, ..., i+m-1
+        noise = np.zeros(np.size(V0))
+        increment = intrinsicNoise[i] if m == 1 else intrinsicNoise[i:i+m].sum(axis=0)
+        noise[0:2] = noiseAmplitude*increment[0:2]
+        noise[7:9] = noiseAmplitude*increment[2:4]
+        return noise
+    
+    return params, Rhs, Noise, counter
+
+
+def TimeSteppingScheme(V0, lambdaA, lambdaB, TF1, TF2, params, scheme='heun', stride=1, rng=None):
+# Fixed-step integration with a given scheme and the step stride*dt.
+# scheme: a name of SDE_SCHEMES or a step function (see above)
+# stride: number of base steps dt per step, the step size is stride*dt
+# Other arguments as in TimeStepping; scheme='euler' with stride=1 reproduces TimeStepping.
+# Returns t, X (the instants and the states there) and stats, a dict with the numbers of accepted
+# and rejected steps, of DifferentialOperator calls ('rhs') and of transfer function evaluations ('TF').
+
+    Step = SDE_SCHEMES[scheme] if isinstance(scheme, str) else scheme
+    params, Rhs, Noise, counter = _SchemeSetup(V0, lambdaA, lambdaB, TF1, TF2, params, rng)
+    dt, nSteps = params.dt, params.nSteps
+    
+    index = list(range(0, nSteps, stride)) + [nSteps]
+    X = np.zeros((len(index), np.size(V0)))
+    X[0,:] = V0
+    for k in range(len(index)-1):
+        i, m = index[k], index[k+1]-index[k]
+        X[k+1,:] = Step(Rhs, X[k,:], i, m, dt, Noise(i, m))[0]
+    
+    stats = {'accepted': len(index)-1, 'rejected': 0, 'rhs': counter['steps'], 'TF': counter['TF']}
+    
+    return np.array(index)*dt, X, stats
+
+
+def TimeSteppingAdaptive(V0, lambdaA, lambdaB, TF1, TF2, params, rtol=1e-3, atol=1e-6, maxStride=64, 
+                         scheme='heun', rng=None):
+# Adaptive-step integration with error control. The steps are multiples m*dt of the base step, m being
+# halved when a step is rejected and doubled (up to maxStride) when the error is small enough.
+# rtol, atol: relative and absolute tolerances, atol can be an array (18,) since the variables have 
+#             very different scales (e.g. W is small in SI units)
+# scheme: a scheme with an embedded estimate, 'heun' by default
+# The error of a step is max|x-xLow|/(atol+rtol*max(|x_i|,|x|)), a step is accepted if it is <= 1 
+# (a step of one base step dt is always accepted).
+# Returns t, X (the accepted instants and the states there) and stats, as in TimeSteppingScheme.
+
+    Step = SDE_SCHEMES[scheme] if isinstance(scheme, str) else scheme
+    params, Rhs, Noise, counter = _SchemeSetup(V0, lambdaA, lambdaB, TF1, TF2, params, rng)
+    dt, nSteps = params.dt, params.nSteps
+    
+    x = np.array(V0, dtype=float)
+    t, X = [0.], [x]
+    accepted, rejected = 0, 0
+    i, m = 0, 1
+    while i < nSteps:
+        
+        m = min(m, nSteps-i)
+        xNew, xLow = Step(Rhs, x, i, m, dt, Noise(i, m))
+        error = np.max(np.abs(xNew-xLow)/(atol+rtol*np.maximum(np.abs(x), np.abs(xNew))))
+        
+        if error <= 1 or m == 1:
+            accepted += 1
+            i, x = i+m, xNew
+            t.append(i*dt)
+            X.append(x)
+            if error < 0.2: # the local error of the embedded estimate grows as the step squared
+                m = min(2*m, maxStride)
+        else:
+            rejected += 1
+            m = max(m//2, 1)
+    
+    stats = {'accepted': accepted, 'rejected': rejected, 'rhs': counter['steps'], 'TF': counter['TF']}
     
-    return X
+    return np.array(t), np.array(X), stats
+
+
+def DecisionTime(t, X, decisionThreshold, tWarmUp=2.):
+# Decision time of a trajectory sampled at the instants t (e.g. from TimeSteppingAdaptive): the first
+# instant from tWarmUp on, the last one excluded, where |v_eA-v_eB| exceeds decisionThreshold, measured
+# from tWarmUp as in the notebook. Returns None if no decision is made.
+    t, X = np.asarray(t), np.asarray(X)
+    check = np.where((t[:-1] >= tWarmUp-1e-9) & (np.abs(X[:-1,0]-X[:-1,7]) > decisionThreshold))[0]
+    return None if check.size == 0 else t[check[0]]-tWarmUp
 
+
+# ## Reduced precision ensembles
+
+# In[ ]:
+
+
+#export
+
+# With dtype=np.float32, RegulatoryPsiEnsemble, TimeSteppingEnsemble and TimeSteppingEnsembleToDecision
+# keep the states, trajectories, stimuli, psi and noise in float32, which halves the memory of a batch
+# (twice as many trials per node), and the work is done in float32 too: the TF jets (muV and sV, see
+# theoretical_tools._TF_jet_array32) and the rates and adaptation of DifferentialOperator. The precision-
+# sensitive pieces get mixed precision: TvN, the threshold polynomial and the erfc tail are computed in
+# float64 by the jet kernel, and the covariances are accumulated in float64 by DifferentialOperator, only
+# being rounded to float32 when stored. With 16384 trials, a right-hand side takes about half the time
+# of float64 (8 ms instead of 17 ms on one core) and a whole ensemble about two thirds of it.
+# ValidatePrecision is the guardrail of this mode: it runs a reference batch in both precisions on the
+# same noise draws and compares the decision times and the psi outcomes (psi[-1] > 0.5, which decides
+# the reward in DecisionSession).
+
+def ValidatePrecision(V0, stimulusA, stimulusB, TF1, TF2, params, decisionThreshold, nTrials=64, psi0=0.5,
+                      tWarmUp=2., seed=0, timeTolerance=None, maxMismatch=0.02, dtype=np.float32):
+# V0, stimulusA, stimulusB, params, decisionThreshold, tWarmUp: as for RegulatoryPsiEnsemble and
+#                                                                TimeSteppingEnsembleToDecision
+# nTrials, psi0, seed: the reference batch, its initial psi and the seed of its noise
+# timeTolerance: decision times closer than this agree (2*dt by default)
+# maxMismatch: largest fraction of trials whose decision times may disagree (a trial close to the
+#              threshold can cross it one step earlier or later); the psi outcomes must all agree
+# dtype: the reduced precision to be validated
+# Returns a dict with the 'decisionTime' and 'psiFinal' of both precisions (float64 first), the largest
+# decision time difference 'maxTimeError', the fractions 'timeMismatch', 'psiMismatch' and 'winnerMismatch'
+# (v_eA > v_eB at the decision), the 'seconds' and 'bytes' (trajectories, stimuli and psi) of both runs
+# and 'passed'.
+    params = MakeModelParameters(params)
+    timeTolerance = 2*params.dt if timeTolerance is None else timeTolerance
+    results = []
+    for precision in (np.float64, dtype):
+        rng = np.random.default_rng(seed) # same draws in both precisions
+        lambdaA, lambdaB, psi = RegulatoryPsiEnsemble(np.full(nTrials, psi0), stimulusA, stimulusB, params,
+                                                      rng=rng, dtype=precision)
+        TimeSteppingEnsembleToDecision(V0, lambdaA[:2,:2], lambdaB[:2,:2], TF1, TF2, 
+                                       MakeModelParameters(params, tF=params.dt),
+                                       rng=np.random.default_rng(seed), dtype=precision) # compilation
+        t0 = time.perf_counter()
+        X, finalState, decisionTime, psiFinal = TimeSteppingEnsembleToDecision(V0, lambdaA, lambdaB, TF1, TF2, params,
+                                                                               decisionThreshold, tWarmUp, psi=psi,
+                                                                               rng=rng, dtype=precision)
+        results.append({'seconds': time.perf_counter()-t0, 'bytes': X.nbytes+lambdaA.nbytes+lambdaB.nbytes+psi.nbytes,
+                        'decisionTime': decisionTime, 'psiFinal': psiFinal, 'winner': finalState[:,0] > finalState[:,7]})
+    reference, reduced = results
+    
+    decided = np.isfinite(reference['decisionTime'])
+    sameDecided = decided == np.isfinite(reduced['decisionTime'])
+    timeError = np.abs(reference['decisionTime']-reduced['decisionTime'])
+    maxTimeError = np.max(timeError[decided & sameDecided], initial=0.)
+    timeMismatch = np.mean(~sameDecided | (timeError > timeTolerance))
+    psiMismatch = np.mean((reference['psiFinal'] > 0.5) != (reduced['psiFinal'] > 0.5))
+    winnerMismatch = np.sum((reference['winner'] != reduced['winner'])[decided & sameDecided])/max(1, nTrials)
+    return {'decisionTime': (reference['decisionTime'], reduced['decisionTime']),
+            'psiFinal': (reference['psiFinal'], reduced['psiFinal']),
+            'maxTimeError': maxTimeError, 'timeMismatch': timeMismatch, 'psiMismatch': psiMismatch,
+            'winnerMismatch': winnerMismatch,
+            'seconds': (reference['seconds'], reduced['seconds']), 'bytes': (reference['bytes'], reduced['bytes']),
+            'passed': bool(timeMismatch <= maxMismatch and psiMismatch == 0)}
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Launcher of the decision-making sessions
+
+# In[ ]:
+
+
+#export
+
+# Initialization
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from DiffOperator import MakeModelParameters, MODEL_PARAMETER_NAMES, NOTEBOOK_PARAMETERS, NOTEBOOK_V0, NotebookParameters
+from SDEIntegrator import TimeStepping
+from NeuronConnectivity import LoadTransferFunctions
+from DecisionSession import DIFFICULTY_SET, GAIN, SweepJobs, RunSweep, StimulusProfile
+from ResultsStore import ResultsStore
+
+
+# ## Configuration of a run
+
+# In[ ]:
+
+
+#export
+
+# A run is described by a JSON file whose entries replace those of DEFAULT_CONFIG, e.g.
+#   {"horizon": 1, "k": [0.05, 0.1], "c0": 1.0, "iterations": 10, "episodes": 100,
+#    "tF": 15, "store": "simulationResults"}
+# units      : parameter set of the notebook, 'non-SI' or 'SI'
+# parameters : changes of the parameter set, by name (see DiffOperator.MODEL_PARAMETER_NAMES)
+# dt, tF     : time step and final time of the trials (those of the parameter set if null)
+# horizon, difficultySet, gain, decisionThreshold: the task (see DecisionSession.RunSession)
+# warmStart  : start the trials from the pre-stimulus attractor reached from V0 (see DecisionSession.RunSession)
+# k, c0      : learning speeds and decay rates, a value or a list of values (the sweep is their grid)
+# iterations, episodes: sessions per (k, c0) pair and episodes per session
+# store, saveDirectory, checkpointDirectory: where the results go (see DecisionSession.RunSweep), null for none
+# workers    : worker processes (all the cores if null, 0 for this process only)
+# seed, noiseSession: random streams of the sessions (see DecisionSession.IterSweep)
+# cells      : arguments of LoadTransferFunctions
+
+DEFAULT_CONFIG = {'units': 'non-SI', 'parameters': {}, 'dt': None, 'tF': None,
+                  'horizon': 0, 'difficultySet': DIFFICULTY_SET, 'gain': GAIN, 'decisionThreshold': 5,
+                  'warmStart': False, 'k': [0.1], 'c0': [1.0], 'iterations': 1, 'episodes': 5,
+                  'store': 'simulationResults', 'saveDirectory': None, 'checkpointDirectory': None,
+                  'workers': None, 'seed': None, 'noiseSession': None, 'cells': ['RS-cell', 'FS-cell', 'CONFIG1']}
+
+
+def MakeConfig(config=None, **changes):
+    # Complete configuration from a partial one (dict) and changes, checked
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    config.update(changes)
+    unknown = set(config)-set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError("Unknown configuration entries %s" % sorted(unknown))
+    unknown = set(config['parameters'])-set(MODEL_PARAMETER_NAMES)
+    if unknown:
+        raise ValueError("Unknown parameters %s" % sorted(unknown))
+    if config['horizon'] not in (0, 1):
+        raise ValueError("Invalid horizon number! Choose either 0 or 1.")
+    config['k'] = np.atleast_1d(config['k']).tolist()
+    config['c0'] = np.atleast_1d(config['c0']).tolist()
+    return config
+
+
+def LoadConfig(fileName, **changes):
+    with open(fileName) as f:
+        return MakeConfig(json.load(f), **changes)
+
+
+def ConfigParameters(config):
+    # ModelParameters record of a configuration
+    changes = dict(config['parameters'])
+    for name in ('dt', 'tF'):
+        if config[name] is not None:
+            changes[name] = config[name]
+    return NotebookParameters(config['units'], **changes)
+
+
+def ConfigJobs(config):
+    # Jobs (k, c0, iteration) of a configuration, as run by DecisionSession.RunSweep
+    return SweepJobs(config['k'], config['c0'], config['iterations'])
+
+
+# ## Dry run
+
+# In[ ]:
+
+
+#export
+
+# The cost of a run is bounded by its number of integration steps: each trial integrates the regulatory
+# mechanism over the nSteps of [0, tF] and the mean-field system at most as long (it stops at the
+# decision). The time of a step is measured on a short trial of the configuration, and the wall time
+# is the time of all the steps shared by the workers (an upper bound, the decisions stopping the trials
+# earlier).
+
+def EstimateCost(config, calibrationSteps=100, TF1=None, TF2=None):
+    # Returns a dict with the numbers of jobs, trials and integration steps of the run, the measured
+    # time of a step and the estimated wall time (seconds)
+    params = ConfigParameters(config)
+    jobs = ConfigJobs(config)
+    nTrials = len(jobs)*config['episodes']*(config['horizon']+1)
+    nWorkers = config['workers'] if config['workers'] is not None else os.cpu_count()
+    parallel = max(1, min(nWorkers or 1, len(jobs)))
+    if TF1 is None:
+        TF1, TF2 = LoadTransferFunctions(*config['cells'])
+    short = MakeModelParameters(params, tF=calibrationSteps*params.dt)
+    stimulus = StimulusProfile(short)
+    TimeStepping(NOTEBOOK_V0, stimulus, stimulus, TF1, TF2, short, rng=np.random.default_rng(0)) # compilation
+    t0 = time.perf_counter()
+    TimeStepping(NOTEBOOK_V0, stimulus, stimulus, TF1, TF2, short, rng=np.random.default_rng(0))
+    secondsPerStep = (time.perf_counter()-t0)/short.nSteps
+    maxSteps = nTrials*params.nSteps
+    return {'jobs': len(jobs), 'sessions': len(jobs), 'trials': nTrials, 'stepsPerTrial': params.nSteps,
+            'maxSteps': maxSteps, 'secondsPerStep': secondsPerStep, 'workers': parallel,
+            'wallTime': maxSteps*secondsPerStep/parallel}
+
+
+def FormatCost(cost):
+    return ('%(jobs)d sessions, %(trials)d trials of at most %(stepsPerTrial)d steps: at most %(maxSteps)d steps\n'
+            '%(secondsPerStep).3g s per step on %(workers)d worker(s): at most %(wallTime).4g s' % cost)
+
+
+# ## Run
+
+# In[ ]:
+
+
+#export
+
+def RunConfig(config, verbose=True):
+    # Runs the sweep of a configuration, returns the dict job -> result of DecisionSession.RunSweep
+    config = MakeConfig(config)
+    store = None if config['store'] is None else ResultsStore(config['store'])
+    for directory in (config['saveDirectory'], config['checkpointDirectory']):
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+    def PrintProgress(job, result):
+        if verbose:
+            print("Done: learning speed %g, c0 %g, iteration %d" % job)
+            for episodeNo in np.where(result['performance'] == -1)[0]:
+                print("Episode %1.0i is not valid!" % episodeNo)
+    return RunSweep(ConfigParameters(config), NOTEBOOK_V0, config['horizon'], config['episodes'], config['k'],
+                    config['c0'], config['iterations'], config['decisionThreshold'], nWorkers=config['workers'],
+                    seed=config['seed'], cells=tuple(config['cells']), callback=PrintProgress,
+                    saveDirectory=config['saveDirectory'], store=store,
+                    checkpointDirectory=config['checkpointDirectory'], noiseSession=config['noiseSession'],
+                    difficultySet=config['difficultySet'], gain=config['gain'], warmStart=config['warmStart'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the decision-making sessions described by a JSON configuration "
+                                                 "(see SessionLauncher.DEFAULT_CONFIG)")
+    parser.add_argument('config', nargs='?', help="configuration file (the default configuration if omitted)")
+    parser.add_argument('--workers', type=int, help="worker processes (0: this process only)")
+    parser.add_argument('--dry-run', action='store_true', help="print the jobs and the estimated cost, run nothing")
+    parser.add_argument('--print-config', action='store_true', help="print the complete configuration and exit")
+    args = parser.parse_args(argv)
+
+    changes = {} if args.workers is None else {'workers': args.workers}
+    try:
+        config = LoadConfig(args.config, **changes) if args.config else MakeConfig(**changes)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.print_config:
+        print(json.dumps(config, indent=1))
+        return 0
+    if args.dry_run:
+        for job in ConfigJobs(config):
+            print("Job: learning speed %g, c0 %g, iteration %d" % job)
+        print(FormatCost(EstimateCost(config)))
+        return 0
+    RunConfig(config)
+    print('Simulation is over.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,85 +3,66 @@ Some configuration of neuronal properties so that we pick up
 within this file
 """
 from __future__ import print_function
-
-def get_neuron_params(NAME, name='', number=1, SI_units=False):
-
-    if NAME=='LIF':
-        params = {'name':name, 'N':number,\
-                  'Gl':10., 'Cm':150.,'Trefrac':5.,\
-                  'El':-60., 'Vthre':-50., 'Vreset':-60., 'delta_v':0.,\
-                  'a':0., 'b': 0., 'tauw':1e9}
-    elif NAME=='EIF':
-        params = {'name':name, 'N':number,\
-                  'Gl':10., 'Cm':150.,'Trefrac':5.,\
-                  'El':-60., 'Vthre':-50., 'Vreset':-60., 'delta_v':2.,\
-                  'a':0., 'b':0., 'tauw':1e9}
-    elif NAME=='AdExp':
-        params = {'name':name, 'N':number,\
-                  'Gl':10., 'Cm':150.,'Trefrac':5.,\
-                  'El':-60., 'Vthre':-50., 'Vreset':-60., 'delta_v':2.,\
-                  'a':4., 'b':20., 'tauw':500.}
-
-    elif NAME=='FS-cell':
-        params = {'name':name, 'N':number,\
-                  'Gl':10., 'Cm':200.,'Trefrac':5,\
-                  'El':-65., 'Vthre':-50., 'Vreset':-65., 'delta_v':0.5,'ampnoise':0.,\
-                  'a':0., 'b': 0., 'tauw':1e9}
-    elif NAME=='RS-cell':
-        params = {'name':name, 'N':number,\
-                  'Gl':10., 'Cm':200.,'Trefrac':5,\
-                  'El':-65., 'Vthre':-50., 'Vreset':-65., 'delta_v':2.,'ampnoise':0.,\
-                  'a':4., 'b':40., 'tauw':5000.}
-
-    elif NAME=='RS-cellbis':
-        params = {'name':name, 'N':number,\
-                'Gl':10., 'Cm':200.,'Trefrac':5,\
+from collections import namedtuple
+from types import MappingProxyType
+
+# registry of the cells: their parameters in the units of the file (mV, ms, nS, pF, pA)
+CELLS = {
+    'LIF': {'Gl':10., 'Cm':150.,'Trefrac':5.,\
+            'El':-60., 'Vthre':-50., 'Vreset':-60., 'delta_v':0.,\
+            'a':0., 'b': 0., 'tauw':1e9},
+    'EIF': {'Gl':10., 'Cm':150.,'Trefrac':5.,\
+            'El':-60., 'Vthre':-50., 'Vreset':-60., 'delta_v':2.,\
+            'a':0., 'b':0., 'tauw':1e9},
+    'AdExp': {'Gl':10., 'Cm':150.,'Trefrac':5.,\
+              'El':-60., 'Vthre':-50., 'Vreset':-60., 'delta_v':2.,\
+              'a':4., 'b':20., 'tauw':500.},
+    'FS-cell': {'Gl':10., 'Cm':200.,'Trefrac':5,\
+                'El':-65., 'Vthre':-50., 'Vreset':-65., 'delta_v':0.5,'ampnoise':0.,\
+                'a':0., 'b': 0., 'tauw':1e9},
+    'RS-cell': {'Gl':10., 'Cm':200.,'Trefrac':5,\
                 'El':-65., 'Vthre':-50., 'Vreset':-65., 'delta_v':2.,'ampnoise':0.,\
-                'a':0., 'b':100., 'tauw':500.}
-
-
-
-
-    elif NAME=='RS-cell_UD':
-        params = {'name':name, 'N':number,\
-            'Gl':10., 'Cm':200.,'Trefrac':5,\
-                'El':-63., 'Vthre':-50., 'Vreset':-65., 'delta_v':2,'ampnoise':0.,\
-                    'a':0., 'b':40., 'tauw':500.}
-
-
-
-    elif NAME=='RS-cell_Try':
-        params = {'name':name, 'N':number,\
-            'Gl':10., 'Cm':200.,'Trefrac':5,\
-            'El':-58.73, 'Vthre':-50., 'Vreset':-58.73, 'delta_v':2,'ampnoise':0.,\
-                'a':0., 'b':0., 'tauw':500.}
-
-
-    else:
-        print('====================================================')
-        print('------------ CELL NOT RECOGNIZED !! ---------------')
-        print('====================================================')
-
-
-
-
+                'a':4., 'b':40., 'tauw':5000.},
+    'RS-cellbis': {'Gl':10., 'Cm':200.,'Trefrac':5,\
+                   'El':-65., 'Vthre':-50., 'Vreset':-65., 'delta_v':2.,'ampnoise':0.,\
+                   'a':0., 'b':100., 'tauw':500.},
+    'RS-cell_UD': {'Gl':10., 'Cm':200.,'Trefrac':5,\
+                   'El':-63., 'Vthre':-50., 'Vreset':-65., 'delta_v':2,'ampnoise':0.,\
+                   'a':0., 'b':40., 'tauw':500.},
+    'RS-cell_Try': {'Gl':10., 'Cm':200.,'Trefrac':5,\
+                    'El':-58.73, 'Vthre':-50., 'Vreset':-58.73, 'delta_v':2,'ampnoise':0.,\
+                    'a':0., 'b':0., 'tauw':500.},
+}
+
+# factors to SI units: mV to V, ms to s, nS to S, pF to F and pA to A
+SI_FACTORS = {'El':1e-3, 'Vthre':1e-3, 'Vreset':1e-3, 'delta_v':1e-3, 'Trefrac':1e-3, 'tauw':1e-3,
+              'a':1e-9, 'Gl':1e-9, 'Cm':1e-12, 'b':1e-12}
+
+# frozen record of a cell, with its (read-only) parameters in the units of the file and in SI units
+CellConfig = namedtuple('CellConfig', ('NAME', 'params', 'params_SI'))
+
+def _cell_config(NAME, params):
+    params_SI = dict((key, SI_FACTORS[key]*value if key in SI_FACTORS else value) for key, value in params.items())
+    return CellConfig(NAME, MappingProxyType(dict(params)), MappingProxyType(params_SI))
+
+CELL_REGISTRY = dict((NAME, _cell_config(NAME, params)) for NAME, params in CELLS.items())
+
+def get_cell_config(NAME):
+    if NAME not in CELL_REGISTRY:
+        raise ValueError('cell %s not recognized, the known cells are %s' % (NAME, sorted(CELL_REGISTRY)))
+    return CELL_REGISTRY[NAME]
 
+def get_neuron_params(NAME, name='', number=1, SI_units=False):
 
+    config = get_cell_config(NAME)
+    params = {'name':name, 'N':number}
     if SI_units:
-        #print('cell parameters in SI units')
-        # mV to V
-        params['El'], params['Vthre'], params['Vreset'], params['delta_v'] =\
-            1e-3*params['El'], 1e-3*params['Vthre'], 1e-3*params['Vreset'], 1e-3*params['delta_v']
-        # ms to s
-        params['Trefrac'], params['tauw'] = 1e-3*params['Trefrac'], 1e-3*params['tauw']
-        # nS to S
-        params['a'], params['Gl'] = 1e-9*params['a'], 1e-9*params['Gl']
-        # pF to F and pA to A
-        params['Cm'], params['b'] = 1e-12*params['Cm'], 1e-12*params['b']
+        params.update(config.params_SI)
     else:
+        params.update(config.params)
         print('cell parameters --NOT-- in SI units')
-        
-    return params.copy()
+
+    return params
 
 if __name__=='__main__':
 
@@ -3,108 +3,74 @@ Some configuration of neuronal properties so that we pick up
 within this file
 """
 from __future__ import print_function
+from collections import namedtuple
+from types import MappingProxyType
 import numpy as np
 
 
+# registry of the networks: the synapses of the excitatory and inhibitory populations (mV, ms, nS) and
+# the network information stored in the first element of the matrix
+NETWORKS = {
+    'Vogels-Abbott': ({'p_conn':0.02, 'Q':7., 'Tsyn':5., 'Erev':0.},
+                      {'p_conn':0.02, 'Q':67., 'Tsyn':10., 'Erev':-80.},
+                      {'Ntot':5000, 'gei':0.2}),
+    'CONFIG1': ({'p_conn':0.05, 'Q':1.5, 'Tsyn':5., 'Erev':0., 'p_conn_cross':0.025,\
+                 'cross_weight_onE': 0.01, 'cross_weight_onI': 0.01, 'coeffCrossCov': 1},
+                {'p_conn':0.05, 'Q':5., 'Tsyn':5., 'Erev':-80., 'p_conn_cross':0.025,\
+                 'cross_weight_onE': 0.01, 'cross_weight_onI': 0.01, 'coeffCrossCov': 1},
+                {'Ntot':10000, 'gei':0.2, 'ext_drive':3., 'afferent_exc_fraction':1.}),
+    'CONFIG1000': ({'p_conn':0.00005, 'Q':1.5, 'Tsyn':5., 'Erev':0.},
+                   {'p_conn':0.00005, 'Q':5., 'Tsyn':5., 'Erev':-80.},
+                   {'Ntot':10000000, 'gei':0.2, 'ext_drive':0., 'afferent_exc_fraction':1.}),
+    #ext=0+ Qe=3...up and down
+    'CONFIG1_UD_N': ({'p_conn':0.0005, 'Q':1., 'Tsyn':5., 'Erev':0.},
+                     {'p_conn':0.0005, 'Q':3., 'Tsyn':5., 'Erev':-80.},
+                     {'Ntot':10000, 'gei':0.2, 'ext_drive':0., 'afferent_exc_fraction':1.}),
+    'CONFIG1_UD': ({'p_conn':0.05, 'Q':1.5, 'Tsyn':5., 'Erev':0.},
+                   {'p_conn':0.05, 'Q':5., 'Tsyn':5., 'Erev':-80.},
+                   {'Ntot':10000, 'gei':0.2, 'ext_drive':0., 'afferent_exc_fraction':1.}),
+    'CONFIG2': ({'p_conn':0.05, 'Q':2., 'Tsyn':5., 'Erev':0.},
+                {'p_conn':0.05, 'Q':6., 'Tsyn':5., 'Erev':-80.},
+                {'Ntot':10000, 'gei':0.2, 'ext_drive':0., 'afferent_exc_fraction':1.}),
+}
+
+# factors to SI units: nS to S, mV to V, ms to s
+SI_FACTORS = {'Q':1e-9, 'Erev':1e-3, 'Tsyn':1e-3}
+
+# frozen record of a network: the (read-only) synapses of the excitatory and inhibitory populations in
+# the units of the file and in SI units, and the network information
+NetworkConfig = namedtuple('NetworkConfig', ('NAME', 'exc_pop', 'inh_pop', 'exc_pop_SI', 'inh_pop_SI', 'network'))
+
+def _SI(pop):
+    return MappingProxyType(dict((key, value*SI_FACTORS[key] if key in SI_FACTORS else value) for key, value in pop.items()))
+
+def _network_config(NAME, exc_pop, inh_pop, network):
+    return NetworkConfig(NAME, MappingProxyType(dict(exc_pop)), MappingProxyType(dict(inh_pop)),
+                         _SI(exc_pop), _SI(inh_pop), MappingProxyType(dict(network)))
+
+NETWORK_REGISTRY = dict((NAME, _network_config(NAME, *config)) for NAME, config in NETWORKS.items())
+
+def get_network_config(NAME):
+    if NAME not in NETWORK_REGISTRY:
+        raise ValueError('network %s not recognized, the known networks are %s' % (NAME, sorted(NETWORK_REGISTRY)))
+    return NETWORK_REGISTRY[NAME]
+
 def get_connectivity_and_synapses_matrix(NAME, number=2, SI_units=False):
 
+    config = get_network_config(NAME)
+    exc_pop, inh_pop = (config.exc_pop_SI, config.inh_pop_SI) if SI_units else (config.exc_pop, config.inh_pop)
 
     # creating empty arry of objects (future dictionnaries)
     M = np.empty((number, number), dtype=object)
+    M[:,0] = [dict(exc_pop), dict(inh_pop)] # post-synaptic : exc
+    M[:,1] = [dict(exc_pop), dict(inh_pop)] # post-synaptic : inh
+    M[0,0]['name'], M[1,0]['name'] = 'ee', 'ie'
+    M[0,1]['name'], M[1,1]['name'] = 'ei', 'ii'
+
+    # in the first element we put the network number and connectivity information
+    M[0,0].update(config.network)
 
-    if NAME=='Vogels-Abbott':
-        exc_pop = {'p_conn':0.02, 'Q':7., 'Tsyn':5., 'Erev':0.}
-        inh_pop = {'p_conn':0.02, 'Q':67., 'Tsyn':10., 'Erev':-80.}
-        M[:,0] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : exc
-        M[:,1] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : inh
-        M[0,0]['name'], M[1,0]['name'] = 'ee', 'ie'
-        M[0,1]['name'], M[1,1]['name'] = 'ei', 'ii'
-
-        # in the first element we put the network number and connectivity information
-        M[0,0]['Ntot'], M[0,0]['gei'] = 5000, 0.2
-        
-    elif NAME=='CONFIG1':
-        exc_pop = {'p_conn':0.05, 'Q':1.5, 'Tsyn':5., 'Erev':0., 'p_conn_cross':0.025,\
-                   'cross_weight_onE': 0.01, 'cross_weight_onI': 0.01, 'coeffCrossCov': 1}
-        inh_pop = {'p_conn':0.05, 'Q':5., 'Tsyn':5., 'Erev':-80., 'p_conn_cross':0.025,\
-                   'cross_weight_onE': 0.01, 'cross_weight_onI': 0.01, 'coeffCrossCov': 1}
-        M[:,0] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : exc
-        M[:,1] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : inh
-        M[0,0]['name'], M[1,0]['name'] = 'ee', 'ie'
-        M[0,1]['name'], M[1,1]['name'] = 'ei', 'ii'
-    
-        # in the first element we put the network number and connectivity information
-        M[0,0]['Ntot'], M[0,0]['gei'] = 10000, 0.2
-        M[0,0]['ext_drive'] = 3. # we also store here the choosen excitatory drive
-        M[0,0]['afferent_exc_fraction'] = 1. # we also store here the choosen excitatory drive
-    
-    elif NAME=='CONFIG1000':
-        exc_pop = {'p_conn':0.00005, 'Q':1.5, 'Tsyn':5., 'Erev':0.}
-        inh_pop = {'p_conn':0.00005, 'Q':5., 'Tsyn':5., 'Erev':-80.}
-        M[:,0] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : exc
-        M[:,1] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : inh
-        M[0,0]['name'], M[1,0]['name'] = 'ee', 'ie'
-        M[0,1]['name'], M[1,1]['name'] = 'ei', 'ii'
-        
-        # in the first element we put the network number and connectivity information
-        M[0,0]['Ntot'], M[0,0]['gei'] = 10000000, 0.2
-        M[0,0]['ext_drive'] = 0. # we also store here the choosen excitatory drive
-        M[0,0]['afferent_exc_fraction'] = 1. # we also store here the choosen excitatory drive
-
-
-        #ext=0+ Qe=3...up and down
-    elif NAME=='CONFIG1_UD_N':
-        exc_pop = {'p_conn':0.0005, 'Q':1., 'Tsyn':5., 'Erev':0.}
-        inh_pop = {'p_conn':0.0005, 'Q':3., 'Tsyn':5., 'Erev':-80.}
-        M[:,0] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : exc
-        M[:,1] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : inh
-        M[0,0]['name'], M[1,0]['name'] = 'ee', 'ie'
-        M[0,1]['name'], M[1,1]['name'] = 'ei', 'ii'
-        
-        # in the first element we put the network number and connectivity information
-        M[0,0]['Ntot'], M[0,0]['gei'] = 10000, 0.2
-        M[0,0]['ext_drive'] = 0. # we also store here the choosen excitatory drive
-        M[0,0]['afferent_exc_fraction'] = 1. # we also store here the choosen excitatory drive
-
-    elif NAME=='CONFIG1_UD':
-        exc_pop = {'p_conn':0.05, 'Q':1.5, 'Tsyn':5., 'Erev':0.}
-        inh_pop = {'p_conn':0.05, 'Q':5., 'Tsyn':5., 'Erev':-80.}
-        M[:,0] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : exc
-        M[:,1] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : inh
-        M[0,0]['name'], M[1,0]['name'] = 'ee', 'ie'
-        M[0,1]['name'], M[1,1]['name'] = 'ei', 'ii'
-        
-        # in the first element we put the network number and connectivity information
-        M[0,0]['Ntot'], M[0,0]['gei'] = 10000, 0.2
-        M[0,0]['ext_drive'] = 0. # we also store here the choosen excitatory drive
-        M[0,0]['afferent_exc_fraction'] = 1. # we also store here the choosen excitatory drive
-    
-    elif NAME=='CONFIG2':
-        exc_pop = {'p_conn':0.05, 'Q':2., 'Tsyn':5., 'Erev':0.}
-        inh_pop = {'p_conn':0.05, 'Q':6., 'Tsyn':5., 'Erev':-80.}
-        M[:,0] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : exc
-        M[:,1] = [exc_pop.copy(), inh_pop.copy()] # post-synaptic : inh
-        M[0,0]['name'], M[1,0]['name'] = 'ee', 'ie'
-        M[0,1]['name'], M[1,1]['name'] = 'ei', 'ii'
-        
-        # in the first element we put the network number and connectivity information
-        M[0,0]['Ntot'], M[0,0]['gei'] = 10000, 0.2
-        M[0,0]['ext_drive'] = 0. # we also store here the choosen excitatory drive
-        M[0,0]['afferent_exc_fraction'] = 1. # we also store here the choosen excitatory drive
-        
-        
-    else:
-        print('====================================================')
-        print('------------ NETWORK NOT RECOGNIZED !! ---------------')
-        print('====================================================')
-
-    if SI_units:
-        #print('synaptic network parameters in SI units')
-        for m in M.flatten():
-            m['Q'] *= 1e-9
-            m['Erev'] *= 1e-3
-            m['Tsyn'] *= 1e-3
-    else:
+    if not SI_units:
         print('synaptic network parameters --NOT-- in SI units')
 
     return M
@@ -119,4 +85,3 @@ if __name__=='__main__':
     #print(M[:,0])
     #print('synapses of the inh. pop. (pop. 1) : M[:,1]')
     #print(M[:,1])
-    
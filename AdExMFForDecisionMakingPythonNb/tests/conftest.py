@@ -0,0 +1,24 @@
+# The modules of the notebook are imported by their names (import DiffOperator, ...), as in MainNotebook.ipynb
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NeuronConnectivity import LoadTransferFunctions
+
+
+@pytest.fixture(scope='session')
+def transferFunctions():
+    return LoadTransferFunctions('RS-cell', 'FS-cell', 'CONFIG1')
+
+
+@pytest.fixture(scope='session')
+def withoutJet():
+    # The same transfer function without its analytic jet: its derivatives are taken by central differences
+    def WithoutJet(TF):
+        def plain(fe, fi, XX):
+            return TF(fe, fi, XX)
+        return plain
+    return WithoutJet
@@ -0,0 +1,131 @@
+# Checks of the tools around the model: benchmarks, profiler, fixed points and continuation.
+# Run them from AdExMFForDecisionMakingPythonNb with: python -m pytest -q tests
+
+import numpy as np
+import pytest
+
+from Benchmarks import RunBenchmarks, CompareBenchmarks, LoadBenchmarks, BASELINE_FILE
+from Instrumentation import Profiler
+from SDEIntegrator import TimeStepping
+from SessionLauncher import NotebookParameters, NOTEBOOK_V0
+from DecisionSession import StimulusProfile, RunSession
+import Continuation
+from Continuation import ContinueBranch, ParameterRhs
+from FixedPoints import FindFixedPoint, FixedPoint, WarmStart, SteadyRhs, ADAPTATION_VARIABLES
+
+
+# ## Benchmarks
+
+def test_benchmarks_count_and_compare():
+    names = ['TF_scalar', 'TF_vectorized', 'DifferentialOperator', 'RegulatoryPsi']
+    results = RunBenchmarks(names, repeat=1, minTime=0.)
+    assert sorted(results['benchmarks']) == sorted(names)
+    for result in results['benchmarks'].values():
+        assert result['time'] > 0 and result['peakMemory'] > 0
+    # the transfer function calls are deterministic, and those of the baseline
+    baseline = LoadBenchmarks(BASELINE_FILE)
+    for name in names:
+        for metric in ('TFCalls', 'TFPoints'):
+            assert results['benchmarks'][name][metric] == baseline['benchmarks'][name][metric]
+    # a slower run is a regression, other TF calls are a change
+    slower = {'benchmarks': {name: dict(result) for name, result in results['benchmarks'].items()}}
+    slower['benchmarks']['TF_scalar']['time'] *= 2
+    slower['benchmarks']['DifferentialOperator']['TFCalls'] += 1
+    status = {(row['benchmark'], row['metric']): row['status'] for row in CompareBenchmarks(slower, results)}
+    assert status[('TF_scalar', 'time')] == 'regression' and status[('TF_scalar', 'TFCalls')] == 'ok'
+    assert status[('DifferentialOperator', 'TFCalls')] == 'changed'
+    assert status[('RegulatoryPsi', 'time')] == 'ok'
+
+
+# ## Profiler
+
+def test_profiler_counts_without_changing_the_trial(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=0.5)
+    stimulus = StimulusProfile(params)
+    profiler = Profiler()
+    profiler.startSession(label='test')
+    for trial in range(2):
+        profiler.startTrial(trial=trial)
+        X = TimeStepping(NOTEBOOK_V0, stimulus, stimulus, TF1, TF2, params, rng=np.random.default_rng(trial),
+                         profiler=profiler)
+        np.testing.assert_array_equal(X, TimeStepping(NOTEBOOK_V0, stimulus, stimulus, TF1, TF2, params,
+                                                      rng=np.random.default_rng(trial)))
+    profiler.endTrial()
+    report = profiler.report()
+    assert len(report['sessions']) == 1 and report['sessions'][0]['labels'] == {'label': 'test'}
+    trials = report['sessions'][0]['trials']
+    assert [t['labels'] for t in trials] == [{'trial': 0}, {'trial': 1}]
+    for t in trials:
+        assert t['counts']['steps'] == t['counts']['rhsCalls'] == params.nSteps
+        assert t['counts']['intrinsicDraws'] == 4*params.nSteps
+        assert set(t['times']) >= {'TF1', 'TF2', 'noise'} and t['wallTime'] >= sum(t['times'].values())
+    assert report['total']['trials'] == 2
+    assert report['total']['counts']['steps'] == 2*params.nSteps
+    assert 'steps' in profiler.summary()
+
+
+# ## Fixed points
+
+def test_fixed_points(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters()
+    Rhs = SteadyRhs(TF1, TF2, params)
+    steady = FindFixedPoint(TF1, TF2, params)
+    assert steady['converged'] and steady['stable']
+    assert np.all(np.abs(Rhs(steady['V'])) < 1e-9*(1+np.abs(steady['V'])))
+    # frozen adaptation: the adaptation variables keep their initial values, the others are steady
+    frozen = FindFixedPoint(TF1, TF2, params, adaptation='frozen')
+    fast = np.setdiff1d(np.arange(18), ADAPTATION_VARIABLES)
+    assert frozen['converged'] and len(frozen['eigenvalues']) == fast.size
+    np.testing.assert_array_equal(frozen['V'][list(ADAPTATION_VARIABLES)], np.array(NOTEBOOK_V0)[list(ADAPTATION_VARIABLES)])
+    assert np.all(np.abs(Rhs(frozen['V'])[fast]) < 1e-9*(1+np.abs(frozen['V'][fast])))
+    # cached, and the warm start is the stable fixed point reached from V0
+    assert FixedPoint(TF1, TF2, params) is FixedPoint(TF1, TF2, params)
+    np.testing.assert_allclose(WarmStart(TF1, TF2, params), steady['V'], rtol=1e-12)
+
+
+def test_session_warm_start(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=1.)
+    V0 = WarmStart(TF1, TF2, params, NOTEBOOK_V0)
+    warm = RunSession(params, TF1, TF2, NOTEBOOK_V0, 0, 2, 0.1, rng=np.random.default_rng(5), warmStart=True)
+    explicit = RunSession(params, TF1, TF2, V0, 0, 2, 0.1, rng=np.random.default_rng(5))
+    for name in warm:
+        np.testing.assert_array_equal(warm[name], explicit[name])
+
+
+# ## Continuation
+
+def NormalFormRhs(TF1, TF2, params, parameter, stimuli=(0., 0.)):
+    # Stands for Continuation.ParameterRhs: a fold of x0' = p-x0**2 at p=0 and a Hopf point of the
+    # pair (x1, x2) at p=1, the other variables decaying
+    def Rhs(V, p):
+        V = np.asarray(V, dtype=float)
+        x0, x1, x2 = V[0], V[1], V[2]
+        r2 = x1**2+x2**2
+        res = -V.copy()
+        res[0] = p-x0**2
+        res[1] = (p-1)*x1-x2-x1*r2
+        res[2] = x1+(p-1)*x2-x2*r2
+        return res
+    return Rhs
+
+
+def test_continuation_finds_the_fold_and_the_hopf_points(monkeypatch):
+    monkeypatch.setattr(Continuation, 'ParameterRhs', NormalFormRhs)
+    start = np.zeros(18)
+    start[0] = np.sqrt(2.)
+    # from p=2 down around the fold at p=0, then up along the lower branch x0 = -sqrt(p)
+    branch = ContinueBranch(None, None, NotebookParameters(), 'vAI', (-1., 3.), direction=-1, start=(start, 2.),
+                            dsMax=0.1)
+    points = branch['points']
+    assert [point['type'] for point in points] == ['hopf', 'fold', 'hopf']
+    np.testing.assert_allclose([point['value'] for point in points], [1., 0., 1.], atol=1e-2)
+    assert branch['V'][-1][0] < 0 and branch['values'][-1] > 1.
+    assert not branch['stable'][-1]
+
+
+def test_continuation_parameters():
+    with pytest.raises(ValueError):
+        ParameterRhs(None, None, NotebookParameters(), 'unknown')
@@ -0,0 +1,235 @@
+# Checks of the integrators: ensembles, regulatory mechanism, early stop, higher-order schemes, recorder
+# and reduced precision. Run them from AdExMFForDecisionMakingPythonNb with: python -m pytest -q tests
+
+import numpy as np
+import pytest
+
+from DiffOperator import MakeModelParameters
+from SDEIntegrator import RegulatoryPsi, RegulatoryPsiEnsemble, TimeStepping, TimeSteppingEnsemble
+from SDEIntegrator import TimeSteppingToDecision, TimeSteppingEnsembleToDecision
+from SDEIntegrator import TimeSteppingScheme, TimeSteppingAdaptive, DecisionTime, Recorder, ValidatePrecision
+from SessionLauncher import NotebookParameters, NOTEBOOK_V0
+from DecisionSession import StimulusProfile
+
+
+def Stimuli(params, nTrials, seed=0):
+    # constant stimuli of nTrials trials, (nTrials, nSteps+1) each
+    rng = np.random.default_rng(seed)
+    amplitudes = rng.uniform(2., 8., (2, nTrials, 1))
+    return np.broadcast_to(amplitudes, (2, nTrials, params.nSteps+1))
+
+
+# ## Ensembles
+
+def test_ensemble_reproduces_each_trial(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=1.)
+    lambdaA, lambdaB = Stimuli(params, 4)
+    V0 = np.asarray(NOTEBOOK_V0, dtype=float)*np.random.default_rng(1).uniform(0.9, 1.1, (4, 18))
+    X = TimeSteppingEnsemble(V0, lambdaA, lambdaB, TF1, TF2, params, rng=[np.random.default_rng(k) for k in range(4)])
+    assert X.shape == (4, params.nSteps+1, 18)
+    for k in range(4):
+        np.testing.assert_array_equal(X[k], TimeStepping(V0[k], lambdaA[k], lambdaB[k], TF1, TF2, params,
+                                                         rng=np.random.default_rng(k)))
+
+
+# ## Regulatory mechanism
+
+def NotebookRegulatoryPsi(psi0, stimulusA, stimulusB, params):
+    # RegulatoryPsi of the original notebook, one scalar draw per step from the global random state
+    tF, dt, tauPsi, sigma_r, c0 = params.tF, params.dt, params.tauPsi, params.sigma_r, params.c0
+    psi = np.zeros(int(tF/dt)+1)
+    psi[0] = psi0
+    lambdaA = np.zeros(int(tF/dt)+1)
+    lambdaB = np.zeros(int(tF/dt)+1)
+    lambdaA[0] = psi[0]*stimulusA[0]+(1-psi[0])*stimulusB[0]
+    lambdaB[0] = psi[0]*stimulusB[0]+(1-psi[0])*stimulusA[0]
+    t = np.linspace(0, tF, int(tF/dt)+1)
+    for i in range(int(tF/dt)):
+        psi[i+1] = psi[i]+(dt/tauPsi)*(-4*psi[i])*(psi[i]-0.5)*(psi[i]-1)+ \
+                   (1/(t[i+1]*c0)**2)*np.sqrt(dt)*sigma_r*np.random.normal(0, 1)/tauPsi
+    lambdaA[i+1] = psi[i+1]*stimulusA[i+1]+(1-psi[i+1])*stimulusB[i+1]
+    lambdaB[i+1] = psi[i+1]*stimulusB[i+1]+(1-psi[i+1])*stimulusA[i+1]
+    return lambdaA, lambdaB, psi
+
+
+def test_regulatory_psi_matches_the_notebook():
+    params = NotebookParameters(c0=0.3)
+    t = np.linspace(0, params.tF, params.nSteps+1)
+    stimulusA, stimulusB = 8.*(t > 2.), 6.*(t > 2.)
+    state = np.random.get_state()
+    try:
+        np.random.seed(4)
+        reference = NotebookRegulatoryPsi(0.5, stimulusA, stimulusB, params)
+        np.random.seed(4)
+        blocks = RegulatoryPsi(0.5, stimulusA, stimulusB, params, legacyStimuli=True)
+        np.random.seed(4)
+        lambdaA, lambdaB, psi = RegulatoryPsi(0.5, stimulusA, stimulusB, params)
+    finally:
+        np.random.set_state(state)
+    for x, y in zip(blocks, reference):
+        np.testing.assert_array_equal(x, y)
+    # the regulated stimuli are applied along the whole trial, from the same psi
+    np.testing.assert_array_equal(psi, reference[2])
+    np.testing.assert_array_equal(lambdaA, psi*stimulusA+(1-psi)*stimulusB)
+    np.testing.assert_array_equal(lambdaB, psi*stimulusB+(1-psi)*stimulusA)
+
+
+def test_regulatory_psi_ensemble_reproduces_each_trial():
+    params = NotebookParameters(c0=0.3)
+    psi0, c0 = np.array([0.2, 0.5, 0.7]), np.array([0.3, 0.5, 1.])
+    stimulusA, stimulusB = Stimuli(params, 3)
+    for legacyStimuli in (False, True):
+        ensemble = RegulatoryPsiEnsemble(psi0, stimulusA, stimulusB, params, c0=c0,
+                                         rng=[np.random.default_rng(k) for k in range(3)], legacyStimuli=legacyStimuli)
+        for k in range(3):
+            serial = RegulatoryPsi(psi0[k], stimulusA[k], stimulusB[k], MakeModelParameters(params, c0=c0[k]),
+                                   rng=np.random.default_rng(k), legacyStimuli=legacyStimuli)
+            for x, y in zip(ensemble, serial):
+                np.testing.assert_array_equal(x[k], y)
+
+
+# ## Early stop
+
+def NotebookDecisionTime(X, decisionThreshold, tWarmUp, dt):
+    # search of the notebook in a full trajectory: diff[int(tWarmUp/dt):-1], measured from tWarmUp
+    diff = np.abs(X[:,0]-X[:,7])
+    check = np.where(diff[int(tWarmUp/dt):-1] > decisionThreshold)[0]
+    return None if check.size == 0 else check[0]*dt
+
+
+@pytest.mark.parametrize('decisionThreshold', [0.09, 0.3, 1.])
+def test_early_stop_matches_the_full_trajectory(transferFunctions, decisionThreshold):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=3.)
+    profile = StimulusProfile(params, t0=0.)
+    stimuli, decisionTimes = [], []
+    for seed in range(3):
+        lambdaA, lambdaB, psi = RegulatoryPsi(0.5, 8*profile, 6*profile, params, rng=np.random.default_rng(seed))
+        full = TimeStepping(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, rng=np.random.default_rng(seed))
+        X, decisionTime, psiFinal = TimeSteppingToDecision(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params,
+                                                           decisionThreshold, tWarmUp=0.2, psi=psi,
+                                                           rng=np.random.default_rng(seed))
+        reference = NotebookDecisionTime(full, decisionThreshold, 0.2, params.dt)
+        assert decisionTime == reference and psiFinal == psi[-1]
+        # the trajectory is that of the full integration, up to the decision
+        np.testing.assert_array_equal(X, full[:len(X)])
+        stimuli.append((lambdaA, lambdaB))
+        decisionTimes.append(np.nan if reference is None else reference)
+    # and so are the decision times of the ensemble
+    lambdaA, lambdaB = np.array(stimuli).transpose(1, 0, 2)
+    ensemble = TimeSteppingEnsembleToDecision(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, decisionThreshold,
+                                              tWarmUp=0.2, rng=[np.random.default_rng(seed) for seed in range(3)])
+    np.testing.assert_array_equal(ensemble[2], decisionTimes)
+
+
+# ## Higher-order and adaptive schemes
+
+def test_schemes_follow_the_same_brownian_path(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=2., dt=0.01)
+    profile = StimulusProfile(params, t0=0.)
+    lambdaA, lambdaB, psi = RegulatoryPsi(0.5, 8*profile, 6*profile, params, rng=np.random.default_rng(0))
+    def Scheme(scheme, stride):
+        return TimeSteppingScheme(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, scheme, stride,
+                                  rng=np.random.default_rng(0))
+    # Euler-Maruyama with the base step is TimeStepping
+    t, X, stats = Scheme('euler', 1)
+    np.testing.assert_array_equal(X, TimeStepping(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params,
+                                                  rng=np.random.default_rng(0)))
+    assert stats['accepted'] == stats['rhs'] == params.nSteps and stats['TF'] == 5*params.nSteps
+    # on the same path, Heun with 4 base steps per step is closer to the fine solution than Euler
+    scale = np.abs(X).max(axis=0)+1e-12
+    errors = {scheme: np.max(np.abs(Scheme(scheme, 4)[1]-X[::4])/scale) for scheme in ('euler', 'heun')}
+    assert errors['heun'] < errors['euler']/2
+    # the adaptive steps end at tF, near the fine Heun solution
+    XHeun = Scheme('heun', 1)[1]
+    t, XAdaptive, stats = TimeSteppingAdaptive(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params,
+                                               rng=np.random.default_rng(0))
+    assert t[-1] == pytest.approx(params.tF) and len(t) == stats['accepted']+1
+    assert stats['rhs'] == 2*(stats['accepted']+stats['rejected']) and stats['accepted'] < params.nSteps
+    assert np.max(np.abs(XAdaptive[-1]-XHeun[-1])/scale) < 1e-3
+    assert DecisionTime(np.arange(params.nSteps+1)*params.dt, X, 0.09, 0.2) == \
+           NotebookDecisionTime(X, 0.09, 0.2, params.dt)
+
+
+def test_implicit_explicit_schemes_converge(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=2., dt=0.01)
+    profile = StimulusProfile(params, t0=0.)
+    lambdaA, lambdaB, psi = RegulatoryPsi(0.5, 8*profile, 6*profile, params, rng=np.random.default_rng(0))
+    def Scheme(scheme, stride):
+        return TimeSteppingScheme(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, scheme, stride,
+                                  rng=np.random.default_rng(0))[1]
+    X = Scheme('heun', 1)
+    scale = np.abs(X).max(axis=0)+1e-12
+    errors = {scheme: [np.max(np.abs(Scheme(scheme, stride)-X[::stride])/scale) for stride in (1, 2, 4)]
+              for scheme in ('imex', 'imex-heun', 'linearly-implicit')}
+    for scheme, error in errors.items():
+        assert error[0] < error[1] < error[2] < 0.1, scheme
+    # the trapezoidal IMEX scheme is second order in the drift, as Heun
+    assert errors['imex-heun'][0] < 1e-4 and errors['imex-heun'][2] < errors['imex'][2]/2
+
+
+# ## Recorder
+
+def test_recorder_keeps_the_selected_instants_and_variables(transferFunctions, tmp_path):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=3.)
+    profile = StimulusProfile(params, t0=0.)
+    lambdaA, lambdaB = 8*profile, 6*profile
+    full = TimeStepping(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, rng=np.random.default_rng(0))
+    kept = list(range(0, params.nSteps, 7))+[params.nSteps] # the last instant is always kept
+    streamed = []
+    fileName = str(tmp_path/'trajectory.npy')
+    recorder = Recorder(['v_eA', 'v_eB', 16], decimation=7, callback=lambda t, x: streamed.append((t, x.copy())),
+                        fileName=fileName)
+    result = TimeStepping(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, rng=np.random.default_rng(0),
+                          recorder=recorder)
+    assert result['variables'] == ['v_eA', 'v_eB', 'C_iAeB']
+    np.testing.assert_allclose(result['t'], np.array(kept)*params.dt)
+    np.testing.assert_array_equal(result['X'][:len(kept)], full[kept][:,[0, 7, 16]])
+    np.testing.assert_array_equal([x for t, x in streamed], full[kept][:,[0, 7, 16]])
+    np.testing.assert_array_equal(result['finalState'], full[-1])
+    assert result['maxDiff'] == np.max(np.abs(full[:,0]-full[:,7])) and result['decisionTime'] is None
+    # the file has the kept rows, NaN after them
+    X = np.load(fileName)
+    np.testing.assert_array_equal(X[:len(kept)], full[kept][:,[0, 7, 16]])
+    assert np.all(np.isnan(X[len(kept):]))
+    # summary mode keeps no trajectory, only the final state and the decision
+    X, decisionTime, psiFinal = TimeSteppingToDecision(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, 0.09,
+                                                       tWarmUp=0.2, rng=np.random.default_rng(0))
+    summary = TimeSteppingToDecision(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, 0.09, tWarmUp=0.2,
+                                     rng=np.random.default_rng(0), recorder=Recorder(summary=True))[0]
+    assert summary['X'] is None and summary['decisionTime'] == decisionTime is not None
+    np.testing.assert_array_equal(summary['finalState'], X[-1])
+    assert summary['finalTime'] == pytest.approx((len(X)-1)*params.dt)
+
+
+def test_recorder_of_an_ensemble(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=1.)
+    lambdaA, lambdaB = Stimuli(params, 3)
+    rngs = lambda: [np.random.default_rng(k) for k in range(3)]
+    full = TimeSteppingEnsemble(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, rng=rngs())
+    result = TimeSteppingEnsemble(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params, rng=rngs(),
+                                  recorder=Recorder(['v_eA', 'W_eB'], decimation=5))
+    assert result['X'].shape == (3, params.nSteps//5+1, 2)
+    np.testing.assert_array_equal(result['X'], full[:,::5][:,:,[0, 12]])
+    np.testing.assert_array_equal(result['finalState'], full[:,-1])
+
+
+# ## Reduced precision
+
+def test_float32_ensemble_passes_the_validation(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=3.)
+    state = np.random.get_state()
+    validation = ValidatePrecision(NOTEBOOK_V0, 8., 6., TF1, TF2, params, 0.1, nTrials=16, tWarmUp=0.2)
+    assert validation['passed']
+    decided = np.isfinite(validation['decisionTime'][0])
+    assert np.all(decided == np.isfinite(validation['decisionTime'][1])) and 4 <= decided.sum() < 16
+    assert np.all(validation['decisionTime'][0][decided] > 0)
+    assert validation['bytes'][1]*2 == validation['bytes'][0]
+    # the global random state is left alone
+    assert np.array_equal(np.random.get_state()[1], state[1])
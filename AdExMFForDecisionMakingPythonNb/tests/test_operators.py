@@ -0,0 +1,108 @@
+# Checks of the right-hand sides: the two-pool DifferentialOperator, its parameters and Jacobian, and the
+# N-column model. Run them from AdExMFForDecisionMakingPythonNb with: python -m pytest -q tests
+
+import numpy as np
+import pytest
+
+from DiffOperator import DifferentialOperator, MakeModelParameters, MODEL_PARAMETER_NAMES
+from DiffOperator import Jacobian, LinearDecayRates, ADAPTATION_VARIABLES, STATE_VARIABLE_NAMES
+from SDEIntegrator import TimeStepping
+from MultiColumn import MultiColumnOperator, TimeSteppingColumns, ColumnStateNames, ColumnCount, ColumnInitialState
+from theoretical_tools import TF_parameters, TF_PARAMETER_NAMES
+from SessionLauncher import NotebookParameters, NOTEBOOK_V0
+
+
+# ## Two pools
+
+def test_differential_operator_matches_the_finite_difference_path(transferFunctions, withoutJet):
+    TF1, TF2 = transferFunctions
+    params = MakeModelParameters(NotebookParameters())
+    V = np.asarray(NOTEBOOK_V0, dtype=float)
+    for stimuli in ((0., 0., 0., 0.), (3., 2., 0., 0.), (8., 6., 8., 6.)):
+        counter, counterDifferences = {}, {}
+        res = DifferentialOperator(V, TF1, TF2, params, *stimuli, counter=counter)
+        differences = DifferentialOperator(V, withoutJet(TF1), withoutJet(TF2), params, *stimuli,
+                                           counter=counterDifferences)
+        assert np.max(np.abs(res-differences)) <= 9e-5*np.max(np.abs(res))
+        # one jet per evaluation point, 13 evaluations each without the analytic jets
+        assert (counter['TF'], counterDifferences['TF']) == (5, 65)
+
+
+def test_jacobian_matches_central_differences(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters()
+    V = np.asarray(NOTEBOOK_V0, dtype=float)
+    stimuli = (8., 6., 8., 6.)
+    J = Jacobian(V, TF1, TF2, params, *stimuli)
+    for l in set(range(18))-set(ADAPTATION_VARIABLES): # W is at 1e-10, where the TF are far from linear
+        h = np.zeros(18)
+        h[l] = 1e-4*max(abs(V[l]), 1e-2)
+        column = (DifferentialOperator(V+h, TF1, TF2, params, *stimuli)
+                  -DifferentialOperator(V-h, TF1, TF2, params, *stimuli))/(2*h[l])
+        np.testing.assert_allclose(J[:,l], column, rtol=0, atol=1e-5*np.max(np.abs(column)))
+    # the adaptation equations are linear in W: their diagonal is the linear decay rate
+    decay = LinearDecayRates(params)
+    for k in ADAPTATION_VARIABLES:
+        assert J[k,k] == pytest.approx(decay[k], abs=1e-5)
+
+
+# ## Parameter records
+
+def test_parameter_record_keeps_the_notebook_vector(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters()
+    vector = list(params[:len(MODEL_PARAMETER_NAMES)])
+    record = MakeModelParameters(vector)
+    assert record == params and MakeModelParameters(record) is record
+    assert record[10] == record.vAI and record.nSteps == int(record.tF/record.dt)
+    assert (record.Ne, record.Ni) == (record.Ntot*record.pc/2, record.Ntot*(1-record.pc)/2)
+    assert MakeModelParameters(record, c0=1.2).c0 == 1.2 and record.c0 == 1.
+    with pytest.raises(AttributeError):
+        record.c0 = 2.
+    # the operator takes the record or the plain vector
+    V = np.asarray(NOTEBOOK_V0, dtype=float)
+    np.testing.assert_array_equal(DifferentialOperator(V, TF1, TF2, vector, 3., 2., 3., 2.),
+                                  DifferentialOperator(V, TF1, TF2, record, 3., 2., 3., 2.))
+
+
+def test_transfer_function_parameters_are_read_only(transferFunctions):
+    p = transferFunctions[0].params
+    assert p.array.tolist()[:len(TF_PARAMETER_NAMES)] == list(p[:len(TF_PARAMETER_NAMES)])
+    assert (p.fe_scaling, p.fi_scaling) == ((1.-p.gei)*p.pconnec*p.Ntot, p.gei*p.pconnec*p.Ntot)
+    with pytest.raises(ValueError):
+        p.array[0] = 0.
+    # without a fit, the threshold is the constant P0 = -45 mV
+    noFit = TF_parameters({name: getattr(p, name) for name in TF_PARAMETER_NAMES[:9]})
+    assert list(noFit[15:26]) == [-45e-3]+[0.]*10
+
+
+# ## N columns
+
+def RandomStates(n, seed=0):
+    # n states scattered around the initial conditions of the notebook, and their stimuli
+    rng = np.random.default_rng(seed)
+    V = np.asarray(NOTEBOOK_V0, dtype=float)[:,None]*rng.uniform(0.5, 1.5, (18, n))
+    return V, rng.uniform(0., 5., (2, n)), rng.uniform(0., 5., (2, n))
+
+
+def test_two_columns_match_the_two_pool_operator(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = MakeModelParameters(NotebookParameters())
+    V, excAff, inhAff = RandomStates(20)
+    res = DifferentialOperator(V, TF1, TF2, params, excAff[0], excAff[1], inhAff[0], inhAff[1])
+    columns = MultiColumnOperator(V, TF1, TF2, params, excAff, inhAff)
+    assert columns.shape == res.shape
+    assert np.all(np.abs(columns-res) <= 1e-9*np.abs(res).max(axis=1, keepdims=True))
+
+
+def test_two_columns_follow_the_two_pool_trajectory(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=1.)
+    assert ColumnStateNames(2) == STATE_VARIABLE_NAMES and ColumnCount(18) == 2
+    np.testing.assert_array_equal(ColumnInitialState(2), NOTEBOOK_V0)
+    lambdas = np.array([np.full(params.nSteps+1, 8.), np.full(params.nSteps+1, 6.)])
+    X, decisionTime, winner = TimeSteppingColumns(ColumnInitialState(2), lambdas, TF1, TF2, params,
+                                                  rng=np.random.default_rng(2))
+    reference = TimeStepping(NOTEBOOK_V0, lambdas[0], lambdas[1], TF1, TF2, params, rng=np.random.default_rng(2))
+    assert decisionTime is None and winner is None
+    np.testing.assert_allclose(X, reference, rtol=1e-9, atol=1e-9*np.abs(reference).max())
@@ -0,0 +1,232 @@
+# Checks of the sessions: sweeps on a process pool, results store, checkpoints, noise streams, launcher and
+# registries. Run them from AdExMFForDecisionMakingPythonNb with: python -m pytest -q tests
+
+import os
+import json
+
+import numpy as np
+import pytest
+
+from DecisionSession import RunSession, ResumeSession, RunSweep
+from ResultsStore import ResultsStore, ImportResultFiles, RESULT_DTYPE
+from NoiseStreams import TrialNoise
+from SDEIntegrator import TimeStepping, TimeSteppingEnsemble
+from cell_library import get_neuron_params, CELL_REGISTRY
+from syn_and_connec_library import get_connectivity_and_synapses_matrix
+from SessionLauncher import NotebookParameters, NOTEBOOK_V0, MakeConfig, ConfigParameters, EstimateCost, RunConfig, main
+
+
+def AssertSameResults(results, reference):
+    assert results.keys() == reference.keys()
+    for job in reference:
+        assert results[job].keys() == reference[job].keys()
+        for key in reference[job]:
+            np.testing.assert_array_equal(results[job][key], reference[job][key])
+
+
+# ## Sweeps
+
+def test_sweep_does_not_depend_on_the_workers(transferFunctions, tmp_path):
+    params = NotebookParameters(tF=3)
+    serial = RunSweep(params, NOTEBOOK_V0, 0, 3, [0.1, 0.2], 1.5, 2, 0.05, nWorkers=0, seed=7,
+                      saveDirectory=str(tmp_path))
+    pooled = RunSweep(params, NOTEBOOK_V0, 0, 3, [0.1, 0.2], 1.5, 2, 0.05, nWorkers=2, seed=7)
+    AssertSameResults(pooled, serial)
+    assert sorted(serial) == [(0.1, 1.5, 0), (0.1, 1.5, 1), (0.2, 1.5, 0), (0.2, 1.5, 1)]
+    assert set(serial[(0.1, 1.5, 0)]['performance'][:-1]) <= {0., 1.} # decisions are made
+    # each job is the session of its own stream, saved with the file names of the notebook
+    seeds = np.random.SeedSequence(7).spawn(4)
+    session = RunSession(params, *transferFunctions, NOTEBOOK_V0, 0, 3, 0.2, 1.5, 0.05, rng=np.random.default_rng(seeds[3]))
+    for key in session:
+        np.testing.assert_array_equal(session[key], serial[(0.2, 1.5, 1)][key])
+    np.testing.assert_array_equal(np.load(os.path.join(str(tmp_path), "performanceResults_Iter_1_k_200_c0_1500.npy")),
+                                  session['performance'])
+
+
+# ## Results store
+
+def SessionResult(nOfEpisodes, seed):
+    rng = np.random.default_rng(seed)
+    return {'performance': rng.integers(0, 2, nOfEpisodes).astype(float), 'decisionTimeList': rng.uniform(0, 5, nOfEpisodes),
+            'difficultyList': rng.choice([0.01, 0.05, 0.1], nOfEpisodes)}
+
+
+def test_store_round_trip(tmp_path):
+    directory = str(tmp_path/'store')
+    store = ResultsStore(directory, chunkSize=25)
+    sessions = {(k, c0, 0, iteration): SessionResult(10, seed) for seed, (k, c0, iteration) in
+                enumerate([(0.1, 1.0, 0), (0.1, 1.0, 1), (0.2, 1.5, 0), (0.3, 1.5, 0)])}
+    for (k, c0, horizon, iteration), result in sessions.items():
+        store.appendSession(result, k, c0, horizon, iteration)
+    # the pending rows are read too, and a second writer appends to the same directory
+    assert len(store.chunkNames()) == 1 and len(store.load()) == 40
+    other = ResultsStore(directory)
+    other.appendSession(SessionResult(5, 9), 0.1, 1.0, 1, 0)
+    other.flush()
+    store.flush()
+    assert len(store.chunkNames()) == 3 and len(store.load()) == 45
+    assert store.keys() == sorted(list(sessions)+[(0.1, 1.0, 1, 0)])
+
+    store.compact()
+    assert len(store.chunkNames()) == 1
+    reopened = ResultsStore(directory)
+    rows = reopened.load()
+    assert rows.dtype == RESULT_DTYPE and np.all(np.diff(rows['k']) >= 0)
+    for (k, c0, horizon, iteration), result in sessions.items():
+        session = reopened.session(k, c0, horizon, iteration)
+        for key in result:
+            np.testing.assert_array_equal(session[key], result[key])
+    assert len(reopened.load(k=0.1, episode=3)) == 3
+
+
+def test_import_of_the_notebook_files(tmp_path):
+    store = ResultsStore(str(tmp_path/'store'))
+    directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'showcaseData')
+    assert ImportResultFiles(store, os.path.join(directory, 'showcase_2_H0', 'varying_k'), horizon=0, c0=2.0) == 10
+    performance = np.load(os.path.join(directory, 'showcase_2_H0', 'varying_k', 'performanceResults_Iter_0_k_150.npy'))
+    np.testing.assert_array_equal(store.session(0.15, 2.0, 0, 0)['performance'], performance)
+    assert np.all(np.isnan(store.session(0.15, 2.0, 0, 0)['decisionTimeList']))
+    # the c0 value is read from the names when they have it, and is required otherwise
+    assert ImportResultFiles(store, os.path.join(directory, 'showcase_1_H0', 'varying_c0'), horizon=0) == 10
+    assert len(store.load(k=0.2, c0=1.3)) == np.load(os.path.join(
+        directory, 'showcase_1_H0', 'varying_c0', 'performanceResults_Iter_0_k_200_c0_1300.npy')).size
+    with pytest.raises(ValueError):
+        ImportResultFiles(store, os.path.join(directory, 'showcase_2_H0', 'varying_k'), horizon=0)
+
+
+# ## Checkpoints
+
+class Interrupted(Exception):
+    pass
+
+
+def InterruptedTF(TF, nCalls, withoutJet):
+    # TF (same parameters, hence the same fingerprint) whose jet raises Interrupted after nCalls
+    # evaluations, as a session killed in the middle
+    calls = [0]
+    def jet(fe, fi, XX):
+        calls[0] += 1
+        if calls[0] > nCalls:
+            raise Interrupted
+        return TF.jet(fe, fi, XX)
+    interrupted = withoutJet(TF)
+    interrupted.jet, interrupted.params = jet, TF.params
+    return interrupted
+
+
+@pytest.mark.parametrize('task', [{}, {'difficultySet': [0.3, 0.4], 'gain': 0.5}])
+def test_resumed_session_is_bit_identical(transferFunctions, withoutJet, tmp_path, task):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=3)
+    checkpoint = str(tmp_path/'session.npz')
+    full = RunSession(params, TF1, TF2, NOTEBOOK_V0, 0, 4, 0.1, rng=np.random.default_rng(3), **task)
+    with pytest.raises(Interrupted):
+        RunSession(params, InterruptedTF(TF1, 300, withoutJet), TF2, NOTEBOOK_V0, 0, 4, 0.1,
+                   rng=np.random.default_rng(3), checkpoint=checkpoint, checkpointEvery=1, **task)
+    assert 0 < np.load(checkpoint)['episode'] < 4
+    # another session does not resume from it
+    with pytest.raises(ValueError):
+        RunSession(params, TF1, TF2, NOTEBOOK_V0, 0, 4, 0.2, checkpoint=checkpoint, **task)
+    with pytest.raises(ValueError):
+        RunSession(NotebookParameters(tF=3, vAI=4), TF1, TF2, NOTEBOOK_V0, 0, 4, 0.1, checkpoint=checkpoint, **task)
+    # the generator state comes from the checkpoint, and so do the difficulty set and the gain
+    resumed = ResumeSession(checkpoint, params, TF1, TF2, NOTEBOOK_V0, checkpointEvery=1)
+    assert resumed.keys() == full.keys()
+    for key in full:
+        np.testing.assert_array_equal(resumed[key], full[key])
+
+
+# ## Noise streams
+
+def test_noise_blocks_replay_in_any_order():
+    noise = TrialNoise(3, iteration=1, episode=2, trial=0, blockSize=16)
+    forward = noise.intrinsic(100)[0:100]
+    stream = noise.intrinsic(100)
+    backward = np.array([stream[i] for i in reversed(range(100))])[::-1]
+    np.testing.assert_array_equal(forward, backward)
+    np.testing.assert_array_equal(TrialNoise(3, 1, 2, 0).extrinsic(100), TrialNoise(3, 1, 2, 0).extrinsic(100))
+    assert not np.array_equal(forward, TrialNoise(3, 1, 2, 1, blockSize=16).intrinsic(100)[0:100])
+
+
+def test_trial_is_replayed_in_isolation(transferFunctions):
+    TF1, TF2 = transferFunctions
+    params = NotebookParameters(tF=1.)
+    lambdaA, lambdaB = np.full((2, 3, params.nSteps+1), [[[8.]], [[6.]]])
+    ensemble = TimeSteppingEnsemble(NOTEBOOK_V0, lambdaA, lambdaB, TF1, TF2, params,
+                                    rng=[TrialNoise(5, 0, 1, trial, blockSize=8) for trial in range(3)])
+    single = TimeStepping(NOTEBOOK_V0, lambdaA[2], lambdaB[2], TF1, TF2, params, rng=TrialNoise(5, 0, 1, 2, blockSize=8))
+    np.testing.assert_array_equal(ensemble[2], single)
+
+
+def test_noise_streams_do_not_depend_on_the_workers():
+    params = NotebookParameters(tF=2)
+    serial = RunSweep(params, NOTEBOOK_V0, 0, 2, 0.1, [1.5, 2.], 2, nWorkers=0, noiseSession=5)
+    pooled = RunSweep(params, NOTEBOOK_V0, 0, 2, 0.1, [2., 1.5], 2, nWorkers=2, noiseSession=5)
+    AssertSameResults(pooled, serial)
+
+
+# ## Launcher
+
+def test_launcher_dry_run_runs_nothing(transferFunctions, tmp_path, capsys):
+    store = str(tmp_path/'store')
+    config = {'k': [0.05, 0.1], 'c0': 1.0, 'iterations': 2, 'episodes': 3, 'tF': 1., 'horizon': 1, 'store': store}
+    fileName = str(tmp_path/'config.json')
+    with open(fileName, 'w') as f:
+        json.dump(config, f)
+    assert main([fileName, '--dry-run', '--workers', '2']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:4] == ['Job: learning speed %g, c0 1, iteration %d' % (k, i) for k in (0.05, 0.1) for i in (0, 1)]
+    assert lines[4].startswith('4 sessions, 24 trials of at most 20 steps: at most 480 steps')
+    assert not os.path.exists(store)
+    cost = EstimateCost(MakeConfig(config, workers=2), 20, *transferFunctions)
+    assert (cost['jobs'], cost['trials'], cost['maxSteps'], cost['workers']) == (4, 24, 480, 2)
+    assert cost['wallTime'] == pytest.approx(480*cost['secondsPerStep']/2)
+    # the configuration is checked and can be printed
+    assert main([fileName, '--print-config']) == 0
+    assert json.loads(capsys.readouterr().out) == MakeConfig(config)
+    with pytest.raises(SystemExit):
+        main([fileName, '--workers', 'x'])
+    with pytest.raises(ValueError):
+        MakeConfig(config, unknown=1)
+
+
+def test_launcher_runs_the_sweep_of_its_configuration(transferFunctions, tmp_path):
+    config = MakeConfig({'k': [0.1, 0.2], 'c0': 1.5, 'episodes': 2, 'tF': 1., 'decisionThreshold': 0.05,
+                         'store': str(tmp_path/'store'), 'workers': 0, 'seed': 3})
+    results = RunConfig(config, verbose=False)
+    reference = RunSweep(ConfigParameters(config), NOTEBOOK_V0, 0, 2, [0.1, 0.2], 1.5, 1, 0.05, nWorkers=0, seed=3)
+    AssertSameResults(results, reference)
+    assert sorted(ResultsStore(str(tmp_path/'store')).keys()) == sorted((k, 1.5, 0, 0) for k in (0.1, 0.2))
+
+
+# ## Registries
+
+def test_registries_give_the_parameters_of_the_original_functions():
+    # the dicts built by the original if/elif chains, e.g. for RS-cell and CONFIG1 in SI units
+    assert get_neuron_params('RS-cell', 'RS', 10, SI_units=True) == \
+        {'name': 'RS', 'N': 10, 'Gl': 1e-9*10., 'Cm': 1e-12*200., 'Trefrac': 1e-3*5, 'El': 1e-3*-65.,
+         'Vthre': 1e-3*-50., 'Vreset': 1e-3*-65., 'delta_v': 1e-3*2., 'ampnoise': 0., 'a': 1e-9*4.,
+         'b': 1e-12*40., 'tauw': 1e-3*5000.}
+    assert get_neuron_params('FS-cell') == {'name': '', 'N': 1, 'Gl': 10., 'Cm': 200., 'Trefrac': 5, 'El': -65.,
+                                            'Vthre': -50., 'Vreset': -65., 'delta_v': 0.5, 'ampnoise': 0.,
+                                            'a': 0., 'b': 0., 'tauw': 1e9}
+    M = get_connectivity_and_synapses_matrix('CONFIG1', SI_units=True)
+    exc_pop = {'p_conn': 0.05, 'Q': 1.5*1e-9, 'Tsyn': 5.*1e-3, 'Erev': 0.*1e-3, 'p_conn_cross': 0.025,
+               'cross_weight_onE': 0.01, 'cross_weight_onI': 0.01, 'coeffCrossCov': 1}
+    inh_pop = dict(exc_pop, Q=5.*1e-9, Erev=-80.*1e-3)
+    assert M.shape == (2, 2)
+    assert M[0,0] == dict(exc_pop, name='ee', Ntot=10000, gei=0.2, ext_drive=3., afferent_exc_fraction=1.)
+    assert (M[1,0], M[0,1], M[1,1]) == (dict(inh_pop, name='ie'), dict(exc_pop, name='ei'), dict(inh_pop, name='ii'))
+    # the results are fresh dicts: changing them changes neither the registry nor the next results
+    params = get_neuron_params('RS-cell', SI_units=True)
+    params['El'] = 0.
+    M[0,1]['Q'] = 0.
+    assert CELL_REGISTRY['RS-cell'].params['El'] == -65. and get_neuron_params('RS-cell', SI_units=True)['El'] != 0.
+    assert get_connectivity_and_synapses_matrix('CONFIG1', SI_units=True)[0,1]['Q'] == 1.5*1e-9
+
+
+def test_registries_reject_unknown_names():
+    with pytest.raises(ValueError, match='known cells'):
+        get_neuron_params('unknown-cell')
+    with pytest.raises(ValueError, match='known networks'):
+        get_connectivity_and_synapses_matrix('unknown-network')
@@ -0,0 +1,199 @@
+# Checks of the transfer functions: their jets, compiled kernels, tables, fits and heterogeneous populations.
+# Run them from AdExMFForDecisionMakingPythonNb with: python -m pytest -q tests
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+from scipy.integrate import quad
+
+from DiffOperator import TF_jet
+from NeuronConnectivity import BuildTransferFunctionTable, LoadTransferFunctionTable, TabulateTransferFunctions
+from NeuronConnectivity import TransferFunctionFingerprint, HeterogeneousTransferFunction
+import NeuronConnectivity
+from NeuronConnectivity import TransferFunction, LoadTransferFunctions, DataPath, FIT_FILES
+from theoretical_tools import get_fluct_regime_varsup, threshold_func, erfc_func
+from theoretical_tools import TF_my_templateup, pseq_params, fit_transfer_function, make_fit_from_data
+from Benchmarks import RSCellParameters, SyntheticFitData
+
+
+# ## Jets
+
+@pytest.mark.parametrize('cell', [0, 1])
+def test_analytic_jet_matches_finite_differences(transferFunctions, withoutJet, cell):
+    TF = transferFunctions[cell]
+    fe, fi, XX = np.array([2., 5., 10., 20.]), np.array([4., 10., 15., 30.]), np.array([0., 1e-11, 5e-11, 1e-10])
+    jet, nJet = TF_jet(TF, fe, fi, XX)
+    differences, nDifferences = TF_jet(withoutJet(TF), fe, fi, XX, df=1e-3)
+    assert (nJet, nDifferences) == (1, 13)
+    jet, differences = np.array(jet), np.array(differences)
+    # each component relative to its largest value
+    assert np.all(np.abs(jet-differences) <= 1e-5*np.abs(jet).max(axis=1, keepdims=True))
+
+
+@pytest.mark.parametrize('cell', [0, 1])
+def test_float32_jet_agrees_with_float64(transferFunctions, cell):
+    TF = transferFunctions[cell]
+    rng = np.random.default_rng(1)
+    for fMax, XXMax in ((40., 1e-10), (1000., 1e-10), (1000., 500.)):
+        fe, fi, XX = (x.astype(np.float32) for x in (rng.uniform(0., fMax, 1000), rng.uniform(0., fMax, 1000),
+                                                     rng.uniform(0., XXMax, 1000)))
+        reduced = np.array(TF.jet(fe, fi, XX))
+        reference = np.array(TF.jet(fe.astype(float), fi.astype(float), XX.astype(float)))
+        assert reduced.dtype == np.float32
+        assert np.all(np.abs(reduced-reference) <= 1e-5*np.abs(reference).max(axis=1, keepdims=True))
+
+
+# ## Loader
+
+def test_transfer_functions_are_cached_on_the_fit_file(transferFunctions, tmp_path, monkeypatch):
+    assert LoadTransferFunctions('RS-cell', 'FS-cell', 'CONFIG1') == transferFunctions
+    fitFile = str(tmp_path/'fit.npy')
+    shutil.copy(DataPath(FIT_FILES[0]), fitFile)
+    reads = []
+    def CountingOpen(fileName, *args):
+        reads.append(fileName)
+        return open(fileName, *args)
+    monkeypatch.setattr(NeuronConnectivity, 'open', CountingOpen, raising=False)
+    TF = TransferFunction('RS-cell', 'CONFIG1', fitFile)
+    # same content: the transfer function of the data folder, and the file is hashed once
+    assert TF is transferFunctions[0]
+    assert TransferFunction('RS-cell', 'CONFIG1', fitFile) is TF and reads.count(fitFile) == 1
+    # a new fit gives a new transfer function
+    P = np.load(fitFile)
+    P[0] += 1e-3
+    np.save(fitFile, P)
+    os.utime(fitFile, ns=(0, os.stat(fitFile).st_mtime_ns+10**9))
+    refitted = TransferFunction('RS-cell', 'CONFIG1', fitFile)
+    assert refitted is not TF and refitted.params.array[TF.params.array != refitted.params.array].size == 1
+    assert reads.count(fitFile) == 2
+
+
+# ## Compiled kernels
+
+def NumpyTF(fe, fi, XX, params):
+    # The NumPy transfer function of the original notebook (TF_my_templateup before its compilation),
+    # on copies of fe and fi as it clamped them in place
+    fe, fi = np.maximum(np.array(fe, dtype=float), 1e-8), np.maximum(np.array(fi, dtype=float), 1e-8)
+    values = params[:26]
+    muV, sV, muGn, TvN = get_fluct_regime_varsup(fe, fi, XX, *values)
+    Vthre = threshold_func(muV, sV, TvN, muGn, *values[15:])
+    sV = np.maximum(sV, 1e-4)
+    return np.maximum(erfc_func(muV, sV, TvN, Vthre, values[6], values[7]), 1e-8)
+
+
+@pytest.mark.parametrize('cell', [0, 1])
+def test_compiled_transfer_function_matches_numpy(transferFunctions, cell):
+    TF = transferFunctions[cell]
+    rng = np.random.default_rng(2)
+    fe, fi, XX = rng.uniform(0., 50., (3, 40)), rng.uniform(0., 50., (3, 40)), rng.uniform(0., 1e-10, (3, 40))
+    fe[0,:5] = 0. # clamped to 1e-8
+    inputs = fe.copy(), fi.copy(), XX.copy()
+    reference = NumpyTF(fe, fi, XX, TF.params)
+    compiled = TF(fe, fi, XX)
+    assert compiled.shape == fe.shape
+    np.testing.assert_allclose(compiled, reference, rtol=1e-12, atol=1e-20)
+    # broadcast inputs and floats give the same values, and the inputs are left alone
+    np.testing.assert_allclose(TF(fe, fi[0,0], XX[0,0]), NumpyTF(fe, fi[0,0], XX[0,0], TF.params), rtol=1e-12)
+    assert TF(float(fe[1,3]), float(fi[1,3]), float(XX[1,3])) == pytest.approx(reference[1,3], rel=1e-12)
+    for x, y in zip((fe, fi, XX), inputs):
+        np.testing.assert_array_equal(x, y)
+
+
+# ## Lookup tables
+
+TEST_TABLE_RANGES = ((0., 40., 21), (0., 40., 21), (0., 1e-10, 6))
+
+
+def test_table_interpolates_the_jet(transferFunctions, tmp_path):
+    TF1, TF2 = transferFunctions
+    fileName = str(tmp_path/'RS_table.npy')
+    info = BuildTransferFunctionTable(TF1, fileName, TEST_TABLE_RANGES)
+    TFTable = LoadTransferFunctionTable(TF1, fileName)
+    assert TFTable.errorEstimate == info['errorEstimate'] and TFTable.errorEstimate['TF'] > 0
+    assert TransferFunctionFingerprint(TFTable) != TransferFunctionFingerprint(TF1)
+    # exact at the nodes, the analytic jet outside of the grid
+    fe, fi, XX = np.meshgrid(np.arange(2., 37., 2.), np.arange(2., 37., 2.), [2e-11, 4e-11, 6e-11])
+    np.testing.assert_allclose(TFTable.jet(fe, fi, XX), TF1.jet(fe, fi, XX), rtol=0, atol=1e-10)
+    np.testing.assert_array_equal(TFTable.jet(50., 10., 2e-11), TF1.jet(50., 10., 2e-11))
+    assert TFTable(50., 10., 2e-11) == pytest.approx(TF1(50., 10., 2e-11), rel=1e-12)
+    # and close to it between the nodes, away from the low rates
+    rng = np.random.default_rng(0)
+    fe, fi, XX = rng.uniform(20., 36., 500), rng.uniform(10., 36., 500), rng.uniform(2e-11, 7e-11, 500)
+    exact = np.array(TF1.jet(fe, fi, XX))
+    assert np.all(np.abs(np.array(TFTable.jet(fe, fi, XX))-exact) <= 1e-2*np.abs(exact).max(axis=1, keepdims=True))
+
+
+def test_stale_table_is_rejected_and_rebuilt(transferFunctions, tmp_path):
+    TF1, TF2 = transferFunctions
+    BuildTransferFunctionTable(TF1, str(tmp_path/'RS_table.npy'), TEST_TABLE_RANGES)
+    with pytest.raises(ValueError):
+        LoadTransferFunctionTable(TF2, str(tmp_path/'RS_table.npy'))
+    # TabulateTransferFunctions builds the missing tables and rebuilds the stale ones
+    TFTable1, TFTable2 = TabulateTransferFunctions(TF1, TF2, str(tmp_path), TEST_TABLE_RANGES)
+    infoName = os.path.join(str(tmp_path), '%s_table.json' % TF1.name)
+    with open(infoName) as f:
+        info = json.load(f)
+    with open(infoName, 'w') as f:
+        json.dump(dict(info, fingerprint='stale'), f)
+    with pytest.raises(ValueError):
+        LoadTransferFunctionTable(TF1, infoName.replace('.json', '.npy'))
+    TFTable1, TFTable2 = TabulateTransferFunctions(TF1, TF2, str(tmp_path), TEST_TABLE_RANGES)
+    with open(infoName) as f:
+        assert json.load(f)['fingerprint'] == info['fingerprint']
+    assert TFTable2(10., 10., 0.) == pytest.approx(TF2(10., 10., 0.), rel=1e-12)
+
+
+# ## Heterogeneous populations
+
+@pytest.mark.parametrize('sigma', [0.02, 0.05, 0.1])
+def test_heterogeneous_transfer_function_matches_quadrature(transferFunctions, sigma):
+    TF = transferFunctions[0]
+    TFHet = HeterogeneousTransferFunction(TF, sigma)
+    p = list(pseq_params(RSCellParameters()))
+    for fe, fi, XX in ((2., 8., 0.), (5., 10., 1e-11), (10., 5., 0.)):
+        def integrand(k): # TF of the cells of leak reversal potential El*k, weighted by the density of k ~ N(1, sigma)
+            q = list(p)
+            q[8] = p[8]*k
+            return TF_my_templateup(fe, fi, XX, *q)*np.exp(-(k-1)**2/(2*sigma**2))/(np.sqrt(2*np.pi)*sigma)
+        reference = quad(integrand, 1-8*sigma, 1+8*sigma, epsabs=0, epsrel=1e-12, limit=200)[0]
+        assert TFHet(fe, fi, XX) == pytest.approx(reference, rel=1e-5)
+    fe, fi, XX = np.array([2., 5., 10.]), np.array([8., 10., 5.]), np.array([0., 1e-11, 0.])
+    np.testing.assert_array_equal(TFHet(fe, fi, XX), [TFHet(*point) for point in zip(fe, fi, XX)])
+    np.testing.assert_allclose(TFHet.jet(fe, fi, XX)[0], TFHet(fe, fi, XX), rtol=1e-12)
+    assert HeterogeneousTransferFunction(TF, sigma) is TFHet
+
+
+# ## Fits
+
+def test_least_squares_fit_recovers_the_coefficients():
+    params = RSCellParameters()
+    Fe_eff, fiSim = np.meshgrid(np.linspace(1., 15., 15), np.linspace(4., 20., 8))
+    w = np.zeros_like(Fe_eff)
+    Fout = TF_my_templateup(Fe_eff, fiSim, w, *pseq_params(params))
+    result = fit_transfer_function(Fout, Fe_eff, fiSim, w, params, with_square_terms=True)
+    assert result['success'] and result['n_points'] == Fout.size and result['rms'] < 1e-9
+    fitted = np.arange(11) != 4 # P4 (the log(muGn) term) is switched off and kept at 0
+    np.testing.assert_allclose(result['P'][fitted], params['P'][fitted], rtol=0, atol=1e-9)
+    assert result['P'][4] == 0.
+    # without the square terms, they stay at 0
+    result = fit_transfer_function(Fout, Fe_eff, fiSim, w, params)
+    assert result['success'] and np.all(result['P'][5:] == 0.)
+
+
+@pytest.mark.filterwarnings('ignore:Unknown solver options') # xtol of the original Nelder-Mead fit
+def test_fit_methods_of_make_fit_from_data(tmp_path):
+    fileName = str(tmp_path/'RS-cell_synthetic.npy')
+    SyntheticFitData(fileName)
+    fitFile = fileName.replace('.npy', '_fit.npy')
+    for method in ('nelder-mead', 'least_squares'):
+        P = make_fit_from_data(fileName, method=method)
+        np.testing.assert_array_equal(np.load(fitFile), P)
+        MEANfreq, SDfreq, Fe_eff, levels, params, w = np.load(fileName, allow_pickle=True)
+        fiSim = np.meshgrid(np.zeros(Fe_eff.shape[1]), levels)[1]
+        rms = np.sqrt(np.mean((TF_my_templateup(Fe_eff, fiSim, w, *pseq_params(dict(params, P=P)))-MEANfreq)**2))
+        assert rms < 0.05*MEANfreq.max(), method
+    with pytest.raises(ValueError):
+        make_fit_from_data(fileName, method='unknown')
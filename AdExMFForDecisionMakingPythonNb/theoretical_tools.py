@@ -1,12 +1,15 @@
+import math
+from collections import namedtuple
 import numpy as np
 import numba
 import scipy.special as sp_spec
 import scipy.integrate as sp_int
-from scipy.optimize import minimize, curve_fit
+from scipy.optimize import minimize, curve_fit, least_squares
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from scipy import signal
-from scipy.integrate import quad
 def pseq_params(params):
     Qe, Te, Ee = params['Qe'], params['Te'], params['Ee']
     Qi, Ti, Ei = params['Qi'], params['Ti'], params['Ei']
@@ -26,9 +29,7 @@ def pseq_params(params):
     if 'P' in params.keys():
         P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10 = params['P']
     else: # no correction
-        P0 = -45e-3
-        for i in range(1,11):
-            exec('P'+str(i)+'= 0')
+        P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10 = [-45e-3]+[0]*10
 
     return Qe,Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross, crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10
 
@@ -109,110 +110,551 @@ def threshold_func(muV, sV, TvN, muGn, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P
         P9*(muV-muV0)/DmuV0*(TvN-TvN0)/DTvN0+\
         P10*(sV-sV0)/DsV0*(TvN-TvN0)/DTvN0
       
+### COMPILED TRANSFER FUNCTION
+# The transfer function parameters are gathered once in an immutable TFParameters record
+# (SI units, as given by cell_library and syn_and_connec_library), which also carries the
+# derived input scalings and a read-only float64 array (Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El,
+# Ntot, pconnec, pconnec_cross, crossweight_onE, crossweight_onI, gei, P0, ..., P10,
+# fe_scaling, fi_scaling) for the compiled kernels below.
+
+TF_PARAMETER_NAMES = ('Qe', 'Te', 'Ee', 'Qi', 'Ti', 'Ei', 'Gl', 'Cm', 'El', 'Ntot', 'pconnec', 'pconnec_cross',
+                      'crossweight_onE', 'crossweight_onI', 'gei', 'P0', 'P1', 'P2', 'P3', 'P4', 'P5',
+                      'P6', 'P7', 'P8', 'P9', 'P10')
+
+TFParameters = namedtuple('TFParameters', TF_PARAMETER_NAMES+('fe_scaling', 'fi_scaling', 'array'))
+
+def TF_params_array(Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross,
+                   crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10):
+    p = np.array([Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross,
+                  crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10,
+                  (1.-gei)*pconnec*Ntot, # fe_scaling: TOTAL (sum over synapses) excitatory input
+                  gei*pconnec*Ntot],     # fi_scaling: TOTAL (sum over synapses) inhibitory input
+                 dtype=np.float64)
+    p.flags.writeable = False
+    return p
+
+def TF_parameters(params):
+    """
+    builds the TFParameters record from a neuron parameter dictionary
+    completed by ReformatSynParameters (and the fit 'P' if any)
+    """
+    values = pseq_params(params)
+    p = TF_params_array(*values)
+    return TFParameters(*(tuple(float(v) for v in p[:26])+(p[26], p[27], p)))
+
+def _TF_array_params(p):
+    # the kernels accept a TFParameters record or the array of TF_params_array
+    if isinstance(p, TFParameters):
+        return p.array
+    return p
+
+@numba.njit(cache=True)
+def _fluct_regime_scalar(Fe, Fi, XX, p):
+    # get_fluct_regime_varsup for floats
+    Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El = p[0], p[1], p[2], p[3], p[4], p[5], p[6], p[7], p[8]
+    fe = Fe*p[26]
+    fi = Fi*p[27]
+    muGe, muGi = Qe*Te*fe, Qi*Ti*fi
+    muG = Gl+muGe+muGi
+    muV = (muGe*Ee+muGi*Ei+Gl*El-XX)/muG
+    muGn, Tm = muG/Gl, Cm/muG
+    Ue, Ui = Qe/muG*(Ee-muV), Qi/muG*(Ei-muV)
+    sV = math.sqrt(fe*(Ue*Te)**2/2./(Te+Tm)+fi*(Ti*Ui)**2/2./(Ti+Tm))
+    fe, fi = fe+1e-9, fi+1e-9
+    Tv = ( fe*(Ue*Te)**2 + fi*(Ti*Ui)**2 ) /( fe*(Ue*Te)**2/(Te+Tm) + fi*(Ti*Ui)**2/(Ti+Tm) )
+    TvN = Tv*Gl/Cm
+    return muV, sV+1e-12, muGn, TvN
+
+@numba.njit(cache=True)
+def _threshold_scalar(muV, sV, TvN, p):
+    # threshold_func for floats, the log(muGn) term being switched off there as well
+    muV0, DmuV0 = -60e-3,10e-3
+    sV0, DsV0 =4e-3, 6e-3
+    TvN0, DTvN0 = 0.5, 1.
+    return p[15]+p[16]*(muV-muV0)/DmuV0+\
+        p[17]*(sV-sV0)/DsV0+p[18]*(TvN-TvN0)/DTvN0+\
+        p[20]*((muV-muV0)/DmuV0)**2+\
+        p[21]*((sV-sV0)/DsV0)**2+p[22]*((TvN-TvN0)/DTvN0)**2+\
+        p[23]*(muV-muV0)/DmuV0*(sV-sV0)/DsV0+\
+        p[24]*(muV-muV0)/DmuV0*(TvN-TvN0)/DTvN0+\
+        p[25]*(sV-sV0)/DsV0*(TvN-TvN0)/DTvN0
+
+@numba.njit(cache=True)
+def _TF_scalar(fe, fi, XX, p):
+    if(fe<1e-8):
+        fe=1e-8
+    if(fi<1e-8):
+        fi=1e-8
+    muV, sV, muGn, TvN = _fluct_regime_scalar(fe, fi, XX, p)
+    Vthre = _threshold_scalar(muV, sV, TvN, p)
+    if(sV<1e-4):
+        sV=1e-4
+    Fout_th = .5/TvN*p[6]/p[7]*(math.erfc((Vthre-muV)/math.sqrt(2)/sV))
+    if(Fout_th<1e-8):
+        Fout_th=1e-8
+    return Fout_th
+
+@numba.njit(cache=True)
+def _TF_array(fe, fi, XX, p, out):
+    # fe, fi, XX are flat arrays of the same length, out too (float64 or float32)
+    for k in range(fe.shape[0]):
+        out[k] = _TF_scalar(fe[k], fi[k], XX[k], p)
+    return out
+
+def _kernel_dtype(fe, fi, XX):
+    # float32 arrays (with floats) stay in float32: they are read and written in float32, anything else
+    # is float64. TF_kernel computes each point in float64, TF_jet_kernel (the one of the right-hand
+    # sides) computes muV and sV in float32 and the rest in float64, see _TF_jet_array32
+    if np.result_type(fe, fi, XX) == np.float32:
+        return np.float32
+    return np.float64
+
+def TF_kernel(fe, fi, XX, p):
+    """
+    compiled transfer function, p being a TFParameters record or the array given by TF_params_array
+    floats give a float, otherwise the inputs are broadcast together 
+    (float32 inputs give float32 outputs, see _kernel_dtype)
+    the inputs are never modified
+    """
+    p = _TF_array_params(p)
+    if(hasattr(fe, "__len__") or hasattr(fi, "__len__") or hasattr(XX, "__len__")):
+        dtype = _kernel_dtype(fe, fi, XX)
+        fe, fi, XX = np.broadcast_arrays(np.asarray(fe, dtype=dtype),
+                                         np.asarray(fi, dtype=dtype),
+                                         np.asarray(XX, dtype=dtype))
+        return _TF_array(fe.ravel(), fi.ravel(), XX.ravel(), p, np.empty(fe.size, dtype=dtype)).reshape(fe.shape)
+    return _TF_scalar(float(fe), float(fi), float(XX), p)
+
 # final transfer function template :
-# @numba.jit()
 
 # Here pconnec_cross, crossweight_onE, crossweight_onI are just to make run the code without any problem, they are
 # not used actually in the function 'get_fluct_regime_varsup'
 def TF_my_templateup(fe, fi, XX, Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross,
                    crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10):
     # here TOTAL (sum over synapses) excitatory and inhibitory input
-    
-    
-
-    if(hasattr(fe, "__len__")):
-        
-        fe[fe<1e-8]=1e-8
-
-
-    else:
-    
-        if(fe<1e-8):
-            fe=1e-8
+    # fe, fi are clamped to 1e-8, sV to 1e-4 (after the threshold) and the output to 1e-8
+    return TF_kernel(fe, fi, XX, TF_params_array(Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross,
+                   crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10))
+
+
+
+### TRANSFER FUNCTION WITH ITS FIRST AND SECOND DERIVATIVES
+# A "jet" is the tuple (f, df/dfe, df/dfi, d2f/dfe2, d2f/dfedfi, d2f/dfi2).
+# The derivatives are propagated in closed form through the chain
+# get_fluct_regime_varsup -> threshold_func -> erfc_func, so that a single
+# call replaces the nested central differences of DiffOperator.
+
+@numba.njit(inline='always', cache=True)
+def _jet_float64(a):
+    return (np.float64(a[0]), np.float64(a[1]), np.float64(a[2]), np.float64(a[3]), np.float64(a[4]), np.float64(a[5]))
+
+def _jet_functions(real):
+    # the jet arithmetic in the precision real (np.float64 or np.float32), its constants being of that
+    # type so that float32 jets stay in float32, and get_fluct_regime_varsup on the jets of fe and fi
+    # (muV and sV in that precision, TvN in float64). The functions are inlined in the kernels, so that
+    # their loops over the points can be vectorized
+    zero, one, two, half, quarter = real(0.), real(1.), real(2.), real(.5), real(.25)
+    jit = numba.njit(inline='always', cache=True)
+
+    @jit
+    def const(c):
+        return (c, zero, zero, zero, zero, zero)
+
+    @jit
+    def add(a, b):
+        return (a[0]+b[0], a[1]+b[1], a[2]+b[2], a[3]+b[3], a[4]+b[4], a[5]+b[5])
+
+    @jit
+    def shift(a, c):
+        return (a[0]+c, a[1], a[2], a[3], a[4], a[5])
+
+    @jit
+    def scale(a, c):
+        return (c*a[0], c*a[1], c*a[2], c*a[3], c*a[4], c*a[5])
+
+    @jit
+    def mul(a, b):
+        return (a[0]*b[0],
+                a[1]*b[0]+a[0]*b[1],
+                a[2]*b[0]+a[0]*b[2],
+                a[3]*b[0]+two*a[1]*b[1]+a[0]*b[3],
+                a[4]*b[0]+a[1]*b[2]+a[2]*b[1]+a[0]*b[4],
+                a[5]*b[0]+two*a[2]*b[2]+a[0]*b[5])
+
+    @jit
+    def apply(a, f, df, d2f):
+        # chain rule for a scalar function f with derivatives df, d2f at a[0]
+        return (f,
+                df*a[1],
+                df*a[2],
+                d2f*a[1]*a[1]+df*a[3],
+                d2f*a[1]*a[2]+df*a[4],
+                d2f*a[2]*a[2]+df*a[5])
+
+    @jit
+    def inv(a):
+        i = one/a[0]
+        return apply(a, i, -i*i, two*i*i*i)
+
+    @jit
+    def sqrt(a):
+        s = math.sqrt(a[0])
+        return apply(a, s, half/s, -quarter/(s*a[0]))
+
+    @jit
+    def clamp(a, low):
+        # constant jet if the value falls below low
+        if(a[0]<low):
+            return const(low)
+        return a
+
+    @jit
+    def fluct_regime(fe, fi, XX, p):
+        # jets of muV, sV and TvN, fe and fi being clamped as in TF_my_templateup
+        Qe, Te, Ee, Qi, Ti, Ei = real(p[0]), real(p[1]), real(p[2]), real(p[3]), real(p[4]), real(p[5])
+
+        # here TOTAL (sum over synapses) excitatory and inhibitory input
+        ae, ai = real(p[26]), real(p[27])
+        Fe = clamp((ae*fe, ae, zero, zero, zero, zero), real(p[26]*1e-8))
+        Fi = clamp((ai*fi, zero, ai, zero, zero, zero), real(p[27]*1e-8))
+
+        muGe, muGi = scale(Fe, real(p[0]*p[1])), scale(Fi, real(p[3]*p[4]))
+        muG = shift(add(muGe, muGi), real(p[6]))
+        inv_muG = inv(muG)
+        muV = mul(shift(add(scale(muGe, Ee), scale(muGi, Ei)), real(p[6]*p[8])-XX), inv_muG)
+        Tm = scale(inv_muG, real(p[7]))
+        UeTe = mul(shift(scale(muV, -one), Ee), scale(inv_muG, real(p[0]*p[1])))
+        UiTi = mul(shift(scale(muV, -one), Ei), scale(inv_muG, real(p[3]*p[4])))
+        UeTe2, UiTi2 = mul(UeTe, UeTe), mul(UiTi, UiTi)
+        inv_TeTm = inv(shift(Tm, Te))
+        inv_TiTm = inv(shift(Tm, Ti))
+
+        sV = sqrt(scale(add(mul(mul(Fe, UeTe2), inv_TeTm), mul(mul(Fi, UiTi2), inv_TiTm)), half))
+        sV = shift(sV, real(1e-12))
+
+        Ae = mul(shift(Fe, real(1e-9)), UeTe2) # just to insure a non zero division,
+        Ai = mul(shift(Fi, real(1e-9)), UiTi2)
+
+        # Tv in float64: with a large adaptation XX, Ae and Ai are near multiples of each other (both 
+        # proportional to muV**2) and the derivatives of the quotient are differences of large terms
+        Ae, Ai = _jet_float64(Ae), _jet_float64(Ai)
+        inv_TeTm, inv_TiTm = _jet_float64(inv_TeTm), _jet_float64(inv_TiTm)
+        Tv = _jet_mul(_jet_add(Ae, Ai), _jet_inv(_jet_add(_jet_mul(Ae, inv_TeTm), _jet_mul(Ai, inv_TiTm))))
+        TvN = _jet_scale(Tv, p[6]/p[7])
+        return muV, sV, TvN
+
+    return const, add, shift, scale, mul, apply, inv, sqrt, clamp, fluct_regime
+
+(_jet_const, _jet_add, _jet_shift, _jet_scale, _jet_mul, _jet_apply, _jet_inv, _jet_sqrt, _jet_clamp,
+ _jet_fluct_regime) = _jet_functions(np.float64)
+_jet_fluct_regime32 = _jet_functions(np.float32)[-1]
+
+@numba.njit(cache=True)
+def _jet_erfc(a):
+    g = 1.1283791670955126*math.exp(-a[0]*a[0]) # 2/sqrt(pi)*exp(-x**2)
+    return _jet_apply(a, math.erfc(a[0]), -g, 2.*a[0]*g)
+
+@numba.njit(inline='always', cache=True)
+def _jet_erfc_argument(muV, sV, TvN, p):
+    # threshold_func (the log(muGn) term is switched off there as well), then the argument of the
+    # erfc of erfc_func, with the same clamping of sV as TF_my_templateup
+    muV0, DmuV0 = -60e-3,10e-3
+    sV0, DsV0 =4e-3, 6e-3
+    TvN0, DTvN0 = 0.5, 1.
+    x = _jet_scale(_jet_shift(muV, -muV0), 1./DmuV0)
+    y = _jet_scale(_jet_shift(sV, -sV0), 1./DsV0)
+    z = _jet_scale(_jet_shift(TvN, -TvN0), 1./DTvN0)
+    Vthre = _jet_shift(_jet_add(_jet_add(_jet_scale(x, p[16]), _jet_scale(y, p[17])), _jet_scale(z, p[18])), p[15])
+    Vthre = _jet_add(Vthre, _jet_add(_jet_add(_jet_scale(_jet_mul(x, x), p[20]), _jet_scale(_jet_mul(y, y), p[21])),
+                                     _jet_scale(_jet_mul(z, z), p[22])))
+    Vthre = _jet_add(Vthre, _jet_add(_jet_add(_jet_scale(_jet_mul(x, y), p[23]), _jet_scale(_jet_mul(x, z), p[24])),
+                                     _jet_scale(_jet_mul(y, z), p[25])))
+    sV = _jet_clamp(sV, 1e-4)
+    return _jet_scale(_jet_mul(_jet_add(Vthre, _jet_scale(muV, -1.)), _jet_inv(sV)), 1./math.sqrt(2))
+
+@numba.njit(cache=True)
+def _TF_jet_scalar(fe, fi, XX, p):
+    muV, sV, TvN = _jet_fluct_regime(fe, fi, XX, p)
+    arg = _jet_erfc_argument(muV, sV, TvN, p)
+    Fout_th = _jet_scale(_jet_mul(_jet_inv(TvN), _jet_erfc(arg)), .5*p[6]/p[7])
+    return _jet_clamp(Fout_th, 1e-8)
+
+@numba.njit(cache=True)
+def _TF_jet_array(fe, fi, XX, p, out):
+    # fe, fi, XX are flat float64 arrays of the same length, out of shape (6, length)
+    for k in range(fe.shape[0]):
+        jet = _TF_jet_scalar(fe[k], fi[k], XX[k], p)
+        for l in range(6):
+            out[l, k] = jet[l]
+    return out
+
+@numba.njit(cache=True, error_model='numpy')
+def _TF_jet_array32(fe, fi, XX, p, out):
+    # fe, fi, XX are flat float32 arrays of the same length, out of shape (6, length) in float32 and p
+    # the tuple of the parameters (so that the loops read them from registers, not from memory).
+    # muV and sV are computed in float32; TvN, the threshold polynomial, the erfc and the products 
+    # that follow in float64 (mixed precision). The erfc being a library call, it has a loop of its 
+    # own, the two others are vectorized. This is about twice as fast as _TF_jet_array, the jets 
+    # agreeing with it to a few 1e-6 (relative to the largest value of each component).
+    n = fe.shape[0]
+    work = np.empty((14, n)) # jets of the argument of the erfc and of 1/TvN, erfc and its derivative
+    for k in range(n):
+        muV, sV, TvN = _jet_fluct_regime32(fe[k], fi[k], XX[k], p)
+        muV, sV, TvN = _jet_float64(muV), _jet_float64(sV), _jet_float64(TvN)
+        work[0, k], work[1, k], work[2, k], work[3, k], work[4, k], work[5, k] = _jet_erfc_argument(muV, sV, TvN, p)
+        work[6, k], work[7, k], work[8, k], work[9, k], work[10, k], work[11, k] = _jet_inv(TvN)
+    for k in range(n):
+        work[12, k] = math.erfc(work[0, k])
+        work[13, k] = -1.1283791670955126*math.exp(-work[0, k]*work[0, k]) # -2/sqrt(pi)*exp(-x**2)
+    for k in range(n):
+        a = (work[0, k], work[1, k], work[2, k], work[3, k], work[4, k], work[5, k])
+        b = (work[6, k], work[7, k], work[8, k], work[9, k], work[10, k], work[11, k])
+        Fout_th = _jet_scale(_jet_mul(b, _jet_apply(a, work[12, k], work[13, k], -2.*a[0]*work[13, k])), .5*p[6]/p[7])
+        out[0, k], out[1, k], out[2, k], out[3, k], out[4, k], out[5, k] = _jet_clamp(Fout_th, 1e-8)
+    return out
+
+def TF_jet_kernel(fe, fi, XX, p):
+    """
+    compiled jet of the transfer function, p being a TFParameters record or the array given by TF_params_array
+    returns the tuple (TF, dTF/dfe, dTF/dfi, d2TF/dfe2, d2TF/dfedfi, d2TF/dfi2),
+    of floats or of arrays broadcast from the inputs
+    the clamping of fe, fi, sV and Fout_th gives zero derivatives in the clamped region
+    float32 inputs give float32 outputs, computed in mixed precision (see _TF_jet_array32)
+    """
+    p = _TF_array_params(p)
+    if(hasattr(fe, "__len__") or hasattr(fi, "__len__") or hasattr(XX, "__len__")):
+        dtype = _kernel_dtype(fe, fi, XX)
+        fe, fi, XX = np.broadcast_arrays(np.asarray(fe, dtype=dtype),
+                                         np.asarray(fi, dtype=dtype),
+                                         np.asarray(XX, dtype=dtype))
+        out = np.empty((6, fe.size), dtype=dtype)
+        if dtype == np.float32:
+            out = _TF_jet_array32(fe.ravel(), fi.ravel(), XX.ravel(), tuple(p), out)
+        else:
+            out = _TF_jet_array(fe.ravel(), fi.ravel(), XX.ravel(), p, out)
+        return tuple(out.reshape((6,)+fe.shape))
+    return _TF_jet_scalar(float(fe), float(fi), float(XX), p)
 
-    if(hasattr(fi, "__len__")):
-    
-        fi[fi<1e-8]=1e-8
+def TF_my_templateup_jet(fe, fi, XX, Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross,
+                   crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10):
+    """
+    same as TF_my_templateup but returns the jet
+    (TF, dTF/dfe, dTF/dfi, d2TF/dfe2, d2TF/dfedfi, d2TF/dfi2)
+    """
+    return TF_jet_kernel(fe, fi, XX, TF_params_array(Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross,
+                   crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10))
 
-    
-    else:
-        
-        if(fi<1e-8):
-            fi=1e-8
 
-   
-   
-   
-   
-   
-    muV, sV, muGn, TvN = get_fluct_regime_varsup(fe, fi,XX, Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross,
-                   crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10)
-    Vthre = threshold_func(muV, sV, TvN, muGn, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10)
-    
+# lookup tables of the jet : the 6 components of TF_jet_kernel tabulated on a regular (fe, fi, XX) grid,
+# interpolated with cubic (Catmull-Rom) convolution in each direction
+# grid is the array (fe0, dfe, nfe, fi0, dfi, nfi, XX0, dXX, nXX) and table has the shape (nfe, nfi, nXX, 6)
 
-    if(hasattr(muV, "__len__")):
-        #print("ttt",isinstance(muV, list), hasattr(muV, "__len__"))
-        sV[sV<1e-4]=1e-4
-    
-    
-    else:
-        
-        if(sV<1e-4):
-            sV=1e-4
+def TF_table_grid(fe_range, fi_range, XX_range):
+    """
+    grid array of a table, each range being (start, stop, number of points)
+    """
+    grid = []
+    for start, stop, n in (fe_range, fi_range, XX_range):
+        if(int(n)<4):
+            raise ValueError("a table needs at least 4 points in each direction")
+        grid += [float(start), (float(stop)-float(start))/(int(n)-1), float(int(n))]
+    grid = np.array(grid, dtype=np.float64)
+    grid.flags.writeable = False
+    return grid
+
+def TF_table_points(grid):
+    """
+    the (fe, fi, XX) axes of a table
+    """
+    return tuple(grid[3*k]+grid[3*k+1]*np.arange(int(grid[3*k+2])) for k in range(3))
 
+def TF_table_fill(table, grid, p):
+    """
+    fills table (e.g. a memory-mapped array) with the jet of the transfer function, one fe slice at a time
+    """
+    fe, fi, XX = TF_table_points(grid)
+    FI, XX = np.meshgrid(fi, XX, indexing='ij')
+    for k in range(fe.size):
+        table[k] = np.moveaxis(np.array(TF_jet_kernel(fe[k], FI, XX, p)), 0, -1)
+    return table
+
+@numba.njit(cache=True)
+def _cubic_weights(t):
+    t2 = t*t
+    t3 = t2*t
+    return (.5*(-t3+2.*t2-t), .5*(3.*t3-5.*t2+2.), .5*(-3.*t3+4.*t2+t), .5*(t3-t2))
+
+@numba.njit(cache=True)
+def _table_cell(x, x0, dx, n):
+    # index i of the cell and position t in [0, 1] in it, i = -1 if the cubic stencil i-1, ..., i+2
+    # is not inside the grid (the interpolation is then replaced by the analytic jet)
+    s = (x-x0)/dx
+    if(not (s>=1. and s<=n-2.)):
+        return -1, 0.
+    i = int(s)
+    if(i>n-3):
+        i = n-3
+    return i, s-i
+
+@numba.njit(cache=True)
+def _TF_table_jet_point(fe, fi, XX, table, grid, p, ncomp, out, m):
+    # writes the jet (its first ncomp components, 1 or 6) at (fe, fi, XX) in out[:, m]
+    i, u = _table_cell(fe, grid[0], grid[1], int(grid[2]))
+    j, v = _table_cell(fi, grid[3], grid[4], int(grid[5]))
+    k, w = _table_cell(XX, grid[6], grid[7], int(grid[8]))
+    if(i<0 or j<0 or k<0):
+        jet = _TF_jet_scalar(fe, fi, XX, p)
+        for l in range(ncomp):
+            out[l, m] = jet[l]
+        return
+    wu, wv, ww = _cubic_weights(u), _cubic_weights(v), _cubic_weights(w)
+    s0, s1, s2, s3, s4, s5 = 0., 0., 0., 0., 0., 0.
+    for a in range(4):
+        for b in range(4):
+            wab = wu[a]*wv[b]
+            for c in range(4):
+                wabc = wab*ww[c]
+                row = table[i-1+a, j-1+b, k-1+c]
+                s0 += wabc*row[0]
+                if(ncomp>1):
+                    s1 += wabc*row[1]
+                    s2 += wabc*row[2]
+                    s3 += wabc*row[3]
+                    s4 += wabc*row[4]
+                    s5 += wabc*row[5]
+    out[0, m] = s0
+    if(ncomp>1):
+        out[1, m], out[2, m], out[3, m], out[4, m], out[5, m] = s1, s2, s3, s4, s5
+
+@numba.njit(cache=True)
+def _TF_table_jet_scalar(fe, fi, XX, table, grid, p, ncomp):
+    out = np.zeros((6, 1))
+    _TF_table_jet_point(fe, fi, XX, table, grid, p, ncomp, out, 0)
+    return out[0, 0], out[1, 0], out[2, 0], out[3, 0], out[4, 0], out[5, 0]
+
+@numba.njit(cache=True)
+def _TF_table_jet_array(fe, fi, XX, table, grid, p, ncomp):
+    # fe, fi, XX are flat arrays of the same length
+    out = np.empty((ncomp, fe.shape[0]))
+    for k in range(fe.shape[0]):
+        _TF_table_jet_point(fe[k], fi[k], XX[k], table, grid, p, ncomp, out, k)
+    return out
+
+def TF_table_jet_kernel(fe, fi, XX, table, grid, p, ncomp=6):
+    """
+    jet of the transfer function interpolated in a table, in the order of TF_jet_kernel
+    (ncomp=1 only gives the value), the analytic jet is used outside of the grid
+    p is the TFParameters record or array the table was built with
+    """
+    p = _TF_array_params(p)
+    if(hasattr(fe, "__len__") or hasattr(fi, "__len__") or hasattr(XX, "__len__")):
+        fe, fi, XX = np.broadcast_arrays(np.asarray(fe, dtype=np.float64),
+                                         np.asarray(fi, dtype=np.float64),
+                                         np.asarray(XX, dtype=np.float64))
+        out = _TF_table_jet_array(fe.ravel(), fi.ravel(), XX.ravel(), table, grid, p, ncomp)
+        return tuple(out.reshape((ncomp,)+fe.shape))
+    return _TF_table_jet_scalar(float(fe), float(fi), float(XX), table, grid, p, ncomp)[:ncomp]
+
+def TF_table_error(table, grid, p):
+    """
+    estimate of the interpolation error of a table: the largest absolute difference with the analytic
+    jet over the centers of all interpolated cells, where the cubic convolution error is usually the
+    largest, for each of the 6 components (sampled there only, hence an estimate, not a bound)
+    """
+    fe, fi, XX = TF_table_points(grid)
+    fe, fi, XX = fe[1:-2]+grid[1]/2, fi[1:-2]+grid[4]/2, XX[1:-2]+grid[7]/2
+    FI, XX = np.meshgrid(fi, XX, indexing='ij')
+    error = np.zeros(6)
+    for k in range(fe.size):
+        exact = np.array(TF_jet_kernel(fe[k], FI, XX, p))
+        approx = np.array(TF_table_jet_kernel(fe[k], FI, XX, table, grid, p))
+        error = np.maximum(error, np.abs(approx-exact).reshape(6, -1).max(axis=1))
+    return error
 
 
-    
-    Fout_th = erfc_func(muV, sV, TvN, Vthre, Gl, Cm)
-    if(hasattr(Fout_th, "__len__")):
-        #print("ttt",isinstance(muV, list), hasattr(muV, "__len__"))
-        Fout_th[Fout_th<1e-8]=1e-8
-    
-    
-    else:
-        
-        if(Fout_th<1e-8):
-            Fout_th=1e-8
-    '''
-    if(El<-0.063):
-    
-        if(hasattr(Fout_th, "__len__")):
-            #print("ttt",isinstance(muV, list), hasattr(muV, "__len__"))
-            Fout_th[Fout_th>80.]=175
-    
-    
-        else:
-        
-            if(Fout_th>80.):
-                print("Done")
-                Fout_th=175
 
-    '''
-    #print 'yyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyy',fe,fi,muV, sV, TvN,Fout_th
-    return Fout_th
+def gaussian(x, mu, sig):
+    return (1/(sig*np.sqrt(2*3.1415)))*np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))
 
 
+### HETEROGENEOUS POPULATION
+# The leak reversal potentials El*k of the cells of a population are spread by a factor k ~ N(1, sigma),
+# and the TF of the population is the mean over k of the TF of its cells. The mean is taken by a
+# Gauss-Hermite quadrature of fixed order, k_j = 1+sqrt(2)*sigma*x_j with the weights w_j/sqrt(pi),
+# the TF of all the nodes being evaluated in the same compiled loop (order TF evaluations per point).
 
-def gaussian(x, mu, sig):
-    return (1/(sig*np.sqrt(2*3.1415)))*np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))
-def TF_my_templateup_heterogeneity(fe, fi, XX, Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10):
-    # here TOTAL (sum over synapses) excitatory and inhibitory input
-    
-    
-    
-    
-    def Phet(k):
-        locale=gaussian(k,1.,0.2)*TF_my_templateup(fe, fi,XX, Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El*k, Ntot, pconnec, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10)
-        return locale
+HETEROGENEITY_ORDER = 8
 
+def heterogeneity_nodes(sigma=0.2, order=HETEROGENEITY_ORDER):
+    """
+    nodes k_j and weights of the Gauss-Hermite quadrature of the mean over k ~ N(1, sigma)
+    """
+    x, w = np.polynomial.hermite.hermgauss(order)
+    return 1.+np.sqrt(2.)*sigma*x, w/np.sqrt(np.pi)
 
-    
-    outhet, err = quad(Phet, 0.1, 5)
+def TF_het_params(p, scales):
+    """
+    read-only parameter arrays (one row per node) of the heterogeneous TF, El being scaled by each node
+    """
+    pm = np.repeat(_TF_array_params(p)[None, :], len(scales), axis=0)
+    pm[:, 8] *= scales
+    pm.flags.writeable = False
+    return pm
+
+@numba.njit(cache=True)
+def _TF_het_scalar(fe, fi, XX, pm, weights):
+    out = 0.
+    for j in range(weights.shape[0]):
+        out += weights[j]*_TF_scalar(fe, fi, XX, pm[j])
+    return out
+
+@numba.njit(cache=True)
+def _TF_het_array(fe, fi, XX, pm, weights):
+    out = np.empty(fe.shape[0])
+    for k in range(fe.shape[0]):
+        out[k] = _TF_het_scalar(fe[k], fi[k], XX[k], pm, weights)
+    return out
+
+@numba.njit(cache=True)
+def _TF_het_jet_array(fe, fi, XX, pm, weights):
+    out = np.zeros((6, fe.shape[0]))
+    for k in range(fe.shape[0]):
+        for j in range(weights.shape[0]):
+            jet = _TF_jet_scalar(fe[k], fi[k], XX[k], pm[j])
+            for l in range(6):
+                out[l, k] += weights[j]*jet[l]
+    return out
+
+def TF_het_kernel(fe, fi, XX, pm, weights):
+    """
+    heterogeneous TF, pm being given by TF_het_params and weights by heterogeneity_nodes
+    floats give a float, otherwise the inputs are broadcast together
+    """
+    if(hasattr(fe, "__len__") or hasattr(fi, "__len__") or hasattr(XX, "__len__")):
+        fe, fi, XX = np.broadcast_arrays(np.asarray(fe, dtype=np.float64),
+                                         np.asarray(fi, dtype=np.float64),
+                                         np.asarray(XX, dtype=np.float64))
+        return _TF_het_array(fe.ravel(), fi.ravel(), XX.ravel(), pm, weights).reshape(fe.shape)
+    return _TF_het_scalar(float(fe), float(fi), float(XX), pm, weights)
+
+def TF_het_jet_kernel(fe, fi, XX, pm, weights):
+    """
+    jet of the heterogeneous TF (TF, dTF/dfe, dTF/dfi, d2TF/dfe2, d2TF/dfedfi, d2TF/dfi2)
+    """
+    fe, fi, XX = np.broadcast_arrays(np.asarray(fe, dtype=np.float64),
+                                     np.asarray(fi, dtype=np.float64),
+                                     np.asarray(XX, dtype=np.float64))
+    out = _TF_het_jet_array(fe.ravel(), fi.ravel(), XX.ravel(), pm, weights).reshape((6,)+fe.shape)
+    return tuple(out) if fe.ndim else tuple(float(o) for o in out)
 
-    
-    
-  
-    return outhet
+def TF_my_templateup_heterogeneity(fe, fi, XX, Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross,
+                   crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10,
+                   sigma=0.2, order=HETEROGENEITY_ORDER):
+    # TF_my_templateup of a population whose El is spread by k ~ N(1, sigma)
+    scales, weights = heterogeneity_nodes(sigma, order)
+    pm = TF_het_params(TF_params_array(Qe, Te, Ee, Qi, Ti, Ei, Gl, Cm, El, Ntot, pconnec, pconnec_cross,
+                   crossweight_onE, crossweight_onI, gei, P0, P1, P2, P3, P4, P5, P6, P7, P8, P9, P10), scales)
+    return TF_het_kernel(fe, fi, XX, pm, weights)
     
 
 
@@ -248,7 +690,9 @@ def make_loop(t, nu, vm, nu_aff_exc, nu_aff_inh, BIN,\
 
 
 def fitting_Vthre_then_Fout(Fout, Fe_eff, fiSim,w, params,\
-                               maxiter=50000, xtol=1e-5, with_square_terms=False):
+                               maxiter=50000, xtol=1e-5, with_square_terms=False, plot=True, verbose=True):
+    # SLSQP on the threshold then Nelder-Mead on Fout (see fit_transfer_function for the faster fit)
+    # plot, verbose: show the figures of the fit, print the progress of the minimizations
 
 
     Gl, Cm , El = params['Gl'], params['Cm'] , params['El']
@@ -279,7 +723,7 @@ def fitting_Vthre_then_Fout(Fout, Fe_eff, fiSim,w, params,\
             
     #xtol=1e-19
     #plsq = minimize(Res, P, method='nelder-mead',options={'xtol': xtol, 'disp': True, 'maxiter':maxiter})
-    plsq = minimize(Res, P, method='SLSQP',options={'ftol': 1e-15, 'disp': True, 'maxiter':40000})
+    plsq = minimize(Res, P, method='SLSQP',options={'ftol': 1e-15, 'disp': verbose, 'maxiter':40000})
     #print plsq
 
     P = plsq.x
@@ -293,65 +737,213 @@ def fitting_Vthre_then_Fout(Fout, Fe_eff, fiSim,w, params,\
                         TF_my_templateup(Fe_eff, fiSim,w, *pseq_params(params)))**2)
 
     plsq = minimize(Res, P, method='nelder-mead',\
-            options={'xtol': xtol, 'disp': True, 'maxiter':maxiter})
+            options={'xtol': xtol, 'disp': verbose, 'maxiter':maxiter})
 
 
 
+    # the returned coefficients, as in the original fit: with the square terms, those of the SLSQP fit
+    # of the threshold (the Nelder-Mead result is not returned), otherwise the Nelder-Mead ones
+    # completed with zero square terms
+    P = P if with_square_terms else np.concatenate([plsq.x, np.zeros(6)])
     params['P'] = P
     
-    diff=(TF_my_templateup(Fe_eff, fiSim,w, *pseq_params(params))-Fout).mean()
-    diff_M=(TF_my_templateup(Fe_eff, fiSim,w, *pseq_params(params))-Fout).max()
-    print("rrrrr",diff,diff_M)
-          
-          
-  
+    if verbose:
+        diff=(TF_my_templateup(Fe_eff, fiSim,w, *pseq_params(params))-Fout).mean()
+        diff_M=(TF_my_templateup(Fe_eff, fiSim,w, *pseq_params(params))-Fout).max()
+        print("rrrrr",diff,diff_M)
+
+    if plot:
+        plot_transfer_function_fit(Fout, Fe_eff, fiSim, w, params, P)
+
+    return P
+
+
+def plot_transfer_function_fit(Fout, Fe_eff, fiSim, w, params, P):
+    """
+    figures of a fit: Fout and the fitted TF against fi, then against muV, 
+    and the erfc of the fitted threshold at sV=4mV, TvN=0.5
+    """
+    Gl, Cm = params['Gl'], params['Cm']
+    Fout, Fe_eff, fiSim, w = Fout.flatten(), Fe_eff.flatten(), fiSim.flatten(), w.flatten()
+    params = dict(params, P=P)
+    muV, sV, muGn, TvN = get_fluct_regime_varsup(Fe_eff, fiSim,w, *pseq_params(params))
     plt.plot(fiSim,Fout,'rd',fiSim,TF_my_templateup(Fe_eff, fiSim,w, *pseq_params(params)),'bs')
-    #plt.plot(fiSim,Fe-eff,Fout,'rd')
     plt.show()
-    thrplot=threshold_func(muV, sV,TvN, muGn, *(plsq.x))
-    
-    #np.save('FScell_Voltage.npy',[muV, sV,TvN,Fout])
-   
+    thrplot=threshold_func(muV, sV,TvN, muGn, *P)
     plt.plot(muV,Fout,'rd',muV,erfc_func(muV, sV, TvN, thrplot, Gl, Cm),'bd')
     plt.show()
     plt.plot(muV,erfc_func(muV, 4e-3, 0.5, thrplot, Gl, Cm),'bd')
     plt.show()
 
 
+################################################################
+##### Headless fit with analytic Jacobians
+################################################################
 
-    if with_square_terms:
-        #return plsq.x
-        return P
-    else:
-        return np.concatenate([plsq.x, np.zeros(6)])
-
-def make_fit_from_data(DATA, with_square_terms=False):
+# The fluctuation variables (muV, sV, TvN, muGn) of the data points do not depend on the fit P and
+# the threshold is linear in P, Vthre = D.P, D being the design matrix of threshold_func. The threshold
+# fit is thus a linear least-squares problem, solved exactly, and the fit of Fout a nonlinear
+# least-squares problem with the Jacobian dTF/dVthre*D, solved by scipy's least_squares (trust region
+# reflective). P4 (the switched-off log(muGn) term) is kept at 0. Nothing is printed or shown unless asked.
 
-    MEANfreq, SDfreq, Fe_eff, fiSim, params,w = np.load(DATA)
-    
+def threshold_design_matrix(muV, sV, TvN, muGn, with_square_terms=True):
+    """
+    dVthre/dP of threshold_func, (n, 11), or (n, 5) without the square terms
+    """
+    muV0, DmuV0 = -60e-3,10e-3
+    sV0, DsV0 =4e-3, 6e-3
+    TvN0, DTvN0 = 0.5, 1.
+    x, y, z = (muV-muV0)/DmuV0, (sV-sV0)/DsV0, (TvN-TvN0)/DTvN0
+    columns = [np.ones_like(x), x, y, z, np.zeros_like(x)] # the log(muGn) term is switched off
+    if with_square_terms:
+        columns += [x**2, y**2, z**2, x*y, x*z, y*z]
+    return np.stack(columns, axis=-1)
 
+def TF_of_threshold(Vthre, muV, sV, TvN, Gl, Cm):
+    """
+    TF_my_templateup given the threshold, with the same clamps, and its derivative dTF/dVthre
+    """
+    sVc = np.maximum(sV, 1e-4)
+    u = (Vthre-muV)/np.sqrt(2)/sVc
+    Fout_th = .5/TvN*Gl/Cm*sp_spec.erfc(u)
+    dFout_th = -.5/TvN*Gl/Cm*2/np.sqrt(np.pi)*np.exp(-u**2)/np.sqrt(2)/sVc
+    return np.maximum(Fout_th, 1e-8), np.where(Fout_th < 1e-8, 0., dFout_th)
+
+def fit_transfer_function(Fout, Fe_eff, fiSim, w, params, with_square_terms=False, P=None,
+                          ftol=1e-12, xtol=1e-12, gtol=1e-12, max_nfev=None, plot=False, verbose=0):
+    """
+    fits the coefficients P of the threshold of TF_my_templateup to the data Fout(Fe_eff, fiSim, w)
+    (same data and same two stages as fitting_Vthre_then_Fout)
+    P: optional starting coefficients (11), instead of the threshold fit
+    verbose: verbosity of least_squares (0, 1 or 2)
+    returns a dict with the coefficients 'P' (11, square terms at 0 without them), the convergence
+    ('success', 'status', 'message', 'nfev', 'njev'), the errors on Fout ('rms', 'max_error') and on
+    the threshold ('threshold_rms'), the number of points and the times of both stages (s)
+    """
+    t0 = time.perf_counter()
+    Gl, Cm = params['Gl'], params['Cm']
+    Fout, Fe_eff, fiSim, w = (np.asarray(a, dtype=float).flatten() for a in (Fout, Fe_eff, fiSim, w))
+    free = np.array([0, 1, 2, 3]+([5, 6, 7, 8, 9, 10] if with_square_terms else []))
+
+    # threshold fit, on the points with 0 < Fout < 60 Hz, with fe and fi as given (as fitting_Vthre_then_Fout)
+    i_non_zeros = np.where((Fout>0.)&(Fout<60.))[0]
+    muV, sV, muGn, TvN = get_fluct_regime_varsup(Fe_eff[i_non_zeros], fiSim[i_non_zeros], w[i_non_zeros],
+                                                 *pseq_params(params))
+    Vthre_eff = effective_Vthre(Fout[i_non_zeros], muV, sV, TvN, Gl, Cm)
+    ok = np.isfinite(Vthre_eff)
+    Dthre, Vthre_eff = threshold_design_matrix(muV, sV, TvN, muGn)[ok], Vthre_eff[ok]
+    if P is None:
+        P = np.zeros(11)
+        P[free] = np.linalg.lstsq(Dthre[:, free], Vthre_eff, rcond=None)[0]
+    else:
+        P = np.concatenate([np.asarray(P, dtype=float), np.zeros(11-len(P))])
+    threshold_rms = np.sqrt(np.mean((Dthre.dot(P)-Vthre_eff)**2)) if Vthre_eff.size else np.nan
+    t1 = time.perf_counter()
+
+    # fit of Fout, on all the points, with fe and fi clamped as in TF_my_templateup
+    muV, sV, muGn, TvN = get_fluct_regime_varsup(np.maximum(Fe_eff, 1e-8), np.maximum(fiSim, 1e-8), w,
+                                                 *pseq_params(params))
+    D = threshold_design_matrix(muV, sV, TvN, muGn)
+    def coefficients(q):
+        p = P.copy()
+        p[free] = q
+        return p
+    def residuals(q):
+        return TF_of_threshold(D.dot(coefficients(q)), muV, sV, TvN, Gl, Cm)[0]-Fout
+    def jacobian(q):
+        dFout = TF_of_threshold(D.dot(coefficients(q)), muV, sV, TvN, Gl, Cm)[1]
+        return dFout[:, None]*D[:, free]
+    plsq = least_squares(residuals, P[free], jac=jacobian, method='trf', x_scale='jac',
+                         ftol=ftol, xtol=xtol, gtol=gtol, max_nfev=max_nfev, verbose=verbose)
+    P = coefficients(plsq.x)
+    t2 = time.perf_counter()
+
+    if plot:
+        plot_transfer_function_fit(Fout, Fe_eff, fiSim, w, params, P)
+    return {'P': P, 'success': bool(plsq.success), 'status': int(plsq.status), 'message': plsq.message,
+            'nfev': int(plsq.nfev), 'njev': int(plsq.njev or 0), 'rms': float(np.sqrt(np.mean(plsq.fun**2))),
+            'max_error': float(np.max(np.abs(plsq.fun))), 'threshold_rms': float(threshold_rms),
+            'n_points': int(Fout.size), 'time_threshold': t1-t0, 'time_fout': t2-t1, 'time': t2-t0}
+
+def fit_from_data(DATA, with_square_terms=False, save=True, **options):
+    """
+    fit_transfer_function on the data file of make_fit_from_data, the coefficients being saved
+    in DATA with the _fit.npy suffix (if save), the result having the 'file' and 'filename' entries
+    options: passed to fit_transfer_function
+    """
+    MEANfreq, SDfreq, Fe_eff, fiSim, params,w = np.load(DATA, allow_pickle=True) # an object array
     Fe_eff, Fout = np.array(Fe_eff), np.array(MEANfreq)
-    levels = fiSim # to store for colors
     fiSim = np.meshgrid(np.zeros(Fe_eff.shape[1]), fiSim)[1]
+    result = fit_transfer_function(Fout, Fe_eff, fiSim, np.array(w), params,
+                                   with_square_terms=with_square_terms, **options)
+    filename = DATA.replace('.npy', '_fit.npy')
+    if save:
+        np.save(filename, result['P'])
+    result.update(file=DATA, filename=filename if save else None)
+    return result
 
-    P = fitting_Vthre_then_Fout(Fout, Fe_eff, fiSim,w, params,\
-                                with_square_terms=with_square_terms)
-                                
-    print("ffffff",P)
+def _fit_from_data_job(job):
+    DATA, with_square_terms, save, options = job
+    return fit_from_data(DATA, with_square_terms, save, **options)
 
-    #plt.plot(Fe_eff[2,:],MEANfreq[2,:],"bs",fiSim[:,5],MEANfreq[:,5],"o")
-    plt.plot(Fe_eff[2,:],MEANfreq[2,:],"bs",fiSim[:,5],MEANfreq[:,5],"o")
-    #np.save('FScell_freq.npy',[Fe_eff[2,:],fiSim[:,5],MEANfreq[:,5]])
+def fit_many_from_data(files, with_square_terms=False, save=True, processes=None, **options):
+    """
+    fit_from_data on several data files (e.g. of the RS, FS and RS-cell_UD cells or of several
+    configurations) in parallel processes (all the cores by default, none if processes=1)
+    returns the dict file -> result of fit_from_data
+    """
+    jobs = [(DATA, with_square_terms, save, dict(options, plot=False)) for DATA in files]
+    if processes == 1 or len(jobs) < 2:
+        return {job[0]: _fit_from_data_job(job) for job in jobs}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return dict(zip(files, pool.map(_fit_from_data_job, jobs)))
 
-    plt.show()
-                            
-    print('==================================================')
-    print(1e3*np.array(P), 'mV')
+def fit_report(results):
+    """
+    text table of the timing and convergence of the results of fit_many_from_data
+    """
+    lines = ['%-40s %8s %6s %12s %12s %10s' % ('file', 'success', 'nfev', 'rms (Hz)', 'max (Hz)', 'time (s)')]
+    for DATA, r in results.items():
+        lines.append('%-40s %8s %6d %12.4g %12.4g %10.3f' % (DATA, r['success'], r['nfev'], r['rms'],
+                                                            r['max_error'], r['time']))
+    return '\n'.join(lines)
 
-    # then we save it:
-    filename = DATA.replace('.npy', '_fit.npy')
-    print('coefficients saved in ', filename)
-    np.save(filename, np.array(P))
+def make_fit_from_data(DATA, with_square_terms=False, method='nelder-mead', plot=False, verbose=False):
+    """
+    fits the TF to the data file DATA, the coefficients being saved with the _fit.npy suffix
+    method: 'nelder-mead' (fitting_Vthre_then_Fout, the original fit) or 'least_squares'
+    (fit_transfer_function, faster, whose coefficients differ slightly)
+    plot, verbose: show the figures of the fit, print its progress and result
+    """
+    if method == 'least_squares':
+        result = fit_from_data(DATA, with_square_terms, plot=plot, verbose=2 if verbose else 0)
+        P = result['P']
+        if verbose:
+            print(fit_report({DATA: result}))
+    elif method == 'nelder-mead':
+        MEANfreq, SDfreq, Fe_eff, fiSim, params,w = np.load(DATA, allow_pickle=True) # an object array
+
+        Fe_eff, Fout = np.array(Fe_eff), np.array(MEANfreq)
+        levels = fiSim # to store for colors
+        fiSim = np.meshgrid(np.zeros(Fe_eff.shape[1]), fiSim)[1]
+
+        P = fitting_Vthre_then_Fout(Fout, Fe_eff, fiSim,w, params,\
+                                    with_square_terms=with_square_terms, plot=plot, verbose=verbose)
+
+        if plot:
+            plt.plot(Fe_eff[2,:],MEANfreq[2,:],"bs",fiSim[:,5],MEANfreq[:,5],"o")
+            plt.show()
+
+        # then we save it:
+        filename = DATA.replace('.npy', '_fit.npy')
+        np.save(filename, np.array(P))
+    else:
+        raise ValueError("Unknown fitting method %s" % method)
+
+    if verbose:
+        print('==================================================')
+        print(1e3*np.array(P), 'mV')
+        print('coefficients saved in ', DATA.replace('.npy', '_fit.npy'))
 
     return P
 
@@ -368,11 +960,21 @@ if __name__=='__main__':
      """,
               formatter_class=argparse.RawTextHelpFormatter)
 
-    parser.add_argument('-f', "--FILE",help="file name of numerical TF data",\
-                        default='data/example_data.npy')
+    parser.add_argument('-f', "--FILE",help="file name(s) of numerical TF data, fitted in parallel by least_squares",\
+                        nargs='+', default=['data/example_data.npy'])
     parser.add_argument("--With_Square",help="Add the square terms in the TF formula"+\
                         "\n then we have 7 parameters",\
                          action="store_true")
+    parser.add_argument("--method",help="fitting method (least_squares is faster)", choices=['nelder-mead', 'least_squares'],\
+                        default='nelder-mead')
+    parser.add_argument("--plot",help="show the figures of the fit (one file only)", action="store_true")
+    parser.add_argument("--processes",help="number of parallel fits (all the cores by default)", type=int)
     args = parser.parse_args()
 
-    make_fit_from_data(args.FILE, with_square_terms=args.With_Square)
+    if len(args.FILE) == 1 or args.method != 'least_squares':
+        for DATA in args.FILE:
+            make_fit_from_data(DATA, with_square_terms=args.With_Square, method=args.method,
+                               plot=args.plot, verbose=True)
+    else:
+        print(fit_report(fit_many_from_data(args.FILE, with_square_terms=args.With_Square,
+                                            processes=args.processes)))